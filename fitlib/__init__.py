@@ -1,8 +1,12 @@
 from subprocess import Popen as popen, PIPE
-from os import stat, path, chdir, getcwd, close as osclose, remove, mkdir, devnull
+from os import stat, path, chdir, getcwd, close as osclose, remove, mkdir, devnull, environ
 from tempfile import mkstemp
-from json import load, dump
-from paths import fitMapToTree, fitTreeToMap
+from json import load
+from paths import fitMapToTree, fitTreeToMap, FitData
+from hashes import iterHashes, hashFile
+import statindex
+import manifest
+import timings
 import re
 import platform
 from threading import Thread as thread
@@ -19,32 +23,66 @@ if platform.system() != "Windows":
     import signal
     signal.signal(signal.SIGPIPE, signal.SIG_DFL) 
 
-# Get the repo root directory if inside one, otherwise exit
-_p = popen('git rev-parse --show-toplevel'.split(), stdout=PIPE)
-repoDir = _p.communicate()[0].strip()
-if _p.returncode != 0:
-    raise Exception('Could not determine git working tree.')
-
-# Get some more directory/file paths we're interested in
-selfDir = path.dirname(path.realpath(__file__))
 workingDir = getcwd()
-gitDir = popen('git rev-parse --git-dir'.split(), stdout=PIPE).communicate()[0].strip()
-fitDir = path.join(gitDir,'fit')
-fitFile = path.join(repoDir, '.fit')
-cacheDir = path.join(fitDir, 'cache')
-objectsDir = path.join(cacheDir, 'objects')
-savesDir = path.join(cacheDir, 'saves')
-commitsDir = path.join(cacheDir, 'commits')
-lruFile = path.join(cacheDir, 'lru')
-statFile = path.join(fitDir, 'stat')
-addedStatFile = path.join(fitDir, 'stat.added')
-mergeMineFitFile = path.join(fitDir, 'merge-mine')
-mergeOtherFitFile = path.join(fitDir, 'merge-other')
-tempDir = path.join(fitDir, 'temp')
-fitManifestItemsTempDir = path.join(fitDir, 'manifest_items_tmp')
+selfDir = path.dirname(path.realpath(__file__))
+
+# The paths of the repository that git-fit operates on. They are resolved the first
+# time any of them is used, so that importing fitlib does not run git at all. Hooks
+# that are given both GIT_DIR and GIT_WORK_TREE by git need no git call; otherwise a
+# single git rev-parse finds both directories.
+class _RepoContext(object):
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        self._resolve()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def _findDirs(self):
+        if environ.get('GIT_DIR') and environ.get('GIT_WORK_TREE'):
+            return path.abspath(environ['GIT_WORK_TREE']), path.abspath(environ['GIT_DIR'])
+
+        p = popen('git rev-parse --show-toplevel --git-dir'.split(), stdout=PIPE)
+        lines = p.communicate()[0].splitlines()
+        if p.returncode != 0 or len(lines) != 2:
+            raise Exception('Could not determine git working tree.')
+        return lines[0], path.abspath(lines[1])
+
+    def _resolve(self):
+        if 'repoDir' in self.__dict__:
+            return
+
+        repoDir, gitDir = self._findDirs()
+        fitDir = path.join(gitDir, 'fit')
+        cacheDir = path.join(fitDir, 'cache')
+        self.__dict__.update(
+            gitDir = gitDir,
+            fitDir = fitDir,
+            fitFile = path.join(repoDir, '.fit'),
+            cacheDir = cacheDir,
+            objectsDir = path.join(cacheDir, 'objects'),
+            savesDir = path.join(cacheDir, 'saves'),
+            commitsDir = path.join(cacheDir, 'commits'),
+            lruFile = path.join(cacheDir, 'lru'),
+            cacheDbFile = path.join(cacheDir, 'cache.db'),
+            statFile = path.join(fitDir, 'stat'),
+            addedStatFile = path.join(fitDir, 'stat.added'),
+            mergeMineFitFile = path.join(fitDir, 'merge-mine'),
+            mergeOtherFitFile = path.join(fitDir, 'merge-other'),
+            tempDir = path.join(fitDir, 'temp'),
+            fitManifestItemsTempDir = path.join(fitDir, 'manifest_items_tmp'),
+            manifestsDir = path.join(fitDir, 'manifests'),
+        )
+        # set last, as it marks the context as resolved
+        self.repoDir = repoDir
+
+repo = _RepoContext()
 
 _fitFileItemRgx = re.compile('([^:]+):\[([^,]+),(\d+)\],?')
 zeroByteSha1 = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+_gzipMagic = '\x1f\x8b'
 
 # Parameterized decorator that will wrap the decoratee with a cd into the git directory
 # before running the operation, and a cd back into the starting directory afterwards.
@@ -59,8 +97,11 @@ def gitDirOperation(arg):
     # @gitDirOperatio('path/gitFolder'). How we get the git directory depends on which
     # form of the decorator is used.
 
-    isParameterized = isinstance(arg, basestring)
-    getDir = (lambda s: arg) if isParameterized else (lambda s: s[0].gitDir)
+    isParameterized = isinstance(arg, (basestring, _RepoContext))
+    if isinstance(arg, _RepoContext):
+        getDir = lambda s: arg.repoDir
+    else:
+        getDir = (lambda s: arg) if isParameterized else (lambda s: s[0].gitDir)
 
     # Assume non-parameterized form by default. If actually the parameterized form
     # is used, than wrapper() will set decoratee to the passed-in function, which
@@ -82,27 +123,69 @@ def gitDirOperation(arg):
 
     return wrapper if isParameterized else decorator
 
+# The ctime of files with several links (e.g. items hard-linked to the cache) changes
+# whenever a link is added or removed, so it is left out for them
 def fitStats(filename):
     stats = stat(filename)
-    return stats.st_size, stats.st_mtime, stats.st_ctime, stats.st_ino
-
-def readFitFile(filePath=fitFile, rev=None):
+    return stats.st_size, stats.st_mtime, stats.st_ctime if stats.st_nlink < 2 else 0, stats.st_ino
+
+# The .fit file is written in the format set by fit.manifest.format: "text" (the
+# default) or "binary" (see manifest.py). Both, as well as the gzipped JSON of early
+# versions, are told apart by their first bytes and can always be read.
+def getManifestFormat():
+    return getConfig('fit.manifest.format', 'text')
+
+def _getFitDataFormat(head):
+    if manifest.isManifest(head):
+        return 'binary'
+    return 'json' if head.startswith(_gzipMagic) else 'text'
+
+def _readFitData(fitFileIn):
+    head = fitFileIn.read(len(manifest.SIGNATURE))
+    fitFileIn.seek(0)
+    dataFormat = _getFitDataFormat(head)
+    if dataFormat == 'binary':
+        return manifest.read(fitFileIn)
+    if dataFormat == 'json':
+        return load(gz(None,None,None,fitFileIn))
+    return fitTreeToMap(_readFitFileRec(fitFileIn))
+
+# Parsed .fit files are looked up by blob id in the cache of manifestcache.py first.
+# They are returned as FitData, so that their PathIndex is shared by the commands.
+@timings.phase('read .fit')
+def readFitFile(filePath=None, rev=None):
+    import manifestcache
+    filePath = filePath or repo.fitFile
     if rev:
-        fitDataString = _getFitDataStringForRev(rev=rev)
-        try:
-            return load(gz(None,None,None,StringIO(fitDataString)))
-        except:
-            return fitTreeToMap(_readFitFileRec(StringIO(fitDataString)))
+        blobId = _getFitBlobIdForRev(rev)
+        if not blobId:
+            return FitData()
+        fitData = manifestcache.get(blobId)
+        if fitData is None:
+            fitDataString = _getBlobString(blobId)
+            fitData = FitData(_readFitData(StringIO(fitDataString)))
+            timings.count('.fit bytes parsed', len(fitDataString))
+            manifestcache.put(blobId, fitData)
+        return fitData
     elif not (path.exists(filePath) and path.getsize(filePath) > 0):
-        return {}
+        return FitData()
     else:
-        try:
-            return load(gz(filePath))
-        except:
-            fitFileIn = open(filePath)
-            fitData = fitTreeToMap(_readFitFileRec(fitFileIn))
-            fitFileIn.close()
-            return fitData
+        blobId = hashFile(filePath)
+        fitData = manifestcache.get(blobId)
+        if fitData is None:
+            with open(filePath, 'rb') as fitFileIn:
+                fitData = FitData(_readFitData(fitFileIn))
+            timings.count('.fit bytes parsed', path.getsize(filePath))
+            manifestcache.put(blobId, fitData)
+        return fitData
+
+# Whether the .fit file exists in a format other than the configured one
+def isFitFileConversionNeeded(filePath=None):
+    filePath = filePath or repo.fitFile
+    if not (path.exists(filePath) and path.getsize(filePath) > 0):
+        return False
+    with open(filePath, 'rb') as fitFileIn:
+        return _getFitDataFormat(fitFileIn.read(len(manifest.SIGNATURE))) != getManifestFormat()
     
 def _readFitFileRec(fitFileIn):
     items = {}
@@ -117,23 +200,26 @@ def _readFitFileRec(fitFileIn):
             items[parts[0]] = [parts[1], int(parts[2])]
     return items
 
-def writeFitFile(fitData, filePath=fitFile):
+@timings.phase('write .fit')
+def writeFitFile(fitData, filePath=None):
+    filePath = filePath or repo.fitFile
     fitFileOut = open(filePath, 'wb')
-    _writeFitFileRec(fitFileOut, fitMapToTree(fitData))
+    if getManifestFormat() == 'binary':
+        manifest.write(fitData, fitFileOut)
+    else:
+        _writeFitFileRec(fitFileOut, fitMapToTree(fitData))
+    timings.count('.fit bytes written', fitFileOut.tell())
     fitFileOut.close()
 
-def _dictItemComparator(a,b):
-    if type(a[1]) == type(b[1]):
-        return -1 if a[0] < b[0] else (1 if a[0] > b[0] else 0)
-    if type(a[1]) == type({}):
-        return 1
-    return -1
+# Items come before directories, and each of them in name order
+def _dictItemKey(item):
+    return type(item[1]) == type({}), item[0]
 
 def _writeFitFileRec(fitFileOut, fitData):
     if len(fitData) == 0:
         return
 
-    items = sorted(fitData.iteritems(), cmp=_dictItemComparator)
+    items = sorted(fitData.iteritems(), key=_dictItemKey)
     for k,v in items[:-1]:
         _writeFitFileItem(fitFileOut, k, v)
     k,v = items[-1]
@@ -151,15 +237,25 @@ def printAsText(fitData):
     items = sorted([(b[:7],a) for a,(b,c) in  fitData.iteritems()], key=lambda i:i[1])
     print '\n'.join(['%s %s'%(h,p) for h,p in items])
 
-# The stat file is a Python-pickled dictionary of the following form:
-#   {filename --> (st_size, st_mtime, st_ctime, st_ino, checksum_hash)}
-def readStatFile(filePath=statFile):
-    return load(open(filePath)) if path.exists(filePath) else {}
-
-def writeStatFile(stats, filePath=statFile):
-    statOut = open(filePath, 'wb')
-    dump(stats, statOut)
-    statOut.close()
+# The stat file is a binary index of the following form (see statindex.py):
+#   {filename --> (checksum_hash, (st_size, st_mtime, st_ctime, st_ino))}
+@timings.phase('read stat index')
+def readStatFile(filePath=None):
+    filePath = filePath or repo.statFile
+    return statindex.read(filePath)
+
+@timings.phase('write stat index')
+def writeStatFile(stats, filePath=None):
+    filePath = filePath or repo.statFile
+    statindex.write(stats, filePath)
+
+# Updates the given entries of the stat file, in place when they are all in it already
+def updateStatFile(stats, filePath=None):
+    filePath = filePath or repo.statFile
+    if not statindex.update(stats, filePath):
+        allStats = readStatFile(filePath=filePath)
+        allStats.update(stats)
+        writeStatFile(allStats, filePath=filePath)
 
 def _gitHashInputProducer(stream, items):
     for j in items:
@@ -167,41 +263,65 @@ def _gitHashInputProducer(stream, items):
         stream.flush()
     stream.close()
 
-@gitDirOperation(repoDir)
+def _gitHashObjects(items):
+    p = popen('git hash-object --stdin-paths'.split(), stdin=PIPE, stdout=PIPE)
+    thread(target=_gitHashInputProducer, args=(p.stdin,items)).start()
+    for l in p.stdout:
+        yield l.strip()
+
+# Number of processes used to hash files. Zero selects the old behavior of
+# piping the paths through git hash-object, which also applies any filters
+# configured for the paths in gitattributes.
+def getHashJobs():
+    from multiprocessing import cpu_count
+    return getConfigInt('fit.hash.jobs', cpu_count())
+
+@timings.phase('hash')
+@gitDirOperation(repo)
 def computeHashes(items):
     if not items:
         return []
+    timings.count('items hashed', len(items))
 
     hashes = []
     numItems = len(items)
     numDigits = str(len(str(numItems)+''))
     progress_fmt = ('\rComputing hashes for new objects...%6.2f%%  '+'%'+numDigits+'s/%'+numDigits+'s')
     print progress_fmt%(0, 0, numItems),
-    p = popen('git hash-object --stdin-paths'.split(), stdin=PIPE, stdout=PIPE)
-    thread(target=_gitHashInputProducer, args=(p.stdin,items)).start()
+    jobs = getHashJobs()
     i = 0
-    for l in p.stdout:
-        hashes.append(l.strip())
+    for h in (iterHashes(items, jobs) if jobs > 0 else _gitHashObjects(items)):
+        hashes.append(h)
         i += 1
         print progress_fmt%(i*100./numItems, i, numItems),
         stdout.flush()
     print '\r'+(' '*(45+int(numDigits)*2))+'\r',
     return hashes
 
-@gitDirOperation(repoDir)
-def refreshStats(items, filePath=statFile):
-    stats = readStatFile(filePath=filePath)
-    for i in items:
-        stats[i] = (items[i], fitStats(i))
-    writeStatFile(stats, filePath=filePath)
+@gitDirOperation(repo)
+def refreshStats(items, filePath=None):
+    filePath = filePath or repo.statFile
+    timings.count('items stat()ed', len(items))
+    updateStatFile({i: (items[i], fitStats(i)) for i in items}, filePath=filePath)
 
-@gitDirOperation(repoDir)
-def updateStats(items, filePath=statFile):
+@timings.phase('update stats')
+@gitDirOperation(repo)
+def updateStats(items, filePath=None):
+    filePath = filePath or repo.statFile
     oldStats = readStatFile(filePath=filePath)
     newStats = {}
     stubs = []
+
+    # With a file system monitor, only the items it reports as changed (or that
+    # are not in the stat file) need to be stat()ed
+    import fsmonitor
+    token, changed = fsmonitor.query(filePath) if filePath == repo.statFile else (None, None)
+
     for i in items:
-        stats = fitStats(i)
+        if changed is not None and i in oldStats and i not in changed:
+            stats = tuple(oldStats[i][1])
+        else:
+            stats = fitStats(i)
         if stats[0] > 0:
             newStats[i] = stats
         else:
@@ -212,19 +332,25 @@ def updateStats(items, filePath=statFile):
     # be considered "modified". Modified items are those that are touched
     # AND whose checksums are different, so we do checksum comparisons next
     touched = [i for i,s in newStats.iteritems() if i not in oldStats or tuple(oldStats[i][1]) != s]
+    # counted only when timings are on, to keep the loops above lean
+    if timings.isEnabled():
+        statted = len(items) if changed is None else len([i for i in items if i not in oldStats or i in changed])
+        timings.count('items stat()ed', statted)
+        timings.count('bytes hashed', sum(newStats[i][0] for i in touched))
     touched = dict(zip(touched, computeHashes(touched)))
 
-    statsUpdated = False
-    if len(touched) > 0:
-        statsUpdated = True
-        for i,h in touched.iteritems():
-            oldStats[i] = (h,newStats[i])
-    if len(newStats) != len(oldStats):
-        statsUpdated = True
-        for s in set(oldStats) - set(newStats):
-            del oldStats[s]
-    if statsUpdated:
+    for i,h in touched.iteritems():
+        oldStats[i] = (h,newStats[i])
+
+    removed = set(oldStats) - set(newStats)
+    for s in removed:
+        del oldStats[s]
+
+    # Items that were only re-hashed are patched in place in the stat file,
+    # while added or removed items need the whole file to be rewritten
+    if removed or not statindex.update({i: oldStats[i] for i in touched}, filePath):
         writeStatFile(oldStats, filePath=filePath)
+    token and fsmonitor.saveToken(filePath, token)
 
     return oldStats, stubs
 
@@ -232,36 +358,105 @@ def getFitSize(fitTrackedData):
     return sum(int(s) for p,(h,s) in fitTrackedData.iteritems())
 
 def getCommitFile(rev=None):
-    if not path.exists(commitsDir):
-        mkdir(commitsDir)
-    return path.join(commitsDir, rev or getHashForRevision() or '---')
+    if not path.exists(repo.commitsDir):
+        mkdir(repo.commitsDir)
+    return path.join(repo.commitsDir, rev or getHashForRevision() or '---')
+
+# The fit.* and core.* settings are read with a single git config call the first
+# time any of them is needed, rather than with a call for every key. They are kept
+# by key as git reports them, with the section and the name lowercased (None for
+# keys without a value).
+_CONFIG_SECTIONS = ('fit', 'core')
+_config = None
+
+def _readConfig():
+    global _config
+    if _config is None:
+        pattern = '^(%s)\\.'%'|'.join(_CONFIG_SECTIONS)
+        output = popen(['git', 'config', '-z', '--get-regexp', pattern], stdout=PIPE).communicate()[0]
+        config = {}
+        for entry in output.split('\0'):
+            if entry:
+                key, newline, value = entry.partition('\n')
+                config[key] = value.strip() if newline else None
+        _config = config
+    return _config
+
+# Returns the key as _readConfig() has it, or None if it is not of its sections
+def _configKey(key):
+    section, _, rest = key.partition('.')
+    if section.lower() not in _CONFIG_SECTIONS:
+        return None
+    subsection, dot, name = rest.rpartition('.')
+    return '%s.%s%s%s'%(section.lower(), subsection, dot, name.lower())
+
+# The value of a setting as git config --bool has it, or None if it is not a boolean
+def _parseBool(value):
+    if value is None:
+        return True
+    value = value.lower()
+    if value in ('true', 'yes', 'on'):
+        return True
+    if value in ('false', 'no', 'off', ''):
+        return False
+    try:
+        return int(value) != 0
+    except ValueError:
+        return None
+
+def getConfig(key, default=None):
+    configKey = _configKey(key)
+    if configKey:
+        value = _readConfig().get(configKey)
+    else:
+        value = popen(['git', 'config', key], stdout=PIPE).communicate()[0].strip()
+    return value if value else default
+
+def getConfigBool(key, default=False):
+    configKey = _configKey(key)
+    if configKey:
+        config = _readConfig()
+        value = _parseBool(config[configKey]) if configKey in config else None
+        return default if value is None else value
+    value = popen(['git', 'config', '--bool', key], stdout=PIPE).communicate()[0].strip()
+    return value == 'true' if value else default
+
+def getConfigInt(key, default=0):
+    try:
+        return int(getConfig(key, default))
+    except ValueError:
+        print 'warning: Ignoring non-integer value of %s in git config.'%key
+        return default
 
 def getHashForRevision(rev='HEAD'):
     return popen(('git rev-parse %s'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
 
-@gitDirOperation(repoDir)
-def _getFitDataStringForRev(rev):
-    return popen(('git show %s:.fit'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0]
+@gitDirOperation(repo)
+def _getFitBlobIdForRev(rev):
+    return popen(('git rev-parse --verify -q %s:.fit'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
+
+def _getBlobString(blobId):
+    return popen(('git cat-file blob %s'%blobId).split(), stdout=PIPE).communicate()[0]
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getFitManifestChanges(rev='HEAD@{1}'):
     lines = popen(("git diff-tree -r --name-only %s HEAD -- *.gitattributes .fit"%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
     return lines.split('\n') if lines else []
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def dirtyGitItemsFilter(items):
     lines = popen('git status --porcelain -u --ignored'.split() + list(items), stdout=PIPE).communicate()[0].rstrip()
     return [l.split(None, 1)[1] for l in lines.split('\n')] if lines else []
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getStagedFitFileHash():
     return popen('git ls-files -s .fit'.split(), stdout=PIPE).communicate()[0].strip().split()[1]
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getFitFileStatus():
     return popen('git status --porcelain -u --ignored .fit'.split(), stdout=PIPE).communicate()[0].rstrip()
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def filterBinaryFiles(files):
     p = popen(['git', 'grep','-I', '--name-only', '-e', "."] + files, stdout=PIPE)
     output = p.communicate()[0].strip()
@@ -272,7 +467,22 @@ def filterBinaryFiles(files):
 
     return binFiles
 
+def _tryTransfer(method, *args):
+    try:
+        return bool(method(*args))
+    except Exception:
+        return False
+
 class DataStore:
+    # Maximum number of objects git-fit get/put hand to getMany/putMany at once.
+    # Stores that can move a whole set of objects in one go should raise this.
+    batchSize = 1
+
+    # Whether getStream() can continue a download into a file that already holds
+    # the beginning of the object: at out.tell() for stores that write into out,
+    # or at the end of the file at out.name for those that write it by themselves
+    resumable = False
+
     def __init__(self, progress):
         pass
     def check(self, dst):
@@ -281,5 +491,34 @@ class DataStore:
         return False
     def put(self, src, dst, size):
         return False
+
+    # Returns a {key: check(key)} map for those of the given keys that exist in the
+    # store. Stores able to answer this for many keys with a single request (e.g.
+    # by listing a directory) should override this one-request-per-key default.
+    def checkMany(self, keys):
+        found = {}
+        for k in keys:
+            v = self.check(k)
+            if v:
+                found[k] = v
+        return found
+
+    # Downloads an object into out, a file object whose .name is the path of the
+    # file it writes. Stores that can write into a file object should override
+    # this default, which has get() write the file at that path.
+    def getStream(self, key, out, size):
+        return self.get(key, out.name, size)
+
+    # Transfers each (key, out, size) item, where key is what check() returned and
+    # out is a file object as for getStream(), and returns a list telling which of
+    # the items were transferred.
+    def getMany(self, items):
+        return [_tryTransfer(self.getStream, key, out, size) for key, out, size in items]
+
+    # Transfers each (src, dst, size) item and returns a list telling which of
+    # the items were transferred.
+    def putMany(self, items):
+        return [_tryTransfer(self.put, src, dst, size) for src, dst, size in items]
+
     def close(self):
         pass
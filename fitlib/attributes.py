@@ -0,0 +1,89 @@
+from . import repo, getConfig, timings
+from hashes import hashFile
+from hashlib import sha1
+from marshal import load, dump
+from os import path, environ, rename, remove
+from subprocess import Popen as popen, PIPE
+
+# Whether a path has the fit attribute only depends on the path and on the
+# attributes files, so the answers of git check-attr are kept in a cache file,
+# along with a key made of the blob hashes of all the attributes files (every
+# .gitattributes in the working tree, info/attributes, and the user's attributes
+# file). As long as the key matches, only paths that were not asked about before
+# go through git check-attr. When any attributes file changes, the whole cache is
+# thrown away.
+
+def _cacheFile():
+    return path.join(repo.fitDir, 'attributes')
+
+# The attributes files that apply to the working tree, including those in ignored
+# directories, which git check-attr reads as well. git goes through the ignored
+# directories to find them, but only lists the attributes files.
+def getAttributesFiles():
+    p = popen(['git', 'ls-files', '-co', '-z', '--', '*.gitattributes'], stdout=PIPE)
+    files = [f for f in p.communicate()[0].split('\0') if f.endswith('.gitattributes')]
+    files.append(path.join(repo.gitDir, 'info', 'attributes'))
+    userFile = getConfig('core.attributesFile')
+    if not userFile:
+        configHome = environ.get('XDG_CONFIG_HOME') or path.join(path.expanduser('~'), '.config')
+        userFile = path.join(configHome, 'git', 'attributes')
+    files.append(path.expanduser(userFile))
+    return files
+
+def getAttributesKey():
+    key = sha1()
+    for f in getAttributesFiles():
+        if path.isfile(f):
+            key.update('%s\0%s\0'%(f, hashFile(f)))
+    return key.hexdigest()
+
+# Returns a {path: hasFitAttribute} map for the given paths
+def checkFit(paths):
+    if not paths:
+        return {}
+    p = popen('git check-attr --stdin -z fit'.split(), stdin=PIPE, stdout=PIPE)
+    fields = p.communicate('\0'.join(paths) + '\0')[0].split('\0')
+    return {fields[n]: fields[n+2] == 'set' for n in range(0, len(fields) - 2, 3)}
+
+def _readCache(key):
+    try:
+        with open(_cacheFile(), 'rb') as f:
+            cacheKey, results = load(f)
+        return results if cacheKey == key else {}
+    except Exception:
+        # missing or unreadable, which just means starting over
+        return {}
+
+def _writeCache(key, results):
+    tempFile = _cacheFile() + '.tmp'
+    try:
+        with open(tempFile, 'wb') as f:
+            dump((key, results), f)
+        if path.exists(_cacheFile()):
+            remove(_cacheFile())
+        rename(tempFile, _cacheFile())
+    except (IOError, OSError):
+        path.exists(tempFile) and remove(tempFile)
+
+# Returns those of the given paths that have the fit attribute. Must run in the
+# repository's root directory.
+@timings.phase('attributes')
+def filterFitPaths(paths):
+    key = getAttributesKey()
+    cached = _readCache(key)
+
+    results = {}
+    new = []
+    for p in paths:
+        if p in cached:
+            results[p] = cached[p]
+        else:
+            new.append(p)
+    results.update(checkFit(new))
+    timings.count('paths checked by check-attr', len(new))
+
+    # Paths that went away are dropped from the cache as well
+    if new or len(results) != len(cached):
+        _writeCache(key, results)
+
+    return {p for p,isFit in results.iteritems() if isFit}
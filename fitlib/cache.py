@@ -1,73 +1,315 @@
-from . import lruFile, objectsDir
-from json import load,dump
-from os import remove, makedirs
-from os.path import exists
+from . import getConfig, repo
+from json import load
+from os import remove, makedirs, rename, link, chmod, umask, stat as osstat
+from os.path import exists, lexists
 from shutil import copyfile
 from sys import stdout
+from stat import S_IWUSR, S_IWGRP, S_IWOTH
+from hashes import hashFile
+import compression
+import sqlite3
 
+# The cache bookkeeping lives in an sqlite database with two tables of objects:
+#   lru:  objects that may be evicted, with a counter of when they were last used
+#   map:  objects that were saved or committed locally and must be kept until they
+#         have been put to the data store
+# The totals table keeps the running sizes of both tables and the last lru counter,
+# so that they never need to be recomputed from the items. The chunks table tells
+# where the chunks of chunked objects (see chunking.py) can be found in cached
+# objects, so that they need not be downloaded again. In hardlink mode (see below),
+# the objectStats table keeps the size and mtime of the objects as they were cached.
+#
+# Using an object gives it the next value of the ever-increasing lru counter, and
+# the index on the counter keeps the objects ordered from least to most recently
+# used. Touching or evicting an object is therefore an O(log n) index update, and
+# the counters never need to be renumbered.
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS lru (key TEXT PRIMARY KEY, size INTEGER NOT NULL, counter INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS lru_counter ON lru (counter);
+CREATE TABLE IF NOT EXISTS map (key TEXT PRIMARY KEY, size INTEGER NOT NULL, committed INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (chunk TEXT NOT NULL, object TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, PRIMARY KEY (chunk, object));
+CREATE INDEX IF NOT EXISTS chunks_object ON chunks (object);
+CREATE TABLE IF NOT EXISTS objectStats (key TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL);
+INSERT OR IGNORE INTO totals VALUES ('lruSize', 0);
+INSERT OR IGNORE INTO totals VALUES ('lruCount', 0);
+INSERT OR IGNORE INTO totals VALUES ('mapSize', 0);
+'''
+
+# Keys are looked up in chunks to stay below sqlite's limit on query parameters
+_QUERY_CHUNK = 500
+
+class _CacheDb:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=()):
+        return self.conn.execute(sql, args)
+
+    def executemany(self, sql, args):
+        return self.conn.executemany(sql, args)
+
+    # Returns a {key: row} map for those of the given keys that are in the table
+    def select(self, table, columns, keys):
+        keys = list(keys)
+        rows = {}
+        for i in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[i:i+_QUERY_CHUNK]
+            query = 'SELECT key, %s FROM %s WHERE key IN (%s)'%(columns, table, ','.join('?'*len(chunk)))
+            rows.update((r[0], r[1:]) for r in self.execute(query, chunk))
+        return rows
+
+    def total(self, name):
+        return self.execute('SELECT value FROM totals WHERE name = ?', (name,)).fetchone()[0]
+
+    def addTotal(self, name, delta):
+        if delta:
+            self.execute('UPDATE totals SET value = value + ? WHERE name = ?', (delta, name))
+
+    def setTotal(self, name, value):
+        self.execute('UPDATE totals SET value = ? WHERE name = ?', (value, name))
+
+def _migrateLruFile(db):
+    # Move the bookkeeping of the JSON lru file used by earlier versions into the database
+    data = load(open(repo.lruFile))
+    l, m = data['lru'], data['map']
+    db.executemany('INSERT OR REPLACE INTO lru VALUES (?, ?, ?)', ((str(k), s, c) for k,(s,c) in l['items'].iteritems()))
+    db.executemany('INSERT OR REPLACE INTO map VALUES (?, ?, ?)', ((str(k), s, int(c)) for k,(s,c) in m['items'].iteritems()))
+    db.setTotal('lruSize', l['size'])
+    db.setTotal('lruCount', l['count'])
+    db.setTotal('mapSize', m['size'])
+
+def _connect():
+    conn = sqlite3.connect(repo.cacheDbFile, timeout=60, isolation_level=None)
+    conn.text_factory = str
+    conn.executescript(_schema)
+    if exists(repo.lruFile):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # check again now that no other process can be migrating it as well
+            if exists(repo.lruFile):
+                _migrateLruFile(_CacheDb(conn))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        exists(repo.lruFile) and remove(repo.lruFile)
+    return conn
+
+# Runs the decoratee with an open cache database as the db argument (unless one is
+# passed in already). Everything the decoratee does is committed as one transaction,
+# or rolled back if it fails. The transaction takes the write lock up front, so that
+# concurrent callers (threads or processes) cannot interleave their reads and writes.
 def _cacheIO(decoratee):
     def decorator(*a, **k):
-        loaded = False
+        if k.get('db') != None:
+            return decoratee(*a, **k)
 
-        if k.get('data') == None:
-            loaded = True
-            k['data'] = load(open(lruFile)) if exists(lruFile) else {'lru':{'size':0,'count':0,'items':{}},'map':{'size':0,'items':{}}}
+        conn = _connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                k['db'] = _CacheDb(conn)
+                r = decoratee(*a, **k)
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            return r
+        finally:
+            conn.close()
+    return decorator
 
-        updated, r = decoratee(*a, **k)
+def objectPath(k):
+    return '%s/%s/%s'%(repo.objectsDir, k[:2], k[2:])
 
-        if loaded and updated:
-            f = open(lruFile, 'w')
-            dump(k['data'], f)
-            f.close()
+# Objects are materialized between the cache and the working tree according to
+# fit.cache.materialize:
+#   copy:      physically copy the contents (the default)
+#   reflink:   share the data blocks through a copy-on-write clone (btrfs, XFS...),
+#              falling back to copying where the file system cannot do that
+#   hardlink:  link both paths to the same file, which is made read-only so that
+#              in-place edits cannot corrupt the cached object; falls back to copying
+#              where links are not possible
+#
+# An item that is made writable again and edited in place still edits the object
+# it is linked to (and every other item linked to it). So in hardlink mode, objects
+# that are about to be used and are linked to more than their cache file are hashed
+# again if their size or mtime changed since they were cached, and dropped from the
+# cache if their contents no longer match (see _dropModifiedObjects).
+MATERIALIZE_MODES = ('copy', 'reflink', 'hardlink')
 
-        return r
-    return decorator
+# ioctl request number of FICLONE from linux/fs.h
+_FICLONE = 0x40049409
+
+_materializeMode = []
+
+# The mode of newly created files. Adopted files are temp files (only accessible by
+# the user), which are given this mode in the cache like copied ones have. The umask
+# can only be read by setting it, which is done here while nothing else runs yet.
+_umask = umask(0)
+umask(_umask)
+_FILE_MODE = 0666 & ~_umask
+
+def getMaterializeMode():
+    if not _materializeMode:
+        mode = getConfig('fit.cache.materialize', 'copy')
+        if mode not in MATERIALIZE_MODES:
+            print 'warning: Unknown fit.cache.materialize mode "%s", copying objects instead.'%mode
+            mode = 'copy'
+        _materializeMode.append(mode)
+    return _materializeMode[0]
+
+def _reflink(src, dst):
+    try:
+        from fcntl import ioctl
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return True
+    except (ImportError, IOError, OSError):
+        return False
+
+def _hardlink(src, dst):
+    try:
+        link(src, dst)
+    except (AttributeError, OSError):
+        return False
+    # only once, as changing the mode changes the ctime of every link
+    mode = osstat(src).st_mode
+    if mode & (S_IWUSR | S_IWGRP | S_IWOTH):
+        chmod(src, mode & ~(S_IWUSR | S_IWGRP | S_IWOTH))
+    return True
+
+def _objectStats(k):
+    st = osstat(objectPath(k))
+    return st.st_size, st.st_mtime
+
+# Removes the objects from the cache whose files were modified through a hard link
+# from the working tree, of the given found keys, and returns them
+def _dropModifiedObjects(keys, db):
+    recorded = db.select('objectStats', 'size, mtime', keys)
+    modified = []
+    for k in keys:
+        objPath = objectPath(k)
+        try:
+            st = osstat(objPath)
+        except OSError:
+            continue
+        if st.st_nlink < 2 or recorded.get(k) == (st.st_size, st.st_mtime) or compression.isFramed(objPath):
+            continue
+        if hashFile(objPath) == k:
+            db.execute('INSERT OR REPLACE INTO objectStats VALUES (?, ?, ?)', (k, st.st_size, st.st_mtime))
+        else:
+            modified.append(k)
+
+    for k in modified:
+        print 'warning: The cached object %s was modified in place through a hard link, and was removed from the cache.'%k
+        _dropObject(k, db)
+    return modified
+
+def _dropObject(k, db):
+    for table, total in (('lru', 'lruSize'), ('map', 'mapSize')):
+        row = db.execute('SELECT size FROM %s WHERE key = ?'%table, (k,)).fetchone()
+        if row:
+            db.execute('DELETE FROM %s WHERE key = ?'%table, (k,))
+            db.addTotal(total, -row[0])
+    db.execute('DELETE FROM chunks WHERE object = ?', (k,))
+    db.execute('DELETE FROM objectStats WHERE key = ?', (k,))
+    exists(objectPath(k)) and remove(objectPath(k))
 
-def _unpack(data):
-    l = data['lru']
-    m = data['map']
-    return l['size'], l['count'], l['items'], m['size'], m['items']
+# Makes dst a file with the contents of src, in the configured materialization mode
+def materialize(src, dst):
+    # Never write through an existing dst: it may be a hard link to a cached
+    # object (or be read-only because of that)
+    if lexists(dst):
+        remove(dst)
 
-def _pack(data, ls, lc, ms):
-    l = data['lru']
-    m = data['map']
-    l['size'], l['count'], m['size'] = ls, lc, ms
+    # Objects kept compressed in the cache can only be copied out
+    if compression.isFramed(src):
+        compression.decompressFile(src, dst)
+        return
 
+    mode = getMaterializeMode()
+    if mode == 'reflink' and _reflink(src, dst):
+        return
+    if mode == 'hardlink' and _hardlink(src, dst):
+        return
+    copyfile(src, dst)
+
+# Places the object file f at dst in the cache, compressed or not according to
+# fit.cache.compress. With adopt, f is moved there if possible (or else deleted), and
+# it may already be framed (see compression.py), e.g. when downloaded that way.
+def _cacheObject(f, dst, adopt):
+    framed = compression.isFramed(f)
+    if compression.isCacheCompressed() and not framed:
+        compression.compressFile(f, dst, *compression.getCodec())
+    elif framed and not adopt:
+        # a raw working-tree file that happens to start with the framing MAGIC
+        compression.compressFile(f, dst, 'none')
+    elif framed and not compression.isCacheCompressed():
+        compression.decompressFile(f, dst)
+        if compression.isFramed(dst):
+            # the same as above for a downloaded object
+            rename(f, dst)
+    elif adopt:
+        rename(f, dst)
+    elif osstat(f).st_nlink > 1:
+        # a file linked to another object (and edited through the link), which
+        # must not share its new contents with that one
+        copyfile(f, dst)
+    else:
+        materialize(f, dst)
+
+    if adopt:
+        chmod(dst, _FILE_MODE)
+        exists(f) and remove(f)
+
+# Adds the given {key: (size, filePath)} objects to the cache. With adopt, the files
+# are moved into the cache instead of being materialized from, and those of objects
+# that are already cached are deleted.
 @_cacheIO
-def insert(keys, inLru=False, progressMsg=None, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def insert(keys, inLru=False, progressMsg=None, adopt=False, db=None):
+    li = db.select('lru', 'size', keys)
+    mi = db.select('map', 'size', keys)
+    lc = db.total('lruCount')
 
     inserted = {}
     inOther = []
+    lruRows = []
     if inLru:
         for k,(s,f) in keys.iteritems():
             lc += 1
             if k in mi:
                 inOther.append(k)
-                del mi[k]
-                ms -= s
-                ls += s
+                db.execute('DELETE FROM map WHERE key = ?', (k,))
+                db.addTotal('mapSize', -s)
+                db.addTotal('lruSize', s)
             elif k not in li:
                 inserted[k] = f
-                ls += s
-            li[k] = (s,lc)
+                db.addTotal('lruSize', s)
+            lruRows.append((k, s, lc))
     else:
         for k,(s,f) in keys.iteritems():
             if k in li:
                 inOther.append(k)
                 lc += 1
-                li[k] = (s,lc)
+                lruRows.append((k, s, lc))
             elif k not in mi:
                 inserted[k] = f
-                mi[k] = (s, False)
-                ms += s
+                db.execute('INSERT INTO map VALUES (?, ?, 0)', (k, s))
+                db.addTotal('mapSize', s)
+
+    db.executemany('INSERT OR REPLACE INTO lru VALUES (?, ?, ?)', lruRows)
+    db.setTotal('lruCount', lc)
 
     n = len(inserted)
     for i,(k,f) in enumerate(inserted.iteritems()):
-        dstDir = '%s/%s'%(objectsDir, k[:2])
+        dstDir = '%s/%s'%(repo.objectsDir, k[:2])
         dst = '%s/%s'%(dstDir, k[2:])
         exists(dstDir) or makedirs(dstDir)
-        copyfile(f, dst)
+        _cacheObject(f, dst, adopt)
         if progressMsg:
             print '\r%s...%6.2f%%  %s/%s           '%(progressMsg,(i+1)*100./n, i+1, n),
             stdout.flush()
@@ -75,26 +317,28 @@ def insert(keys, inLru=False, progressMsg=None, data=None):
     if progressMsg and len(inserted) > 0:
         print
 
-    _pack(data, ls, lc, ms)
-    return True, (inserted, inOther, ls, ms)
+    if adopt:
+        for k,(s,f) in keys.iteritems():
+            if k not in inserted and exists(f):
+                remove(f)
 
-@_cacheIO
-def commit(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+    if getMaterializeMode() == 'hardlink':
+        db.executemany('INSERT OR REPLACE INTO objectStats VALUES (?, ?, ?)', ((k,) + _objectStats(k) for k in inserted))
 
-    commited = {}
-    for k in keys:
-        if k in mi and not mi[k][1]:
-            s = mi[k][0]
-            mi[k] = (s, True)
-            commited[k] = s
+    return inserted, inOther, db.total('lruSize'), db.total('mapSize')
 
-    _pack(data, ls, lc, ms)
-    return len(commited) > 0, commited
+@_cacheIO
+def commit(keys, db=None):
+    commited = {k: s for k,(s,c) in db.select('map', 'size, committed', keys).iteritems() if not c}
+    db.executemany('UPDATE map SET committed = 1 WHERE key = ?', ((k,) for k in commited))
+    return commited
 
 @_cacheIO
-def enque(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def enque(keys, db=None):
+    keys = list(keys)
+    li = db.select('lru', 'size', keys)
+    mi = db.select('map', 'size, committed', keys)
+    lc = db.total('lruCount')
 
     enqued = {}
     fromMap = {}
@@ -106,80 +350,107 @@ def enque(keys, data=None):
             val = mi.pop(k)
             fromMap[k] = val
             val = val[0]
-            ms -= val
-            ls += val
+            db.execute('DELETE FROM map WHERE key = ?', (k,))
+            db.addTotal('mapSize', -val)
+            db.addTotal('lruSize', val)
 
         if val:
             enqued[k] = val
             lc += 1
-            li[k] = (val, lc)
+            db.execute('INSERT OR REPLACE INTO lru VALUES (?, ?, ?)', (k, val, lc))
 
-    _pack(data, ls, lc, ms)
-    return len(enqued) > 0, (enqued, fromMap)
+    db.setTotal('lruCount', lc)
+    return enqued, fromMap
 
+# Returns a {key: objectPath} map of the given keys that are in the cache. With
+# update, the objects are about to be used: they count as used for the lru, and in
+# hardlink mode, those modified through a link are dropped from the cache.
 @_cacheIO
-def find(keys, inMap=False, update=True, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def find(keys, inMap=False, update=True, db=None):
+    keys = list(keys)
+    mi = db.select('map', 'size', keys)
     if inMap:
-        return False, {k:'%s/%s/%s'%(objectsDir, k[:2], k[2:]) for k in keys if k in mi}
+        return {k:objectPath(k) for k in keys if k in mi}
+
+    li = db.select('lru', 'size', keys)
+    lc = db.total('lruCount')
 
-    inLru = False
     found = {}
+    touched = []
     for k in keys:
         if k in li:
-            inLru = True
             lc += 1
-            val = li[k][0]
-            li[k] = (val, lc)
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
+            touched.append((lc, k))
+            found[k] = objectPath(k)
         elif k in mi:
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
+            found[k] = objectPath(k)
+
+    if update and touched:
+        db.executemany('UPDATE lru SET counter = ? WHERE key = ?', touched)
+        db.setTotal('lruCount', lc)
+
+    if update and getMaterializeMode() == 'hardlink':
+        for k in _dropModifiedObjects(found, db):
+            del found[k]
 
-    _pack(data, ls, lc, ms)
-    return inLru and update, found
+    return found
 
 @_cacheIO
-def delete(keys, commits=False, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def delete(keys, commits=False, db=None):
     deleted = {}
-    for k in keys:
-        if k in mi:
-            s,c = mi.pop(k)
-            if commits == c:
-                deleted[k] = s
-                ms -= s
-                remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
+    for k,(s,c) in db.select('map', 'size, committed', keys).iteritems():
+        if commits == bool(c):
+            deleted[k] = s
+            db.execute('DELETE FROM map WHERE key = ?', (k,))
+            db.execute('DELETE FROM chunks WHERE object = ?', (k,))
+            db.execute('DELETE FROM objectStats WHERE key = ?', (k,))
+            db.addTotal('mapSize', -s)
+            remove(objectPath(k))
 
-    _pack(data, ls, lc, ms)
-    return len(deleted) > 0, (deleted, ls, ms)
+    return deleted, db.total('lruSize'), db.total('mapSize')
 
 @_cacheIO
-def prune(size, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-    
-    i = 0
-    items = sorted(li.iteritems(), key=lambda (i,(j,k)): k)
-    while ls > size and i < len(items):
-        k, (s, c) = items[i]
-        remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
-        ls -= s
-        i += 1
-
-    for k,(s,c) in items[:i]:
-        del li[k]
-
-    lc = 0
-    for k,(s,c) in items[i:]:
-        lc += 1
-        li[k] = (s,lc)
-
-    _pack(data, ls, lc, ms)
-    return True,ls
+def prune(size, db=None):
+    ls = db.total('lruSize')
+
+    # Walk the counter index from the least recently used object on, only as far
+    # as needed to get the cache down to the given size
+    evicted = []
+    if ls > size:
+        for k, s in db.execute('SELECT key, size FROM lru ORDER BY counter'):
+            if ls <= size:
+                break
+            remove(objectPath(k))
+            ls -= s
+            evicted.append((k,))
+
+    db.executemany('DELETE FROM lru WHERE key = ?', evicted)
+    db.executemany('DELETE FROM chunks WHERE object = ?', evicted)
+    db.executemany('DELETE FROM objectStats WHERE key = ?', evicted)
+    db.setTotal('lruSize', ls)
+    return ls
 
 @_cacheIO
-def size(data=None):
-    return False, (data['lru']['size'], data['map']['size'])
+def size(db=None):
+    return db.total('lruSize'), db.total('mapSize')
 
 @_cacheIO
-def getCommittedObjects(data=None):
-    return False, {h for h,(s,c) in data['map']['items'].iteritems() if c}
+def getCommittedObjects(db=None):
+    return {k for (k,) in db.execute('SELECT key FROM map WHERE committed = 1')}
+
+# Records where the given [(chunkHash, offset, length)] chunks are in a cached object
+@_cacheIO
+def addChunks(key, chunks, db=None):
+    db.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)', ((c, key, o, l) for c,o,l in chunks))
+
+# Returns a {chunkHash: (objectPath, offset, length)} map of the given chunks that
+# can be found in cached objects
+@_cacheIO
+def findChunks(chunkHashes, db=None):
+    chunkHashes = list(chunkHashes)
+    found = {}
+    for i in range(0, len(chunkHashes), _QUERY_CHUNK):
+        chunk = chunkHashes[i:i+_QUERY_CHUNK]
+        query = 'SELECT chunk, object, offset, length FROM chunks WHERE chunk IN (%s)'%','.join('?'*len(chunk))
+        found.update((c, (objectPath(k), o, l)) for c,k,o,l in db.execute(query, chunk))
+    return found
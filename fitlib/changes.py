@@ -1,15 +1,14 @@
 
-from . import fitFile, gitDirOperation, repoDir, savesDir, workingDir
-from . import updateStats, refreshStats, addedStatFile, writeFitFile, readFitFile
+from . import gitDirOperation, workingDir, repo
+from . import updateStats, refreshStats, writeFitFile, readFitFile
 from . import filterBinaryFiles, getStagedFitFileHash, getFitFileStatus
+from . import getManifestFormat, isFitFileConversionNeeded
 from objects import getUpstreamItems, getDownstreamItems
-from paths import getValidFitPaths
-import merge, cache
+from paths import getValidFitPaths, getPathIndex
+import attributes, merge, cache, scan
 from subprocess import Popen as popen, PIPE
 from os.path import exists, dirname, join as joinpath
 from os import remove, makedirs, stat, listdir, mkdir
-from shutil import copyfile
-import re
 from sys import stdout
 
 restoreMissingMessage = '''
@@ -52,8 +51,7 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
 
     trackedItems = getTrackedItems()
     fitItems = set(fitTrackedData)
-    allItems = fitItems | trackedItems
-    paths = None if not pathArgs else getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir)
+    paths = None if not pathArgs else getValidFitPaths(pathArgs, getPathIndex(fitTrackedData), basePath=repo.repoDir, workingDir=workingDir, extra=trackedItems)
 
     modifiedItems, addedItems, removedItems, untrackedItems, unchangedItems, stats, stubs = getChangedItems(fitTrackedData, trackedItems=trackedItems, paths=paths)
 
@@ -66,7 +64,7 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
     untrackedItems = untrackedItems - offenders
     unchangedItems = unchangedItems - offenders
 
-    downstream = getDownstreamItems(fitTrackedData, fitItems if paths == None else paths, stats)
+    downstream = getDownstreamItems(fitTrackedData, fitItems if paths == None else paths & fitItems, stats)
     upstream = getUpstreamItems()
 
     modified,added,removed,untracked,unchanged = [],[],[],[],[]
@@ -117,7 +115,7 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
 
     print
 
-    if dirtyFit and exists(fitFile):
+    if dirtyFit and exists(repo.fitFile):
         print 'The .fit file contains changes that have not yet been staged for commit.'
         if noChanges:
             print 'If you want to include these changes in a commit, you should run "git-fit save"'
@@ -141,16 +139,13 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
         print '   them with their actual contents.'
 
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getTrackedItems():
     # The tracked items in the working tree according to the
     # currently set fit attributes
-    fitSetRgx = re.compile('(.*): fit: set')
-    p = popen('git ls-files -o'.split(), stdout=PIPE)
-    p = popen('git check-attr --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
-    return {m.group(1) for m in [fitSetRgx.match(l) for l in p.stdout] if m}
+    return attributes.filterFitPaths(scan.listCandidates())
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None):
 
     # The tracked items according to the saved/committed .fit file
@@ -159,7 +154,7 @@ def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None
 
     # Get valid, fit-friendly repo paths from given arbitrary path arguments
     if paths == None and pathArgs:
-        paths = getValidFitPaths(pathArgs, expectedItems | trackedItems, basePath=repoDir, workingDir=workingDir)
+        paths = getValidFitPaths(pathArgs, getPathIndex(fitTrackedData), basePath=repo.repoDir, workingDir=workingDir, extra=trackedItems)
 
     if paths != None:
         if len(paths) == 0:
@@ -188,7 +183,7 @@ def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None
 
     return modifiedItems, newItems, removedItems, untrackedItems, unchangedItems, stats, stubs
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def getStagedOffenders():
     fitConflict = []
     binaryFiles = []
@@ -208,7 +203,7 @@ def getStagedOffenders():
 
     return set(fitConflict), set(binaryFiles)
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def checkForChanges(fitTrackedData, paths=None, pathArgs=None):
     changes = getChangedItems(fitTrackedData, paths=paths, pathArgs=pathArgs)[:-3]
     if not any(changes):
@@ -216,7 +211,7 @@ def checkForChanges(fitTrackedData, paths=None, pathArgs=None):
     
     return changes
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def restore(fitTrackedData, quiet=False, pathArgs=None):
     changes = checkForChanges(fitTrackedData, pathArgs=pathArgs)
     if not changes:
@@ -229,7 +224,7 @@ def restore(fitTrackedData, quiet=False, pathArgs=None):
     if missing > 0:
         print restoreMissingMessage%missing
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def restoreItems(fitTrackedData, modified, added, removed, quiet=False):
     for i in sorted(added):
         remove(i)
@@ -261,18 +256,21 @@ def _restoreFromCache(restoreType, objects, fitTrackedData, quiet=False):
         if objHash in cached:
             if not quiet:
                 print '%s: %s'%(restoreType, filePath)
-            copyfile(cached[objHash], filePath)
+            cache.materialize(cached[objHash], filePath)
             touched[filePath] = objHash
         else:
             if not quiet:
                 print '%s (empty): %s'%(restoreType, filePath)
-            open(filePath, 'w').close()  #write a 0-byte file as placeholder
+            # write a 0-byte file as placeholder (replacing, rather than truncating,
+            # any existing file since it may be hard-linked to a cached object)
+            exists(filePath) and remove(filePath)
+            open(filePath, 'w').close()
             touched[filePath] = 0
             missing += 1
 
     return (touched, missing)
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=False):
     added,removed,stubs = saveItems(fitTrackedData, paths=paths, pathArgs=pathArgs, quiet=quiet)
 
@@ -286,6 +284,9 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
     if len(added) + len(removed) > 0 or forceWrite:
         print 'Working-tree changes saved.'
         writeFitFile(fitTrackedData)
+    elif isFitFileConversionNeeded():
+        print 'Converted .fit file to the %s format.'%getManifestFormat()
+        writeFitFile(fitTrackedData)
 
     fitFileStatus = getFitFileStatus()
     if len(fitFileStatus) == 0 or fitFileStatus[1] == ' ':
@@ -295,7 +296,7 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
     newStagedFitFileHash = None
     if fitFileStatus[0] == 'A':
         oldStagedFitFileHash = getStagedFitFileHash()
-    popen('git add -f'.split()+[fitFile]).wait()
+    popen('git add -f'.split()+[repo.fitFile]).wait()
     newStagedFitFileHash = getStagedFitFileHash()
     print 'Staged .fit file.'
 
@@ -304,7 +305,7 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
 
     return True
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
     changes = checkForChanges(fitTrackedData, paths=paths, pathArgs=pathArgs)
     if not changes:
@@ -314,7 +315,7 @@ def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
     
     modified, added, removed, untracked = changes
 
-    stats, stubs = updateStats(added, filePath=addedStatFile)
+    stats, stubs = updateStats(added, filePath=repo.addedStatFile)
     modified.update((i,[h,s[0]]) for i,(h,s) in stats.iteritems())
     removed |= untracked
 
@@ -328,8 +329,8 @@ def _saveToCache(newItems, fitTrackedData, fitFileHash):
     toAdd = dict(newItems)
     toRemove = set()
 
-    for l in listdir(savesDir):
-        savesFile = joinpath(savesDir, l)
+    for l in listdir(repo.savesDir):
+        savesFile = joinpath(repo.savesDir, l)
         oldSaveItems = readFitFile(savesFile)
         for i,f in oldSaveItems.iteritems():
             if fitTrackedData.get(i) == f:
@@ -338,6 +339,6 @@ def _saveToCache(newItems, fitTrackedData, fitFileHash):
                 toRemove.add(f[0])
         remove(savesFile)
 
-    writeFitFile(toAdd, joinpath(savesDir,fitFileHash))
+    writeFitFile(toAdd, joinpath(repo.savesDir,fitFileHash))
     cache.delete(toRemove - {toAdd[i][0] for i in toAdd})
     cache.insert({h:(s,f) for f,(h,s) in newItems.iteritems()}, progressMsg='Caching new and modified items')
@@ -0,0 +1,256 @@
+from . import getConfigInt
+from hashes import BlobWriter
+from hashlib import sha1
+from os import remove
+from os.path import exists
+from struct import Struct
+from zlib import crc32
+import cache, compression
+import re
+
+# Large objects may be put to the data store in chunks, so that objects that only
+# differ in parts share most of their chunks and only the chunks that the store
+# (or, on get, the local cache) lacks need to be transferred.
+#
+# Chunk boundaries are content-defined: a chunk ends after an anchor byte whose
+# CRC-32 together with the 31 bytes before it has its low bits all zero. An
+# insertion or deletion therefore only changes the chunks around it, and the
+# chunks after it keep their boundaries. Chunks are between a quarter and four
+# times fit.chunking.chunkSize long. Anchors are found with bytearray.find(), so
+# the contents are scanned in C, and only about one position in 256 is hashed.
+#
+# A chunked object is stored under its usual key as a manifest, which is framed
+# like a compressed object (see compression.py) with the "chunked" codec and lists
+# the SHA-1 and length of every chunk in order. The chunks themselves are stored
+# (and possibly compressed) like objects under chunks/<xx>/<yyy...> keys. The
+# object's hash is still the hash of its whole contents, so nothing but the
+# transfers needs to know about chunking.
+
+DEFAULT_CHUNK_SIZE = 1048576
+
+_count = Struct('>I')
+_entry = Struct('>20sI')
+
+# Chunks are checked and transferred in groups of about this many bytes, so that
+# only that much of an object is held in memory or in temp files at a time
+_GROUP_SIZE = 67108864
+
+# The anchor byte and the window hashed at anchors must never change, or the chunk
+# boundaries (and with them the chunk dedup) would change along with them
+_ANCHOR = '\x9d'
+_ANCHOR_BITS = 8
+_WINDOW = 32
+_ANCHOR_RUN = _ANCHOR*_WINDOW
+_NOT_ANCHOR = re.compile('[^%s]'%re.escape(_ANCHOR))
+
+_settings = {}
+
+# Objects at least this large are put in chunks, from fit.chunking.minSize (0,
+# the default, disables chunking)
+def getMinSize():
+    if 'minSize' not in _settings:
+        _settings['minSize'] = getConfigInt('fit.chunking.minSize', 0)
+    return _settings['minSize']
+
+def getChunkSize():
+    if 'chunkSize' not in _settings:
+        _settings['chunkSize'] = max(4096, getConfigInt('fit.chunking.chunkSize', DEFAULT_CHUNK_SIZE))
+    return _settings['chunkSize']
+
+def shouldChunk(size):
+    return getMinSize() > 0 and size >= getMinSize()
+
+def chunkKey(chunkHash):
+    return 'chunks/%s/%s'%(chunkHash[:2], chunkHash[2:])
+
+# Returns the length of the first chunk of data (a bytearray)
+def _findBoundary(data, minSize, maxSize, mask):
+    end = min(len(data), maxSize)
+    if end <= minSize:
+        return end
+
+    find = data.find
+    i = find(_ANCHOR, minSize - 1, end)
+    while i >= 0:
+        if not crc32(buffer(data, i + 1 - _WINDOW, _WINDOW)) & mask:
+            return i + 1
+        # windows within a run of anchors are all the same, so none of the run
+        # is a boundary either
+        if data[i - 1] == data[i] and data[i + 1 - _WINDOW:i + 1] == _ANCHOR_RUN:
+            m = _NOT_ANCHOR.search(data, i, end)
+            i = m.start() if m else end
+        i = find(_ANCHOR, i + 1, end)
+    return end
+
+# Splits the contents given as a sequence of blocks into content-defined chunks.
+# The chunks do not depend on how the contents are split into blocks.
+def iterChunks(blocks, chunkSize):
+    minSize, maxSize = chunkSize/4, chunkSize*4
+    # one anchor in 2**_ANCHOR_BITS positions is hashed, so that many fewer bits
+    # need to be zero for chunks of about chunkSize
+    mask = (1 << max(0, chunkSize.bit_length() - 1 - _ANCHOR_BITS)) - 1
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+        while len(buf) >= maxSize:
+            n = _findBoundary(buf, minSize, maxSize, mask)
+            yield str(buf[:n])
+            del buf[:n]
+    while buf:
+        n = _findBoundary(buf, minSize, maxSize, mask)
+        yield str(buf[:n])
+        del buf[:n]
+
+def writeManifest(filePath, size, chunks):
+    with open(filePath, 'wb') as f:
+        f.write(compression.frameHeader(compression.CHUNKED, size))
+        f.write(_count.pack(len(chunks)))
+        for h,o,l in chunks:
+            f.write(_entry.pack(h.decode('hex'), l))
+
+# Returns the [(chunkHash, offset, length)] chunks listed in a manifest
+def readManifest(filePath):
+    with open(filePath, 'rb') as f:
+        f.seek(compression.HEADER_SIZE)
+        count, = _count.unpack(f.read(_count.size))
+        data = f.read(count*_entry.size)
+    if len(data) != count*_entry.size:
+        raise IOError('Chunk manifest is truncated.')
+
+    chunks = []
+    offset = 0
+    for n in xrange(count):
+        h, l = _entry.unpack_from(data, n*_entry.size)
+        chunks.append((h.encode('hex'), offset, l))
+        offset += l
+    return chunks
+
+def _readChunk(filePath, offset, length):
+    with open(filePath, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+# Puts the cached object in chunks, uploading only the chunks that the store does
+# not have yet, as they are found in a single pass over the object. uploadSource
+# and newTempFile are those of the transfer code.
+def putChunked(store, cachedPath, objKey, objHash, size, uploadSource, newTempFile):
+    chunks = []
+    seen = set()
+    group = []
+
+    def putGroup():
+        existing = store.checkMany([chunkKey(h) for h,data in group])
+        missing = [(h, data) for h,data in group if chunkKey(h) not in existing]
+        del group[:]
+        files = []
+        sources = []
+        try:
+            for h,data in missing:
+                files.append(newTempFile())
+                with open(files[-1], 'wb') as f:
+                    f.write(data)
+                sources.append(uploadSource(files[-1]))
+            return all(store.putMany([(src, chunkKey(h), len(data)) for (h,data),src in zip(missing, sources)]))
+        finally:
+            for f, src in map(None, files, sources):
+                exists(f) and remove(f)
+                src and src != f and exists(src) and remove(src)
+
+    offset = 0
+    groupSize = 0
+    for data in iterChunks(compression.iterRawBlocks(cachedPath), getChunkSize()):
+        h = sha1(data).hexdigest()
+        chunks.append((h, offset, len(data)))
+        offset += len(data)
+        if h in seen:
+            continue
+        seen.add(h)
+        group.append((h, data))
+        groupSize += len(data)
+        if groupSize >= _GROUP_SIZE:
+            groupSize = 0
+            if not putGroup():
+                return False
+    if group and not putGroup():
+        return False
+
+    if not compression.isFramed(cachedPath):
+        cache.addChunks(objHash, chunks)
+
+    manifest = newTempFile()
+    try:
+        writeManifest(manifest, size, chunks)
+        return all(store.putMany([(manifest, objKey, size)]))
+    finally:
+        remove(manifest)
+
+# Assembles the object of the downloaded manifest into outPath, taking the chunks
+# from cached objects where possible and from the store otherwise. Returns whether
+# the assembled contents match objHash.
+def getChunked(store, manifestPath, objHash, size, outPath, newTempFile):
+    chunks = readManifest(manifestPath)
+    local = cache.findChunks(set(h for h,o,l in chunks))
+
+    # Cached chunks are only used if their contents (still) check out
+    localData = {}
+    for h,(objPath,o,l) in local.iteritems():
+        if exists(objPath):
+            data = _readChunk(objPath, o, l)
+            if sha1(data).hexdigest() == h:
+                localData[h] = objPath, o, l
+
+    # The chunks to download, in the order they are first needed
+    needed = []
+    sizes = {}
+    for h,o,l in chunks:
+        if h not in localData and h not in sizes:
+            needed.append(h)
+            sizes[h] = l
+    keys = store.checkMany([chunkKey(h) for h in needed]) if needed else {}
+    if len(keys) < len(needed):
+        return False
+    pending = needed[::-1]
+
+    # Downloads the next group of needed chunks, and returns whether they check out
+    def getGroup():
+        group = []
+        groupSize = 0
+        while pending and groupSize < _GROUP_SIZE:
+            group.append(pending.pop())
+            groupSize += sizes[group[-1]]
+        writers = [BlobWriter(newTempFile(), decoder=compression.Decoder()) for h in group]
+        transferred = store.getMany([(keys[chunkKey(h)], w, sizes[h]) for h,w in zip(group, writers)])
+        for h, w, ok in zip(group, writers, transferred):
+            w.close()
+            downloaded[h] = w.name
+        return all(ok and w.hexdigest() == h for h,w,ok in zip(group, writers, transferred))
+
+    # The chunks are written out in order as they are downloaded, a group at a time.
+    # Chunks that occur again are read back from where they were written.
+    downloaded = {}
+    written = {}
+    out = BlobWriter(outPath, size)
+    try:
+        for h,o,l in chunks:
+            if h in localData:
+                out.write(_readChunk(*localData[h]))
+            elif h in written:
+                out.flush()
+                out.write(_readChunk(outPath, *written[h]))
+            else:
+                if h not in downloaded and not getGroup():
+                    return False
+                for data in compression.iterRawBlocks(downloaded[h]):
+                    out.write(data)
+                remove(downloaded.pop(h))
+            written.setdefault(h, (o, l))
+    finally:
+        out.close()
+        for f in downloaded.itervalues():
+            exists(f) and remove(f)
+    if out.hexdigest() != objHash:
+        return False
+
+    if not compression.isCacheCompressed():
+        cache.addChunks(objHash, chunks)
+    return True
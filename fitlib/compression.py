@@ -0,0 +1,169 @@
+from . import getConfig, getConfigInt, getConfigBool
+from struct import Struct
+
+# Objects may be kept compressed, both in the data store and in the local cache.
+# A compressed object is "framed": it starts with a header made of the MAGIC bytes,
+# the id of the codec, and the size of the uncompressed contents, which is followed
+# by the compressed contents. Any object that does not start with MAGIC is raw, so
+# framed and raw objects can live side by side under the same keys. The rare raw
+# object that does start with MAGIC is framed with the "none" codec, which keeps
+# its contents as they are.
+
+MAGIC = '\x89FIT\r\n\x1a\n'
+_header = Struct('>%dsBQ'%len(MAGIC))
+HEADER_SIZE = _header.size
+
+_CHUNK_SIZE = 1048576
+
+class _Identity:
+    def compress(self, data):
+        return data
+    def decompress(self, data):
+        return data
+    def flush(self):
+        return ''
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma
+
+def _zstd():
+    import zstandard
+    return zstandard
+
+# name --> (id, default level, compressor factory, decompressor factory)
+_CODECS = {
+    'none': (0, 0, lambda level: _Identity(), lambda: _Identity()),
+    'zlib': (1, 6, lambda level: __import__('zlib').compressobj(level), lambda: __import__('zlib').decompressobj()),
+    'bz2':  (2, 9, lambda level: __import__('bz2').BZ2Compressor(level), lambda: __import__('bz2').BZ2Decompressor()),
+    'lzma': (3, 6, lambda level: _lzma().LZMACompressor(preset=level), lambda: _lzma().LZMADecompressor()),
+    'zstd': (4, 3, lambda level: _zstd().ZstdCompressor(level=level).compressobj(), lambda: _zstd().ZstdDecompressor().decompressobj()),
+}
+_codecNames = {v[0]: k for k,v in _CODECS.iteritems()}
+
+# Framed objects with this codec are not compressed contents but manifests of
+# chunked objects (see chunking.py), which are never decoded here
+CHUNKED = 'chunked'
+_CHUNKED_ID = 15
+_codecNames[_CHUNKED_ID] = CHUNKED
+
+def isAvailable(codec):
+    if codec not in _CODECS:
+        return False
+    try:
+        _CODECS[codec][3]()
+        return True
+    except ImportError:
+        return False
+
+def defaultLevel(codec):
+    return _CODECS[codec][1]
+
+def _flush(codecObj):
+    flush = getattr(codecObj, 'flush', None)
+    return flush() if flush else ''
+
+_settings = {}
+
+# The (codec, level) objects are compressed with when putting them to the data
+# store, from fit.compression.codec and fit.compression.level
+def getCodec():
+    if 'codec' not in _settings:
+        codec = getConfig('fit.compression.codec', 'none')
+        if not isAvailable(codec):
+            print 'warning: Compression codec "%s" is not available, objects will not be compressed.'%codec
+            codec = 'none'
+        _settings['codec'] = (codec, getConfigInt('fit.compression.level', defaultLevel(codec)))
+    return _settings['codec']
+
+# Whether the local cache keeps objects compressed (fit.cache.compress)
+def isCacheCompressed():
+    if 'cache' not in _settings:
+        _settings['cache'] = getConfigBool('fit.cache.compress') and getCodec()[0] != 'none'
+    return _settings['cache']
+
+def isFramed(filePath):
+    with open(filePath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+# Decodes a stream of object bytes fed to it in arbitrary pieces, which may be
+# either framed or raw
+class Decoder:
+    def __init__(self):
+        self.pending = ''
+        self.framed = None
+        self.codec = None
+        self.decompressor = None
+
+    def feed(self, data):
+        if self.framed is None:
+            self.pending += data
+            if len(self.pending) < len(MAGIC) and MAGIC.startswith(self.pending):
+                return ''
+            if not self.pending.startswith(MAGIC):
+                self.framed = False
+                data, self.pending = self.pending, ''
+                return data
+            if len(self.pending) < HEADER_SIZE:
+                return ''
+            magic, codecId, size = _header.unpack_from(self.pending)
+            if codecId not in _codecNames:
+                raise IOError('Object is compressed with an unknown codec (%d).'%codecId)
+            self.framed = True
+            self.codec = _codecNames[codecId]
+            self.decompressor = _Identity() if self.codec == CHUNKED else _CODECS[self.codec][3]()
+            data, self.pending = self.pending[HEADER_SIZE:], ''
+
+        return self.decompressor.decompress(data) if self.framed else data
+
+    def flush(self):
+        if self.framed is None:
+            # a raw object shorter than MAGIC
+            self.framed = False
+            data, self.pending = self.pending, ''
+            return data
+        return _flush(self.decompressor) if self.framed else ''
+
+def _readChunks(f):
+    return iter(lambda: f.read(_CHUNK_SIZE), '')
+
+def frameHeader(codec, size):
+    return _header.pack(MAGIC, _CHUNKED_ID if codec == CHUNKED else _CODECS[codec][0], size)
+
+# Yields the raw contents of the (framed or raw) object file in blocks
+def iterRawBlocks(filePath):
+    decoder = Decoder()
+    with open(filePath, 'rb') as f:
+        for chunk in _readChunks(f):
+            data = decoder.feed(chunk)
+            if data:
+                yield data
+    data = decoder.flush()
+    if data:
+        yield data
+
+# Writes the raw contents of the (framed or raw) object file src into dst
+def decompressFile(src, dst):
+    decoder = Decoder()
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            for chunk in _readChunks(fin):
+                fout.write(decoder.feed(chunk))
+            fout.write(decoder.flush())
+
+# Writes the raw file src into dst framed with the given codec
+def compressFile(src, dst, codec, level=None):
+    codecId, codecLevel, compressor, decompressor = _CODECS[codec]
+    compressor = compressor(codecLevel if level == None else level)
+    with open(src, 'rb') as fin:
+        fin.seek(0, 2)
+        size = fin.tell()
+        fin.seek(0)
+        with open(dst, 'wb') as fout:
+            fout.write(frameHeader(codec, size))
+            for chunk in _readChunks(fin):
+                fout.write(compressor.compress(chunk))
+            fout.write(_flush(compressor))
@@ -0,0 +1,99 @@
+from . import getConfig, getConfigInt
+from subprocess import Popen as popen, PIPE
+from os import path, devnull
+from pipes import quote
+from time import time
+
+# Support for git's core.fsmonitor hook protocol, which lets updateStats skip
+# stat()ing the items that a file system monitor (e.g. watchman, through the hook
+# that git ships as fsmonitor-watchman.sample) has not seen change.
+#
+# The hook is run as "<hook> <version> <token>" and prints the paths that changed
+# since the token, separated by NUL bytes:
+#   version 2:  the token is opaque, and the hook prints a new token first
+#   version 1:  the token is a time in nanoseconds since the epoch
+# A path of "/" means that everything must be assumed to have changed.
+#
+# The token of the last query is kept in a file next to the stat index, prefixed
+# with the protocol version. Without a valid token, every item is stat()ed.
+
+# The hook configured by fit.fsmonitor, or else core.fsmonitor. Boolean values
+# select git's built-in monitor daemon, which is only reachable from within git.
+def getHook():
+    hook = getConfig('fit.fsmonitor') or getConfig('core.fsmonitor')
+    if not hook or hook.lower() in ('true', 'false', 'yes', 'no', 'on', 'off', '1', '0'):
+        return None
+    return hook
+
+def _tokenFile(statFile):
+    return statFile + '.token'
+
+def _readToken(statFile):
+    tokenFile = _tokenFile(statFile)
+    if not path.exists(tokenFile):
+        return None, None
+    version, _, token = open(tokenFile, 'rb').read().partition(':')
+    return version, token
+
+def saveToken(statFile, token):
+    with open(_tokenFile(statFile), 'wb') as f:
+        f.write(token)
+
+def _runHook(hook, version, token):
+    p = popen('%s %d %s'%(hook, version, quote(token)), shell=True, stdout=PIPE, stderr=open(devnull, 'wb'))
+    output = p.communicate()[0]
+    return output if p.returncode == 0 else None
+
+# The paths reported as changed. Directories may be reported instead of the files
+# in them, so an item counts as changed if it or any directory above it is in here.
+class ChangedPaths:
+    def __init__(self, paths):
+        self.paths = set(p.rstrip('/') for p in paths)
+
+    def __contains__(self, item):
+        if item in self.paths:
+            return True
+        while '/' in item:
+            item = item.rsplit('/', 1)[0]
+            if item in self.paths:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.paths)
+
+# Asks the hook what changed since the token saved for the stat index. Returns a
+# (token, changed) pair, where token (prefixed with the protocol version) should be
+# saved with saveToken() once the stat index is up to date, and changed is a
+# ChangedPaths, or None if every item needs to be stat()ed. Without a hook, the
+# token is None too.
+def query(statFile):
+    hook = getHook()
+    if not hook:
+        return None, None
+
+    lastVersion, lastToken = _readToken(statFile)
+    version = getConfigInt('core.fsmonitorHookVersion', 0)
+    for v in ((version,) if version in (1, 2) else (2, 1)):
+        usable = lastVersion == str(v) and lastToken
+        if v == 2:
+            output = _runHook(hook, 2, lastToken if usable else '')
+            if output is None:
+                continue
+            token, _, output = output.partition('\0')
+            if not token:
+                continue
+        else:
+            # the time of the query must be taken before the hook runs
+            token = '%d'%(time()*1e+9)
+            output = _runHook(hook, 1, lastToken if usable else '0')
+            if output is None:
+                continue
+
+        paths = [p for p in output.split('\0') if p]
+        token = '%d:%s'%(v, token)
+        if not usable or '/' in paths:
+            return token, None
+        return token, ChangedPaths(paths)
+
+    return None, None
@@ -0,0 +1,125 @@
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+from os import fstat
+
+# Files at least this large are hashed straight from a read-only memory map
+# instead of through buffered reads
+MMAP_MIN_SIZE = 1048576
+_READ_SIZE = 1048576
+
+# Longest time to wait for a single hash from the pool. Waiting with a timeout
+# (instead of indefinitely) keeps KeyboardInterrupt working in Python 2.
+_POOL_WAIT = 1e+6
+
+def blobHeader(size):
+    return 'blob %d\0'%size
+
+# Computes the same SHA-1 that git assigns to the file's contents as a blob,
+# i.e. the digest of "blob <size>\0" followed by the contents.
+def hashFile(filePath):
+    with open(filePath, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+        digest = sha1(blobHeader(size))
+        if size >= MMAP_MIN_SIZE:
+            m = mmap(f.fileno(), 0, access=ACCESS_READ)
+            try:
+                digest.update(m)
+            finally:
+                m.close()
+        elif size > 0:
+            for chunk in iter(lambda: f.read(_READ_SIZE), ''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# Yields the blob hash of each of the given files, in order. The files are
+# hashed by a pool of the given number of processes, or in this process if
+# that is not worth it or a pool cannot be started.
+def iterHashes(items, jobs):
+    pool = None
+    if jobs > 1 and len(items) > 1:
+        try:
+            from multiprocessing import Pool
+            pool = Pool(min(jobs, len(items)))
+        except Exception:
+            pool = None
+
+    if not pool:
+        for i in items:
+            yield hashFile(i)
+        return
+
+    try:
+        results = pool.imap(hashFile, items, chunksize=max(1, min(64, len(items)/(jobs*8))))
+        for i in xrange(len(items)):
+            yield results.next(_POOL_WAIT)
+    finally:
+        pool.terminate()
+        pool.join()
+
+# A write-only file object that computes the blob hash of everything written to
+# it, or, given a decoder, of what the decoder makes of it. Stores that cannot write
+# into a file object may instead write the file at .name by themselves, in which
+# case the hash is computed from what ends up there. Without a size, the plain
+# SHA-1 of the contents is computed instead of their blob hash.
+#
+# Given an offset, the file already holds that many bytes of the contents, and
+# writing continues after them; anything beyond the offset is discarded.
+class BlobWriter:
+    def __init__(self, filePath, size=None, decoder=None, offset=0):
+        self.name = filePath
+        self.file = None
+        self.header = blobHeader(size) if size != None else ''
+        self.decoder = decoder
+        self.digest = sha1(self.header)
+        self.offset = offset
+        self.position = offset
+        with open(filePath, 'r+b' if offset else 'wb') as f:
+            f.truncate(offset)
+
+    def _update(self, data):
+        self.digest.update(self.decoder.feed(data) if self.decoder else data)
+
+    def _open(self):
+        self.file = open(self.name, 'r+b')
+        remaining = self.offset
+        while remaining > 0:
+            data = self.file.read(min(remaining, _READ_SIZE))
+            self._update(data)
+            remaining -= len(data)
+        self.file.seek(self.offset)
+
+    def write(self, data):
+        if not self.file:
+            self._open()
+        self.file.write(data)
+        self._update(data)
+        self.position += len(data)
+
+    # The offset in the contents where the next write goes
+    def tell(self):
+        return self.position
+
+    # Discards everything written so far, for stores that cannot continue at the
+    # offset after all
+    def restart(self):
+        self.close()
+        self.file = None
+        self.digest = sha1(self.header)
+        self.decoder = self.decoder and self.decoder.__class__()
+        self.offset = self.position = 0
+        open(self.name, 'wb').close()
+
+    def flush(self):
+        self.file and self.file.flush()
+
+    def close(self):
+        self.file and self.file.close()
+
+    def hexdigest(self):
+        if not self.file:
+            with open(self.name, 'rb') as f:
+                for chunk in iter(lambda: f.read(_READ_SIZE), ''):
+                    self._update(chunk)
+        if self.decoder:
+            self.digest.update(self.decoder.flush())
+        return self.digest.hexdigest()
@@ -0,0 +1,78 @@
+from binascii import hexlify, unhexlify
+from itertools import izip, imap
+import gc
+from struct import Struct
+
+# Binary encoding of the .fit manifest, as an alternative to the text format:
+#
+#   header:  signature "FITM", version (8-bit), item count (32-bit)
+#   blocks:  item count and size of the path table (both 32-bit), then for each
+#            item of the block its 20-byte binary hash, then the sizes (64-bit),
+#            then the item paths separated by NUL bytes
+#
+# All integers are big-endian, and the items are sorted by path across blocks.
+# Blocks keep each item column together, so that a whole block is decoded with a
+# few calls, while the file can still be read as a stream, one block at a time.
+
+SIGNATURE = 'FITM'
+VERSION = 1
+BLOCK_SIZE = 4096
+
+_header = Struct('>4sBI')
+_blockHeader = Struct('>II')
+
+def isManifest(data):
+    return data.startswith(SIGNATURE)
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError('The .fit manifest is truncated.')
+    return data
+
+# Yields the (paths, hashes, sizes) lists of each block of the manifest read from
+# file object f
+def iterBlocks(f):
+    signature, version, count = _header.unpack(_read(f, _header.size))
+    if signature != SIGNATURE or version != VERSION:
+        raise IOError('Unsupported .fit manifest version (%d).'%version)
+
+    while count > 0:
+        n, pathsSize = _blockHeader.unpack(_read(f, _blockHeader.size))
+        hashes = hexlify(_read(f, n*20))
+        hashes = [hashes[i:i+40] for i in xrange(0, n*40, 40)]
+        sizes = Struct('>%dQ'%n).unpack(_read(f, n*8))
+        paths = _read(f, pathsSize).split('\0')
+        yield paths, hashes, sizes
+        count -= n
+
+# Yields the (path, hash, size) items of the manifest read from file object f
+def iterItems(f):
+    for paths, hashes, sizes in iterBlocks(f):
+        for item in izip(paths, hashes, sizes):
+            yield item
+
+def read(f):
+    fitData = {}
+    # Creating a list per item would otherwise trigger many useless garbage
+    # collections
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for paths, hashes, sizes in iterBlocks(f):
+            fitData.update(izip(paths, imap(list, izip(hashes, sizes))))
+    finally:
+        if collecting:
+            gc.enable()
+    return fitData
+
+def write(fitData, f):
+    paths = sorted(fitData)
+    f.write(_header.pack(SIGNATURE, VERSION, len(paths)))
+    for start in xrange(0, len(paths), BLOCK_SIZE):
+        block = paths[start:start+BLOCK_SIZE]
+        pathTable = '\0'.join(block)
+        f.write(_blockHeader.pack(len(block), len(pathTable)))
+        f.write(unhexlify(''.join(fitData[p][0] for p in block)))
+        f.write(Struct('>%dQ'%len(block)).pack(*(int(fitData[p][1]) for p in block)))
+        f.write(pathTable)
@@ -0,0 +1,66 @@
+from . import repo, getConfigInt
+from marshal import load, dump
+from paths import FitData, PathIndex
+from os import path, listdir, makedirs, rename, remove, utime
+
+# Parsed .fit files are kept in a cache under the fit directory, one marshal file
+# per blob id of the .fit contents, so that reading a .fit file that was read
+# before (the one at HEAD, the one in the working tree, ...) only takes loading
+# that file instead of parsing the .fit file again. Cache files are touched when
+# used, and only the fit.manifestCache.size (0 disables the cache) most recently
+# used ones are kept. Each file holds the fit data followed by its sorted paths, so
+# that the PathIndex of the .fit contents is only built once as well.
+
+DEFAULT_CACHE_SIZE = 32
+
+_cacheSize = None
+
+def getCacheSize():
+    global _cacheSize
+    if _cacheSize is None:
+        _cacheSize = max(0, getConfigInt('fit.manifestCache.size', DEFAULT_CACHE_SIZE))
+    return _cacheSize
+
+def _cacheFile(blobId):
+    return path.join(repo.manifestsDir, blobId)
+
+# Returns the fit data (as FitData) parsed from the .fit contents with the given
+# blob id, or None if it is not in the cache
+def get(blobId):
+    if not getCacheSize():
+        return None
+    cacheFile = _cacheFile(blobId)
+    try:
+        with open(cacheFile, 'rb') as f:
+            fitData = load(f)
+            paths = load(f)
+        utime(cacheFile, None)
+        return FitData(fitData, PathIndex(paths, isSorted=True))
+    except Exception:
+        # missing or unreadable, which just means parsing the .fit file
+        return None
+
+def put(blobId, fitData):
+    if not getCacheSize():
+        return
+    cacheFile = _cacheFile(blobId)
+    tempFile = cacheFile + '.tmp'
+    try:
+        if not path.exists(repo.manifestsDir):
+            makedirs(repo.manifestsDir)
+        pathIndex = fitData.pathIndex() if isinstance(fitData, FitData) else PathIndex(fitData)
+        with open(tempFile, 'wb') as f:
+            dump(dict(fitData), f)
+            dump(pathIndex.paths, f)
+        rename(tempFile, cacheFile)
+        _evict()
+    except (IOError, OSError, ValueError):
+        path.exists(tempFile) and remove(tempFile)
+
+def _evict():
+    entries = [path.join(repo.manifestsDir, e) for e in listdir(repo.manifestsDir) if not e.endswith('.tmp')]
+    if len(entries) <= getCacheSize():
+        return
+    entries.sort(key=path.getmtime)
+    for e in entries[:len(entries) - getCacheSize()]:
+        remove(e)
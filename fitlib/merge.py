@@ -1,5 +1,5 @@
-from . import gitDirOperation, repoDir, fitFile, readFitFile, writeFitFile
-from . import mergeOtherFitFile, mergeMineFitFile, filterBinaryFiles, getFitFileStatus
+from . import gitDirOperation, readFitFile, writeFitFile, repo
+from . import filterBinaryFiles, getFitFileStatus, timings
 import changes
 from os import path, remove
 from shutil import move
@@ -116,14 +116,15 @@ likewise, "theirs" actually refers to YOUR version that's already in the current
 
 _conflictLine_re = re.compile('\s*([(]?)\s*\[([MTW]?)\]\s*([)]?)\s*(\*\*|\+\+|\*-|-\*)\s*(.+)\s*$')
 
+@timings.phase('merge driver')
 def mergeDriver(common, mine, other):
     commonFit, mineFit, otherFit = readFitFile(common), readFitFile(mine), readFitFile(other)
     mergedFit, modified, added, removed, conflicts = getMergedFit(commonFit, mineFit, otherFit)
 
     if conflicts:
         resolved = False
-        writeFitFile(mergedFit, mergeMineFitFile)
-        move(other, mergeOtherFitFile)
+        writeFitFile(mergedFit, repo.mergeMineFitFile)
+        move(other, repo.mergeOtherFitFile)
         prepareResolutionForm(conflicts, mine)
         print conflictMsg
     else:
@@ -174,8 +175,8 @@ def resolve():
     return True
 
 def getResolutions():
-    mineFitData = readFitFile(mergeMineFitFile)
-    otherFitData = readFitFile(mergeOtherFitFile)
+    mineFitData = readFitFile(repo.mergeMineFitFile)
+    otherFitData = readFitFile(repo.mergeOtherFitFile)
 
     mine = []
     theirs = []
@@ -185,7 +186,7 @@ def getResolutions():
     stack = []
     batchResolution = ''
 
-    for n,l in enumerate(open(fitFile).readlines()):
+    for n,l in enumerate(open(repo.fitFile).readlines()):
         if l.startswith('#'):
             continue
         l = l.strip()
@@ -239,9 +240,9 @@ def isMergeInProgress():
 
     merging = (
         ('U' in fitFileStatus or fitFileStatus in ('AA', 'DD'))
-        and path.exists(mergeMineFitFile) and path.exists(mergeOtherFitFile)
-        and path.exists(fitFile) and fitFile not in filterBinaryFiles([fitFile])
-        and open(fitFile).next().strip() == crfHeader[0]
+        and path.exists(repo.mergeMineFitFile) and path.exists(repo.mergeOtherFitFile)
+        and path.exists(repo.fitFile) and repo.fitFile not in filterBinaryFiles([repo.fitFile])
+        and open(repo.fitFile).next().strip() == crfHeader[0]
     )
 
     if not merging:
@@ -250,10 +251,10 @@ def isMergeInProgress():
     return merging
 
 def cleanupMergeArtifacts():
-    if path.exists(mergeMineFitFile):
-        remove(mergeMineFitFile)
-    if path.exists(mergeOtherFitFile):
-        remove(mergeOtherFitFile)
+    if path.exists(repo.mergeMineFitFile):
+        remove(repo.mergeMineFitFile)
+    if path.exists(repo.mergeOtherFitFile):
+        remove(repo.mergeOtherFitFile)
 
 def getMergedFit(common, mine, other):
     mineMod,mineAdd,mineRem = fitDiff(common, mine)
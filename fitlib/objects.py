@@ -1,17 +1,36 @@
-from . import gitDirOperation, refreshStats, getFitSize, readFitFile, writeFitFile, getCommitFile, commitsDir
-from . import repoDir, fitDir, objectsDir, tempDir, workingDir
-from paths import getValidFitPaths
-import cache
-from subprocess import Popen as popen, PIPE
+from . import gitDirOperation, refreshStats, getFitSize, readFitFile, writeFitFile, getCommitFile, repo
+from . import workingDir, getConfig, getConfigInt, timings
+from paths import getValidFitPaths, getPathIndex
+from hashes import BlobWriter
+import cache, chunking, compression, telemetry
 from os.path import dirname, basename, exists, join as joinpath, getsize
 from os import walk, makedirs, remove, close as osclose, mkdir, listdir, stat
-from shutil import copyfile, move
 from sys import stdout
 from tempfile import mkstemp
+from threading import Thread as thread, RLock, Condition, local
+from Queue import Queue, Empty
+from timeit import default_timer as timer
+
+# Number of concurrent transfers that get/put start with when fit.transfer.jobs is
+# not set, and the limits that it adapts within (see _Window)
+DEFAULT_TRANSFER_JOBS = 4
+DEFAULT_MIN_TRANSFER_JOBS = 1
+DEFAULT_MAX_TRANSFER_JOBS = 16
+
+# Number of times a failed transfer is tried again when fit.transfer.retries is not set
+DEFAULT_TRANSFER_RETRIES = 2
+
+# Throughput may vary this much between windows without counting as a drop
+THROUGHPUT_TOLERANCE = 0.9
+
+# A batch that takes this many times longer (plus the margin, in seconds) than
+# the throughput of the previous window's worth has it take counts as congested
+SLOW_BATCH_FACTOR = 4
+SLOW_BATCH_MARGIN = 1.0
 
 def getDataStore(progressCallback):
-    moduleName = popen('git config fit.datastore.moduleName'.split(), stdout=PIPE).communicate()[0].strip()
-    modulePath = popen('git config fit.datastore.modulePath'.split(), stdout=PIPE).communicate()[0].strip()
+    moduleName = getConfig('fit.datastore.moduleName')
+    modulePath = getConfig('fit.datastore.modulePath')
 
     if not moduleName:
         raise Exception('error: No external data store is configured. Check the fit.datastore keys in git config.')
@@ -37,51 +56,71 @@ def getDownstreamItems(fitTrackedData, paths, stats):
     cached = cache.find((fitTrackedData[p][0] for p in paths), update=False)
     return [p for p in paths if not (p in stats or fitTrackedData[p][0] in cached)]
 
+# The progress printer is shared by all transfer workers. Each worker thread has
+# its own current item, and the overall percentage accounts for the partial
+# progress of every item still in flight.
 class _ProgressPrinter:
     def __init__(self):
         self.size_total = 0
-        self.size_item = 0
         self.size_done = 0
-        self.item_name = ''
-        self.item_started = False
+        self.size_inflight = 0
+        self.open_line = None
+        self.lock = RLock()
+        self.current = local()
+
+    def _item(self):
+        return getattr(self.current, 'item', None)
 
     def updateProgress(self, done, size, custom_item_string=None):
-        if custom_item_string:
-            fmt_args = (
-                (self.size_done+done)*100./self.size_total,
-                custom_item_string,
-                self.item_name
-            )
-            print '\rOverall: %6.2f%%    %s   %s'%fmt_args,
-        else:
-            fmt_args = (
-                (self.size_done+done)*100./self.size_total,
-                self.size_item/1048576.,
-                done*100./size,
-                self.item_name
-            )
-            print '\rOverall: %6.2f%%    %7.3f MB   %6.2f%%   %s'%fmt_args,
-        stdout.flush()
-        self.item_started = True
-    def newItem(self, name, size):
-        if self.size_item and self.item_started:
+        with self.lock:
+            item = self._item()
+            if not item:
+                return
+            self.size_inflight += done - item['done']
+            item['done'] = done
+
+            if self.open_line not in (None, item):
+                print
+            self.open_line = item
+
+            overall = (self.size_done+self.size_inflight)*100./self.size_total
+            if custom_item_string:
+                print '\rOverall: %6.2f%%    %s   %s'%(overall, custom_item_string, item['name']),
+            else:
+                fmt_args = (
+                    overall,
+                    item['size']/1048576.,
+                    done*100./size,
+                    item['name']
+                )
+                print '\rOverall: %6.2f%%    %7.3f MB   %6.2f%%   %s'%fmt_args,
+            stdout.flush()
+
+    def _finishItem(self, item):
+        if self.open_line is item:
             print
+            self.open_line = None
+        self.size_inflight -= item['done']
+        self.size_done += item['size']
 
-        self.size_done += self.size_item
-        self.item_name = name
-        self.size_item = size
-        self.item_started = False
+    def newItem(self, name, size):
+        with self.lock:
+            item = self._item()
+            if item:
+                self._finishItem(item)
+            self.current.item = {'name': name, 'size': size, 'done': 0}
 
     def done(self):
-        if self.size_item > 0:
-            self.size_done += self.size_item
-            print
+        with self.lock:
+            if self.open_line:
+                print
+                self.open_line = None
 
     def setTotalSize(self, totalSize):
         self.size_total = totalSize
 
 class _QuietProgressPrinter:
-    def updateProgress(self, done, size):
+    def updateProgress(self, done, size, custom_item_string=None):
         pass
     def newItem(self, name, size):
         pass
@@ -90,10 +129,188 @@ class _QuietProgressPrinter:
     def setTotalSize(self, totalSize):
         pass
 
-@gitDirOperation(repoDir)
+# Limits the number of batches in flight to a window that adapts to how well the
+# data store copes, much like TCP congestion control: each window's worth of
+# successful batches widens the window by one, or narrows it by one if throughput
+# dropped compared to the previous window's worth, and a failed or slow batch (a
+# lost or late packet, so to speak) halves it. The window stays between minSize
+# and maxSize.
+class _Window:
+    def __init__(self, size, minSize, maxSize):
+        self.minSize = max(1, minSize)
+        self.maxSize = max(self.minSize, maxSize)
+        self.size = float(min(max(size, self.minSize), self.maxSize))
+        self.inFlight = 0
+        self.condition = Condition()
+        self.lastRate = None
+        self._newEpoch()
+
+    def _newEpoch(self):
+        self.epochStart = timer()
+        self.epochBytes = 0
+        self.epochBatches = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.inFlight >= int(self.size):
+                # wait with a timeout so that KeyboardInterrupt is still delivered
+                self.condition.wait(1)
+            self.inFlight += 1
+
+    # Gives back a slot that was not used for a transfer
+    def cancel(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify_all()
+
+    # Takes back the slot of a batch of size that took seconds
+    def release(self, ok, size, seconds=0):
+        with self.condition:
+            self.inFlight -= 1
+            if ok and self.lastRate and seconds > SLOW_BATCH_FACTOR*size*self.size/self.lastRate + SLOW_BATCH_MARGIN:
+                ok = False
+            if not ok:
+                self.size = max(self.minSize, self.size/2)
+                self.lastRate = None
+                self._newEpoch()
+            else:
+                self.epochBytes += size
+                self.epochBatches += 1
+                if self.epochBatches >= int(self.size):
+                    rate = self.epochBytes/max(timer() - self.epochStart, 1e-6)
+                    if self.lastRate is None or rate >= self.lastRate*THROUGHPUT_TOLERANCE:
+                        self.size = min(self.maxSize, self.size + 1)
+                    else:
+                        self.size = max(self.minSize, self.size - 1)
+                    self.lastRate = rate
+                    self._newEpoch()
+            self.condition.notify_all()
+
+# The size of a (path, hash, size) item, which throughput is measured in
+def _itemSize(item):
+    return item[2] if isinstance(item, tuple) else 1
+
+# Runs transfers over a pool of worker threads. Every worker owns a separate data
+# store instance (created on demand by storeFactory) so that stores do not need to
+# be thread-safe. The number of transfers in flight starts at jobs and adapts
+# between minJobs and maxJobs (see _Window), which default to jobs. With a single
+# job everything runs in the calling thread, exactly like the serial transfer loop
+# did. Items of failed batches are tried again, one at a time, up to retries times.
+# Checks and batches are recorded in log, if given (see telemetry.py).
+class _TransferPool:
+    def __init__(self, store, storeFactory, jobs, log=None, minJobs=None, maxJobs=None, retries=0):
+        self.stores = [store]
+        self.storeFactory = storeFactory
+        self.jobs = max(1, jobs)
+        self.minJobs = minJobs or self.jobs
+        self.maxJobs = maxJobs or self.jobs
+        self.retries = retries
+        self.lock = RLock()
+        self.log = log
+        self.window = None
+
+    def _getStore(self, worker):
+        with self.lock:
+            while len(self.stores) <= worker:
+                self.stores.append(None)
+            if self.stores[worker] is None:
+                self.stores[worker] = self.storeFactory()
+            return self.stores[worker]
+
+    # Returns a {key: handle} map of the given keys that exist in the store.
+    def checkMany(self, keys):
+        keys = list(keys)
+        timings.count('store checks', len(keys))
+        start = timer()
+        found = self.stores[0].checkMany(keys)
+        self.log and self.log.check(len(keys), timer() - start)
+        return found
+
+    # Calls transferBatch(store, batch) for consecutive batches of the items, with
+    # batches as large as the store accepts, and returns a list with the outcome
+    # of each item (True for success) in the same order as items.
+    def map(self, transferBatch, items):
+        batchSize = max(1, getattr(self.stores[0], 'batchSize', 1))
+        results = [False]*len(items)
+        queue = Queue()
+        for i in range(0, len(items), batchSize):
+            queue.put((i, items[i:i+batchSize], 1))
+        timings.count('store batches', queue.qsize())
+        window = self.window = self.window or _Window(self.jobs, self.minJobs, self.maxJobs)
+
+        def work(worker):
+            store = None
+            while True:
+                window.acquire()
+                # The store is opened before a batch is taken, so that a worker whose
+                # store cannot be opened leaves all of the batches to the others
+                # (worker 0 has the store the pool was given, which is open already)
+                if not store:
+                    try:
+                        store = self._getStore(worker)
+                    except Exception as e:
+                        print '\nwarning: Could not open data store for transfer worker: %s'%e
+                        window.cancel()
+                        return
+                try:
+                    i, batch, attempt = queue.get_nowait()
+                except Empty:
+                    window.cancel()
+                    return
+
+                start = timer()
+                try:
+                    results[i:i+len(batch)] = [bool(r) for r in transferBatch(store, batch)]
+                except Exception:
+                    pass
+                seconds = timer() - start
+                batchResults = results[i:i+len(batch)]
+                window.release(all(batchResults), sum(_itemSize(item) for item in batch), seconds)
+                self.log and self.log.batch(batch, batchResults, seconds, attempt)
+
+                if attempt <= self.retries:
+                    for n, ok in enumerate(batchResults):
+                        ok or queue.put((i + n, batch[n:n+1], attempt + 1))
+
+        numWorkers = min(self.maxJobs, queue.qsize())
+        if numWorkers <= 1:
+            work(0)
+        else:
+            workers = [thread(target=work, args=(w,)) for w in range(numWorkers)]
+            for w in workers:
+                w.daemon = True
+                w.start()
+            for w in workers:
+                # join with a timeout so that KeyboardInterrupt is still delivered
+                while w.is_alive():
+                    w.join(1)
+
+        return results
+
+    def close(self):
+        for store in self.stores:
+            if store:
+                store.close()
+
+# Returns the (jobs, minJobs, maxJobs) of the given data store module. The
+# fit.transfer.<module>.* settings override the fit.transfer.* ones. A number of
+# jobs that is set stays fixed, as it always has, unless minJobs or maxJobs are
+# set as well.
+def getTransferLimits(storeName):
+    def getLimit(name, default):
+        for key in ('fit.transfer.%s.%s'%(storeName, name), 'fit.transfer.%s'%name):
+            if getConfig(key):
+                return getConfigInt(key, default)
+        return default
+    jobs = getLimit('jobs', None)
+    if jobs is None:
+        return DEFAULT_TRANSFER_JOBS, getLimit('minJobs', DEFAULT_MIN_TRANSFER_JOBS), getLimit('maxJobs', DEFAULT_MAX_TRANSFER_JOBS)
+    return jobs, getLimit('minJobs', jobs), getLimit('maxJobs', jobs)
+
+@gitDirOperation(repo)
 def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=False):    
     allItems = fitTrackedData.keys()
-    validPaths = getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir) if pathArgs else allItems
+    validPaths = getValidFitPaths(pathArgs, getPathIndex(fitTrackedData), basePath=repo.repoDir, workingDir=workingDir) if pathArgs else allItems
 
     needed = []   # not in working tree nor in cache, must be downloaded
     touched = {}
@@ -106,7 +323,7 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
             fileDir = dirname(filePath)
             fileDir and (exists(fileDir) or makedirs(fileDir))
             if objPath:
-                copyfile(objPath, filePath)
+                cache.materialize(objPath, filePath)
                 touched[filePath] = objHash
             else:
                 needed.append((filePath, objHash, size))
@@ -136,35 +353,149 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
 
     refreshStats(touched)
 
-def _get(items, store, pp, successes, failures):
-    if not exists(tempDir):
-        mkdir(tempDir)
+def _objectKey(objHash):
+    return '%s/%s'%(objHash[:2], objHash[2:])
 
-    for filePath,objHash,size in items:
-        pp.newItem(filePath, size)
-        
-        # Copy download to temp file first, and then to actual object location
-        # This is to prevent interrupted downloads from causing bad objects to be placed
-        # in the objects cache
-        (tempHandle, tempTransferFile) = mkstemp(dir=tempDir)
-        osclose(tempHandle)
-        key = store.check('%s/%s'%(objHash[:2], objHash[2:]))
+def _newBatch(pp, batch):
+    if len(batch) == 1:
+        pp.newItem(batch[0][0], batch[0][2])
+    else:
+        pp.newItem('%d objects'%len(batch), sum(s for f,h,s in batch))
 
-        try:
-            transferred = store.get(key, tempTransferFile, size)
-        except:
-            transferred = False
-        if key and transferred:
+def _reportItem(pp, item, message):
+    pp.newItem(item[0], item[2])
+    pp.updateProgress(item[2], item[2], custom_item_string=message)
+
+def _collectResults(items, results, successes, failures):
+    for n, item in enumerate(items):
+        if results[n]:
+            successes.append(item)
+        else:
+            failures.append(item[0])
+
+def _newTempFile():
+    (tempHandle, tempTransferFile) = mkstemp(dir=repo.tempDir)
+    osclose(tempHandle)
+    return tempTransferFile
+
+# Objects are downloaded into tempDir/<hash>.part, and the number of bytes of it
+# known to be written is kept in tempDir/<hash>.offset. If a download is cut short,
+# both are kept so that the next get can continue it with stores that can resume
+# downloads (see DataStore.resumable). Continued downloads are hashed as a whole,
+# so they are verified just like any other.
+class _PartialDownload(BlobWriter):
+    # Bytes written between updates of the offset file
+    SAVE_INTERVAL = 8388608
+
+    def __init__(self, objHash, size, resume):
+        partFile = joinpath(repo.tempDir, objHash + '.part')
+        self.offsetFile = joinpath(repo.tempDir, objHash + '.offset')
+        offset = 0
+        if resume and exists(partFile) and exists(self.offsetFile):
+            try:
+                offset = min(int(open(self.offsetFile).read()), getsize(partFile))
+            except ValueError:
+                pass
+        BlobWriter.__init__(self, partFile, size, compression.Decoder(), offset)
+        self.saved = offset
+
+    def _save(self, offset):
+        with open(self.offsetFile, 'w') as f:
+            f.write(str(offset))
+        self.saved = offset
+
+    def write(self, data):
+        BlobWriter.write(self, data)
+        if self.position - self.saved >= self.SAVE_INTERVAL:
+            self.file.flush()
+            self._save(self.position)
+
+    def close(self):
+        BlobWriter.close(self)
+        # stores that write the file by themselves keep it consistent on their own
+        self._save(self.position if self.file else getsize(self.name) if exists(self.name) else 0)
+
+    def discard(self):
+        for f in (self.name, self.offsetFile):
+            exists(f) and remove(f)
+
+def _get(items, pool, pp, successes, failures):
+    if not exists(repo.tempDir):
+        mkdir(repo.tempDir)
+
+    keys = pool.checkMany(_objectKey(h) for f,h,s in items)
+
+    # Objects that are shared by several items are only downloaded once
+    results = {}
+    pending = {}
+    for n, item in enumerate(items):
+        if _objectKey(item[1]) in keys:
+            pending.setdefault(item[1], []).append(n)
+        else:
+            _reportItem(pp, item, 'ERROR')
+            results[n] = False
+
+    needed = [items[n[0]] for n in pending.itervalues()]
+    needed.sort()
+    # The items that share an object with another are done along with it, so only
+    # the objects themselves (and the items reported on already) make progress
+    pp.setTotalSize(sum(s for f,h,s in needed) + sum(items[n][2] for n in results))
+
+    def getBatch(store, batch):
+        _newBatch(pp, batch)
+
+        # Each object is downloaded into a temp file, hashing its (decompressed)
+        # contents on the way, and only moved into the cache if its hash checks out. This prevents
+        # interrupted or corrupted downloads from placing bad objects in the cache.
+        resumable = getattr(store, 'resumable', False)
+        writers = [_PartialDownload(h, s, resumable) for f,h,s in batch]
+        transferred = store.getMany([(keys[_objectKey(h)], w, s) for (f,h,s),w in zip(batch, writers)])
+
+        verified = []
+        objFiles = []
+        for (f,h,s), writer, ok in zip(batch, writers, transferred):
+            writer.close()
+            objFile = writer.name
+            digest = ok and writer.hexdigest()
+            if ok and writer.decoder.codec == compression.CHUNKED:
+                # a manifest of a chunked object, which is assembled from its chunks
+                objFile = _newTempFile()
+                ok = chunking.getChunked(store, writer.name, h, s, objFile, _newTempFile)
+                writer.discard()
+                if not ok:
+                    remove(objFile)
+            elif ok and digest != h:
+                ok = False
+                writer.discard()
+            elif not ok and not resumable:
+                writer.discard()
+            verified.append(ok)
+            objFiles.append(objFile)
+
+        cache.insert({h:(s,o) for (f,h,s),o,ok in zip(batch, objFiles, verified) if ok}, inLru=True, adopt=True)
+        for w, ok in zip(writers, verified):
+            ok and w.discard()
+
+        # The working tree is materialized from the verified cache entries
+        for (f,h,s), ok in zip(batch, verified):
+            if ok:
+                for n in pending[h]:
+                    cache.materialize(cache.objectPath(h), items[n][0])
+
+        size = sum(s for f,h,s in batch)
+        if all(verified):
             pp.updateProgress(size, size)
-            move(tempTransferFile, filePath)
-            successes.append((filePath, objHash, size))
+        elif all(transferred):
+            pp.updateProgress(size, size, custom_item_string='ERROR (content does not match hash)')
         else:
             pp.updateProgress(size, size, custom_item_string='ERROR')
-            failures.append(filePath)
+        return verified
 
-    cache.insert({h:(s,f) for f,h,s in successes}, inLru=True, progressMsg='Caching newly gotten items')
+    for (f,objHash,s), transferred in zip(needed, pool.map(getBatch, needed)):
+        results.update((n, transferred) for n in pending[objHash])
+    _collectResults(items, results, successes, failures)
 
-@gitDirOperation(repoDir)
+@gitDirOperation(repo)
 def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=False, quiet=False):
     commitsFile = getCommitFile()
     commitsFitData = readFitFile(commitsFile)
@@ -196,38 +527,85 @@ def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=Fal
         writeFitFile(commitsFitData, commitsFile)
     elif exists(commitsFile):
         remove(commitsFile)
-    for f in sorted(listdir(commitsDir), key=lambda x: stat(joinpath(commitsDir, x)).st_mtime)[:-2]:
-        remove(joinpath(commitsDir, f))
+    for f in sorted(listdir(repo.commitsDir), key=lambda x: stat(joinpath(repo.commitsDir, x)).st_mtime)[:-2]:
+        remove(joinpath(repo.commitsDir, f))
+
+# Returns the file to upload for the given cached object, which is a temp file if
+# the object needs to be compressed first (see compression.py)
+def _uploadSource(cachedPath):
+    codec, level = compression.getCodec()
+    if codec == 'none' or compression.isFramed(cachedPath):
+        return cachedPath
+
+    compressed = _newTempFile()
+    compression.compressFile(cachedPath, compressed, codec, level)
+    if getsize(compressed) < getsize(cachedPath):
+        return compressed
+
+    # not worth it for objects that do not compress
+    remove(compressed)
+    return cachedPath
+
+def _put(items, pool, pp, successes, failures):
+    if not exists(repo.tempDir):
+        mkdir(repo.tempDir)
 
-def _put(items, store, pp, successes, failures):
     cached = cache.find(o for f,o,s in items)
-    for filePath,objHash,size in items:
-        pp.newItem(filePath, size)
+    existing = pool.checkMany(_objectKey(o) for f,o,s in items if o in cached)
+
+    # Objects that are shared by several items are only uploaded once
+    results = {}
+    pending = {}
+    for n, item in enumerate(items):
+        filePath,objHash,size = item
         if objHash not in cached:
-            pp.updateProgress(size, size, custom_item_string='ERROR')
-            failures.append(filePath)
-            continue
+            _reportItem(pp, item, 'ERROR')
+            results[n] = False
+        elif _objectKey(objHash) in existing:
+            _reportItem(pp, item, 'No transfer needed.')
+            results[n] = True
+        else:
+            pending.setdefault(objHash, []).append(n)
+
+    needed = [items[n[0]] for n in pending.itervalues()]
+    needed.sort()
+    # The items that share an object with another are done along with it, so only
+    # the objects themselves (and the items reported on already) make progress
+    pp.setTotalSize(sum(s for f,h,s in needed) + sum(items[n][2] for n in results))
 
-        done = True
-        keyName = '%s/%s'%(objHash[:2], objHash[2:])
-        if store.check(keyName):
-            pp.updateProgress(size, size, custom_item_string='No transfer needed.')
+    def putBatch(store, batch):
+        _newBatch(pp, batch)
+
+        # Large objects are put in chunks (see chunking.py), one at a time
+        results = {}
+        for f,h,s in batch:
+            if chunking.shouldChunk(s):
+                results[h] = chunking.putChunked(store, cached[h], _objectKey(h), h, s, _uploadSource, _newTempFile)
+
+        whole = [item for item in batch if item[1] not in results]
+        sources = [_uploadSource(cached[h]) for f,h,s in whole]
+        try:
+            results.update(zip((h for f,h,s in whole), store.putMany([(src, _objectKey(h), s) for (f,h,s),src in zip(whole, sources)])))
+        finally:
+            for (f,h,s), src in zip(whole, sources):
+                if src != cached[h] and exists(src):
+                    remove(src)
+        transferred = [results[h] for f,h,s in batch]
+
+        size = sum(s for f,h,s in batch)
+        if all(transferred):
+            pp.updateProgress(size, size)
         else:
-            try:
-                transferred = store.put(cached[objHash], keyName, size)
-            except:
-                transferred = False
-            if transferred:
-                pp.updateProgress(size, size)
-            else:
-                done = False
-                pp.updateProgress(size, size, custom_item_string='ERROR')
-                failures.append(filePath)
-        if done:
-            successes.append((filePath, objHash, size))
+            pp.updateProgress(size, size, custom_item_string='ERROR')
+        return transferred
+
+    for (f,objHash,s), transferred in zip(needed, pool.map(putBatch, needed)):
+        results.update((n, transferred) for n in pending[objHash])
+    _collectResults(items, results, successes, failures)
 
     cache.enque(o for f,o,s in successes)
 
+@timings.phase('transfer')
 def _transfer(method, items, size, fitTrackedData, successes, quiet):
     pp = _QuietProgressPrinter() if quiet else _ProgressPrinter()
     pp.setTotalSize(size)
@@ -240,10 +618,16 @@ def _transfer(method, items, size, fitTrackedData, successes, quiet):
     failures = []
     items.sort()
 
-    method(items, store, pp, successes, failures)
+    jobs, minJobs, maxJobs = getTransferLimits(store.__class__.__module__)
+    retries = getConfigInt('fit.transfer.retries', DEFAULT_TRANSFER_RETRIES)
+    log = telemetry.TransferLog(method.__name__.strip('_'), store, jobs)
+    pool = _TransferPool(store, lambda: getDataStore(pp.updateProgress), jobs, log, minJobs, maxJobs, retries)
+    method(items, pool, pp, successes, failures)
+    timings.count('bytes of items transferred', sum(s for f,h,s in successes))
 
     pp.done()
-    store.close()
+    pool.close()
+    log.close(successes, failures, pool.window and pool.window.size)
 
     if len(failures) > 0:
         print '\n'.join(failures)
@@ -1,21 +1,76 @@
 #!/usr/bin/env python2.7
 
+from bisect import bisect_left
 from os.path import dirname, realpath, relpath, join as joinpath
 
-class FitNode:
-    def __init__(self, path, nodes):
-        self.parentPath = path
-        self.children = nodes
+# The given paths in sorted order, so that those in or below a directory form a
+# contiguous range that is found by binary search, in O(log n + k) time for k
+# matching paths
+class PathIndex:
+    def __init__(self, paths, isSorted=False):
+        self.paths = paths if isSorted else sorted(paths)
 
-# Returns a tree constructred from given list of paths
-def getPathTree(paths):
-    tree = {}
-    for p in paths:
-        parts = p.split('/')
-        node = tree.setdefault(parts[0], {})
-        for c in parts[1:]:
-            node = node.setdefault(c, {})
-    return tree
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, p):
+        i = bisect_left(self.paths, p)
+        return i < len(self.paths) and self.paths[i] == p
+
+    # Returns the paths equal to p or below directory p
+    def find(self, p):
+        found = [p] if p in self else []
+        # '0' is the character that follows '/'
+        start = bisect_left(self.paths, p + '/')
+        end = bisect_left(self.paths, p + '0', start)
+        found.extend(self.paths[start:end])
+        return found
+
+# Fit data ({path: [hash, size]}) that builds a PathIndex of its paths at most once,
+# unless one is given (e.g. by the manifest cache), and drops it when they change
+class FitData(dict):
+    def __init__(self, items=(), pathIndex=None):
+        dict.__init__(self, items)
+        self._pathIndex = pathIndex
+
+    def pathIndex(self):
+        if self._pathIndex is None:
+            self._pathIndex = PathIndex(self)
+        return self._pathIndex
+
+    def __setitem__(self, k, v):
+        self._pathIndex = None
+        dict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self._pathIndex = None
+        dict.__delitem__(self, k)
+
+    def update(self, *args, **kwds):
+        self._pathIndex = None
+        dict.update(self, *args, **kwds)
+
+    def pop(self, *args):
+        self._pathIndex = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._pathIndex = None
+        return dict.popitem(self)
+
+    def setdefault(self, k, v=None):
+        self._pathIndex = None
+        return dict.setdefault(self, k, v)
+
+    def clear(self):
+        self._pathIndex = None
+        dict.clear(self)
+
+def getPathIndex(fitData):
+    return fitData.pathIndex() if isinstance(fitData, FitData) else PathIndex(fitData)
 
 def fitMapToTree(fitData):
     tree = {}
@@ -47,46 +102,37 @@ def _fitMapToTreeRec(fitData, path, items):
         else:
             fitData[next_path] = v
 
-def _addFitItemsToList(path, node, items):
-    # keep a queue of nodes, adding all leafs to fitPaths
-    nodes = [FitNode(path, node)]
-    while len(nodes) > 0:
-        node = nodes.pop(0)
-        if len(node.children) == 0:
-            items.add(node.parentPath)
-        else:
-            nodes.extend([FitNode(node.parentPath + '/' + k, v) for k,v in node.children.iteritems()])            
-
-def getValidFitPaths(given, available, basePath='', workingDir=''):
+# Returns the items of available (a PathIndex, or an iterable of paths that is indexed
+# for this call) and of extra (paths that are only scanned once, e.g. those of the
+# working tree, which would take longer to index) given by the user-entered paths,
+# which may be items or directories
+def getValidFitPaths(given, available, basePath='', workingDir='', extra=()):
     if not given:
         return None
 
     # Normalize the user-entered paths into canonical paths relative to basePath
     given = {relpath(realpath(joinpath(workingDir,p)), basePath) for p in given}
-    validPaths = set(available) if '.' in given else set()
-    fitPathTree = getPathTree(available)
+    if not isinstance(available, PathIndex):
+        available = PathIndex(available)
+    if '.' in given:
+        return set(available) | set(extra)
 
-    # Generate list of individual fit items under user-given paths
     for p in given:
         if p.startswith('../'):
             print '(...skipping path not under repo: %s)'%p
-            continue
+    given = sorted(p for p in given if not p.startswith('../'))
 
-        # Determine if normalized user-given path is one that
-        # is tracked by fit by traversing fitPathTree
-        isFit = True
-        node = fitPathTree
-        parts = p.split('/')
-        for part in parts:
-            node = node.get(part)
-            if node == None:
-                isFit = False
-                break
+    prefixes = tuple(p + '/' for p in given)
+    extraItems = [e for e in extra if e in given or e.startswith(prefixes)] if given else []
 
-        if not isFit:
+    # Generate list of individual fit items under user-given paths
+    validPaths = set()
+    for p in given:
+        items = available.find(p) + [e for e in extraItems if e == p or e.startswith(p + '/')]
+        if not items:
             print '(...path not currently tracked by fit: %s)'%p
             continue
 
-        _addFitItemsToList(p, node, validPaths)
+        validPaths.update(items)
 
     return validPaths
@@ -0,0 +1,152 @@
+from . import getConfigBool, getConfigInt, timings
+from attributes import getAttributesFiles
+from fnmatch import fnmatchcase
+from os import walk, sep
+from os.path import dirname, basename, islink, join as joinpath
+from subprocess import Popen as popen, PIPE
+from threading import Thread as thread
+from Queue import Queue, Empty
+
+# Lists the files in the working tree that may be fit items, i.e. those that git
+# does not track. Fit items are usually gitignored, so ignored files cannot just be
+# left out, but listing every ignored file (build output, dependencies, ...) can be
+# very slow. Instead, git lists the untracked files that are not ignored, and the
+# ignored directories as a whole without descending into them. Of those, only the
+# ones in which a fit pattern of an attributes file could match are walked, and
+# only the files whose names match a fit pattern are kept. The result is a superset
+# of the fit items, which still go through git check-attr. Attributes files inside
+# ignored directories count as well, so the directories above them are walked.
+# Setting fit.scan.prune to false lists all untracked files instead, like earlier
+# versions did.
+
+DEFAULT_SCAN_JOBS = 4
+
+def _lsFiles(args):
+    p = popen(['git', 'ls-files', '-o', '-z'] + args, stdout=PIPE)
+    return [f for f in p.communicate()[0].split('\0') if f]
+
+# A pattern of an attributes file that sets the fit attribute, with the directory
+# (relative to the repository's root) that it is relative to
+class _FitPattern:
+    def __init__(self, base, pattern):
+        self.base = base.split('/') if base else []
+        # patterns without a slash match file names at any depth
+        self.anchored = '/' in pattern.rstrip('/')
+        parts = pattern.lstrip('/').split('/')
+        self.dirParts = parts[:-1]
+        self.name = parts[-1]
+
+    def _relative(self, dirParts):
+        n = len(self.base)
+        if dirParts[:n] != self.base[:len(dirParts)]:
+            return None
+        return dirParts[n:]
+
+    # Whether the pattern could match any file in or below the given directory
+    def coversDir(self, dirParts):
+        rel = self._relative(dirParts)
+        if rel is None:
+            return False
+        if not self.anchored:
+            return True
+        for r, p in zip(rel, self.dirParts):
+            if '**' in p:
+                return True
+            if not fnmatchcase(r, p):
+                return False
+        return len(rel) <= len(self.dirParts) or '**' in self.name
+
+    def matchesName(self, name):
+        return '**' in self.name or fnmatchcase(name, self.name)
+
+def _readFitPatterns():
+    patterns = []
+    for attributesFile in getAttributesFiles():
+        base = dirname(attributesFile) if basename(attributesFile) == '.gitattributes' else ''
+        try:
+            lines = open(attributesFile).read().splitlines()
+        except IOError:
+            continue
+        for l in lines:
+            fields = l.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            setsFit = any(a == 'fit' or a.startswith('fit=') for a in fields[1:])
+            if fields[0].startswith('[attr]'):
+                if setsFit:
+                    # a macro that sets fit could be used by any pattern
+                    return None
+                continue
+            if setsFit:
+                patterns.append(_FitPattern(base, fields[0].strip('"')))
+    return patterns
+
+# Adds the files below top that may be fit items to found, as paths relative to the
+# repository's root with '/' separators, like those git lists
+def _walkIgnored(top, patterns, found):
+    for dirPath, dirNames, fileNames in walk(top):
+        relDir = dirPath.replace(sep, '/').rstrip('/')
+        dirParts = relDir.split('/')
+        # git lists symlinks to directories as files
+        links = [d for d in dirNames if islink(joinpath(dirPath, d))]
+        fileNames.extend(links)
+        if patterns is not None:
+            dirNames[:] = [d for d in dirNames if d not in links and any(p.coversDir(dirParts + [d]) for p in patterns)]
+            fileNames = [f for f in fileNames if any(p.matchesName(f) for p in patterns)]
+        found.extend(relDir + '/' + f for f in fileNames)
+
+# Returns the untracked files that may be fit items. Must run in the repository's
+# root directory.
+@timings.phase('scan')
+def listCandidates():
+    if not getConfigBool('fit.scan.prune', True):
+        return _lsFiles([])
+
+    candidates = _lsFiles(['--exclude-standard'])
+    ignored = _lsFiles(['-i', '--exclude-standard', '--directory'])
+    patterns = _readFitPatterns()
+
+    # git may list a directory along with directories and files in it
+    files = [f for f in ignored if not f.endswith('/')]
+    dirs = []
+    for d in sorted(d for d in ignored if d.endswith('/')):
+        if not (dirs and d.startswith(dirs[-1])):
+            dirs.append(d)
+    dirs = [d.rstrip('/') for d in dirs]
+    if patterns is not None:
+        files = [f for f in files if any(p.matchesName(basename(f)) for p in patterns)]
+        dirs = [d for d in dirs if any(p.coversDir(d.split('/')) for p in patterns)]
+    candidates.extend(files)
+    if not dirs:
+        return candidates
+
+    # The ignored directories are walked by a few threads, which mostly wait for
+    # the file system
+    queue = Queue()
+    for d in dirs:
+        queue.put(d)
+    results = []
+
+    def work():
+        found = []
+        while True:
+            try:
+                d = queue.get_nowait()
+            except Empty:
+                break
+            _walkIgnored(d, patterns, found)
+        results.append(found)
+
+    jobs = max(1, min(getConfigInt('fit.scan.jobs', DEFAULT_SCAN_JOBS), len(dirs)))
+    workers = [thread(target=work) for w in range(jobs)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        while w.is_alive():
+            w.join(1)
+
+    candidates = set(candidates)
+    for found in results:
+        candidates.update(found)
+    return list(candidates)
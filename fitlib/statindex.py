@@ -0,0 +1,179 @@
+from hashlib import sha1
+from json import load
+from mmap import mmap, ACCESS_READ, ACCESS_WRITE
+from os import path, rename, fdopen, remove
+from struct import Struct
+from binascii import hexlify, unhexlify
+from tempfile import mkstemp
+
+# The stat index records, for every fit item in the working tree, the hash of its
+# contents along with the stats it had when it was hashed:
+#   {filename --> (checksum_hash, (st_size, st_mtime, st_ctime, st_ino))}
+#
+# It is laid out much like git's own index file, so it can be read without any
+# parsing and patched in place:
+#
+#   header:   signature "FSTI", version, record count, size of the path table
+#             (all 32-bit big-endian), then the SHA-1 of everything after the header
+#   records:  one fixed-width record per item, sorted by path: 20-byte binary
+#             hash, size, mtime, ctime, inode, and the offset and length of the
+#             item's path in the path table
+#   paths:    the concatenated item paths
+#
+# A hash of all zero bytes stands for an item whose contents are not known.
+# The checksum covers the records and the paths. An index whose checksum does not
+# match (e.g. because an update was interrupted) is treated as empty, which just
+# means that all items get hashed again.
+
+SIGNATURE = 'FSTI'
+VERSION = 1
+
+_header = Struct('>4sIII20s')
+_record = Struct('>20sQddQIH')
+_noHash = '\0'*20
+
+def _packHash(h):
+    return unhexlify(h) if h else _noHash
+
+def _unpackHash(h):
+    return hexlify(h) if h != _noHash else 0
+
+def _encodePath(p):
+    return p.encode('utf-8') if isinstance(p, unicode) else p
+
+class _IndexFile:
+    def __init__(self, filePath, writable=False):
+        self.file = open(filePath, 'r+b' if writable else 'rb')
+        try:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_WRITE if writable else ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+        self.count = 0
+        self.valid = False
+        if len(self.data) < _header.size:
+            return
+
+        signature, version, self.count, pathsSize, checksum = _header.unpack_from(self.data)
+        self.pathsOffset = _header.size + self.count*_record.size
+        self.valid = (
+            signature == SIGNATURE
+            and version == VERSION
+            and len(self.data) == self.pathsOffset + pathsSize
+            and sha1(buffer(self.data, _header.size)).digest() == checksum
+        )
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def _path(self, fields):
+        start = self.pathsOffset + fields[5]
+        return self.data[start:start+fields[6]]
+
+    def _fields(self, n):
+        return _record.unpack_from(self.data, _header.size + n*_record.size)
+
+    def items(self):
+        for n in xrange(self.count):
+            fields = self._fields(n)
+            yield self._path(fields), (_unpackHash(fields[0]), fields[1:5])
+
+    # Binary search for the record number of the given path (or None)
+    def find(self, filePath):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi)//2
+            p = self._path(self._fields(mid))
+            if p < filePath:
+                lo = mid + 1
+            elif p > filePath:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def update(self, n, objHash, stats):
+        offset = _header.size + n*_record.size
+        fields = self._fields(n)
+        _record.pack_into(self.data, offset, _packHash(objHash), *(tuple(stats) + fields[5:]))
+
+    def updateChecksum(self):
+        signature, version, count, pathsSize, checksum = _header.unpack_from(self.data)
+        checksum = sha1(buffer(self.data, _header.size)).digest()
+        _header.pack_into(self.data, 0, signature, version, count, pathsSize, checksum)
+        self.data.flush()
+
+def isIndex(filePath):
+    with open(filePath, 'rb') as f:
+        return f.read(len(SIGNATURE)) == SIGNATURE
+
+def read(filePath):
+    if not path.exists(filePath):
+        return {}
+
+    if not isIndex(filePath):
+        # Migrate the JSON stat file used by earlier versions
+        stats = load(open(filePath))
+        stats = {_encodePath(p): (h and str(h), tuple(s)) for p,(h,s) in stats.iteritems()}
+        write(stats, filePath)
+        return stats
+
+    if path.getsize(filePath) == 0:
+        return {}
+
+    index = _IndexFile(filePath)
+    try:
+        return dict(index.items()) if index.valid else {}
+    finally:
+        index.close()
+
+def write(stats, filePath):
+    paths = sorted((_encodePath(p), p) for p in stats)
+    records = []
+    offset = 0
+    for encoded, p in paths:
+        h, s = stats[p]
+        records.append(_record.pack(_packHash(h), *(tuple(s) + (offset, len(encoded)))))
+        offset += len(encoded)
+
+    body = ''.join(records) + ''.join(encoded for encoded, p in paths)
+    header = _header.pack(SIGNATURE, VERSION, len(records), offset, sha1(body).digest())
+
+    # Write to a temporary file first so that readers never see a partial index
+    handle, tempPath = mkstemp(dir=path.dirname(filePath) or '.')
+    try:
+        with fdopen(handle, 'wb') as out:
+            out.write(header)
+            out.write(body)
+        try:
+            rename(tempPath, filePath)
+        except OSError:
+            # Windows cannot rename onto an existing file
+            remove(filePath)
+            rename(tempPath, filePath)
+    except:
+        path.exists(tempPath) and remove(tempPath)
+        raise
+
+# Overwrites the records of the given items in place. Returns False, without
+# changing anything, if the index does not exist yet or lacks any of the items.
+def update(stats, filePath):
+    if not stats:
+        return True
+    if not (path.exists(filePath) and path.getsize(filePath) > 0 and isIndex(filePath)):
+        return False
+
+    index = _IndexFile(filePath, writable=True)
+    try:
+        if not index.valid:
+            return False
+        records = [(index.find(_encodePath(p)), h, s) for p,(h,s) in stats.iteritems()]
+        if any(n is None for n,h,s in records):
+            return False
+        for n,h,s in records:
+            index.update(n, h, s)
+        index.updateChecksum()
+        return True
+    finally:
+        index.close()
@@ -0,0 +1,125 @@
+from . import repo, getConfigBool
+from json import dumps, loads
+from os import path, rename, getpid
+from threading import RLock
+from timeit import default_timer as timer
+import time
+
+# Every get and put appends JSON records of its transfers to .git/fit/transfers.log
+# (unless fit.transfer.log is false), one per line:
+#   check:   a checkMany() of count keys that took seconds
+#   batch:   a batch of count objects of bytes in total that took seconds to
+#            transfer, of which succeeded succeeded, on its attempts'th attempt
+#   object:  an object of size bytes in a batch of batch objects, with ok telling
+#            whether it succeeded. Its seconds are its share of the time of the
+#            batch, in proportion to its size.
+#   run:     the totals of a get or put, and the concurrency it ended with
+# Records carry the operation (get or put) and the data store module. The log is
+# rotated to transfers.log.1 once it grows larger than LOG_MAX_SIZE.
+
+LOG_FILE = 'transfers.log'
+LOG_MAX_SIZE = 16*1048576
+
+def _logFile():
+    return path.join(repo.fitDir, LOG_FILE)
+
+class TransferLog:
+    def __init__(self, op, store, jobs):
+        self.op = op
+        self.store = store.__class__.__module__
+        self.jobs = jobs
+        self.start = timer()
+        self.lock = RLock()
+        self.records = []
+
+    def _add(self, kind, **fields):
+        fields.update(type=kind, op=self.op, store=self.store)
+        with self.lock:
+            self.records.append(fields)
+
+    def check(self, count, seconds):
+        self._add('check', count=count, seconds=seconds)
+
+    # Records the batch of (path, hash, size) items that took seconds, given the
+    # outcome of each and the attempt the batch was
+    def batch(self, items, results, seconds, attempts=1):
+        total = sum(s for f,h,s in items)
+        with self.lock:
+            self._add('batch', count=len(items), bytes=total, seconds=seconds, attempts=attempts,
+                succeeded=len([ok for ok in results if ok]))
+            for (f,h,s), ok in zip(items, results):
+                share = float(s)/total if total else 1./len(items)
+                self._add('object', hash=h, size=s, seconds=seconds*share, batch=len(items), ok=bool(ok))
+
+    # window is the number of concurrent transfers that the run ended with
+    def close(self, successes, failures, window=None):
+        with self.lock:
+            objects = [r for r in self.records if r['type'] == 'object']
+            self._add('run', time=time.time(), pid=getpid(), jobs=self.jobs, window=window,
+                seconds=timer() - self.start, objects=len(objects),
+                bytes=sum(r['size'] for r in objects if r['ok']),
+                successes=len(successes), failures=len(failures))
+            records, self.records = self.records, []
+        if getConfigBool('fit.transfer.log', True):
+            writeRecords(records)
+
+def writeRecords(records):
+    logFile = _logFile()
+    try:
+        if path.exists(logFile) and path.getsize(logFile) > LOG_MAX_SIZE:
+            rename(logFile, logFile + '.1')
+        with open(logFile, 'a') as f:
+            f.write(''.join(dumps(r, sort_keys=True) + '\n' for r in records))
+    except (IOError, OSError):
+        pass
+
+def readRecords():
+    records = []
+    for logFile in (_logFile() + '.1', _logFile()):
+        if not path.exists(logFile):
+            continue
+        with open(logFile) as f:
+            for l in f:
+                try:
+                    records.append(loads(l))
+                except ValueError:
+                    # a line cut short by an interrupted write
+                    pass
+    return records
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p))]
+
+# Prints the transfer statistics of each data store and operation
+def printReport(records=None):
+    records = readRecords() if records is None else records
+    groups = {}
+    for r in records:
+        groups.setdefault((r['store'], r['op']), []).append(r)
+    if not groups:
+        print 'No transfers have been logged yet.'
+        return
+
+    for (store, op), rs in sorted(groups.iteritems()):
+        runs = [r for r in rs if r['type'] == 'run']
+        batches = [r for r in rs if r['type'] == 'batch']
+        objects = [r for r in rs if r['type'] == 'object']
+        done = [r for r in objects if r['ok']]
+        checks = [r for r in rs if r['type'] == 'check' and r['count']]
+        totalBytes = sum(r['bytes'] for r in runs)
+        runSeconds = sum(r['seconds'] for r in runs)
+        objectSeconds = [r['seconds'] for r in done]
+        # objects of a batch are transferred together, so throughput is that of batches
+        throughputs = [r['bytes']/r['seconds']/1048576 for r in batches if r['succeeded'] == r['count'] and r['seconds'] > 0]
+        checkSeconds = [r['seconds']/r['count'] for r in checks]
+
+        print '%s %s:'%(store, op)
+        print '  %d runs, %d object transfers (%d failed, %d retries), %.2fMB in total at %.2fMB/s'%(
+            len(runs), len(objects), len(objects) - len(done), len([r for r in batches if r['attempts'] > 1]),
+            totalBytes/1048576., totalBytes/1048576./runSeconds if runSeconds else 0)
+        print '  time per object:    p50 %8.1f ms   p95 %8.1f ms'%(_percentile(objectSeconds, .5)*1000, _percentile(objectSeconds, .95)*1000)
+        print '  batch throughput:   p50 %8.2f MB/s p95 %8.2f MB/s'%(_percentile(throughputs, .5), _percentile(throughputs, .95))
+        print '  check time per key: p50 %8.1f ms   p95 %8.1f ms'%(_percentile(checkSeconds, .5)*1000, _percentile(checkSeconds, .95)*1000)
@@ -0,0 +1,154 @@
+from collections import defaultdict
+from functools import wraps
+from json import dumps
+from os import environ, getpid, path
+from threading import RLock
+from timeit import default_timer as timer
+import subprocess
+import sys
+import time
+
+# Optional instrumentation, enabled with git-fit --timings or, for the runs of
+# git-fit by git (hooks, merge driver, textconv), with the GIT_FIT_TIMINGS
+# environment variable:
+#   print (or any other value)  prints a summary to stderr when git-fit exits
+#   log                         appends a JSON record to .git/fit/timings.log
+#
+# Records the wall time of the phases marked with @phase, the number and duration
+# of subprocesses by command, and the counters passed to count(). When disabled,
+# a phase costs one extra call and a check, and nothing else is patched.
+
+LOG_FILE = 'timings.log'
+
+_timings = None
+
+class _Timings:
+    def __init__(self, mode):
+        self.mode = mode
+        self.start = timer()
+        self.lock = RLock()
+        self.phases = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.processes = defaultdict(lambda: [0, 0.0])
+        self.counts = defaultdict(int)
+
+    def addPhase(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+            self.calls[name] += 1
+
+    def addProcess(self, command, seconds):
+        with self.lock:
+            self.processes[command][0] += 1
+            self.processes[command][1] += seconds
+
+    def count(self, name, n):
+        with self.lock:
+            self.counts[name] += n
+
+    def record(self):
+        return {
+            'time': time.time(),
+            'pid': getpid(),
+            'argv': sys.argv[1:],
+            'total': timer() - self.start,
+            'phases': {p: {'calls': self.calls[p], 'seconds': s} for p,s in self.phases.iteritems()},
+            'processes': {c: {'count': n, 'seconds': s} for c,(n,s) in self.processes.iteritems()},
+            'counts': dict(self.counts),
+        }
+
+def isEnabled():
+    return _timings is not None
+
+# Marks a function as a phase, whose calls are timed
+def phase(name):
+    def decorate(f):
+        @wraps(f)
+        def timed(*args, **kwds):
+            if _timings is None:
+                return f(*args, **kwds)
+            start = timer()
+            try:
+                return f(*args, **kwds)
+            finally:
+                _timings.addPhase(name, timer() - start)
+        return timed
+    return decorate
+
+def count(name, n=1):
+    if _timings is not None:
+        _timings.count(name, n)
+
+# The command of a subprocess, as its first two words (e.g. "git ls-files")
+def _commandName(args):
+    if isinstance(args, basestring):
+        args = args.split()
+    return ' '.join(path.basename(a) if i == 0 else a for i,a in enumerate(args[:2]))
+
+# Subprocesses are timed from their creation until wait() (which communicate()
+# and call() go through as well) sees them exit. The Popen class itself is
+# patched, as the modules bind Popen to their own names when they are imported.
+def _patchPopen():
+    popenInit = subprocess.Popen.__init__
+    popenWait = subprocess.Popen.wait
+
+    def init(self, args, *rest, **kwds):
+        self._fitTimingsCommand = _commandName(args)
+        self._fitTimingsStart = timer()
+        popenInit(self, args, *rest, **kwds)
+
+    def wait(self, *args, **kwds):
+        status = popenWait(self, *args, **kwds)
+        start = self.__dict__.pop('_fitTimingsStart', None)
+        if start is not None and _timings is not None:
+            _timings.addProcess(self._fitTimingsCommand, timer() - start)
+        return status
+
+    subprocess.Popen.__init__ = init
+    subprocess.Popen.wait = wait
+
+def _printSummary(record):
+    out = sys.stderr
+    print >>out, '\ngit-fit timings (%s): %.1f ms total'%(' '.join(record['argv']) or 'status', record['total']*1000)
+    if record['phases']:
+        print >>out, '  phases:'
+        for name, p in sorted(record['phases'].iteritems(), key=lambda i: -i[1]['seconds']):
+            print >>out, '    %-28s %9.1f ms  %6d calls'%(name, p['seconds']*1000, p['calls'])
+    if record['processes']:
+        print >>out, '  subprocesses:'
+        for name, p in sorted(record['processes'].iteritems(), key=lambda i: -i[1]['seconds']):
+            print >>out, '    %-28s %9.1f ms  %6d runs'%(name, p['seconds']*1000, p['count'])
+    if record['counts']:
+        print >>out, '  counts:'
+        for name, n in sorted(record['counts'].iteritems()):
+            print >>out, '    %-28s %12d'%(name, n)
+
+def _appendLog(record):
+    from . import repo
+    try:
+        with open(path.join(repo.fitDir, LOG_FILE), 'a') as f:
+            f.write(dumps(record, sort_keys=True) + '\n')
+    except Exception:
+        pass
+
+def report():
+    if _timings is None:
+        return
+    record = _timings.record()
+    if _timings.mode == 'log':
+        _appendLog(record)
+    else:
+        _printSummary(record)
+
+# Turns on the instrumentation with the given mode, or the one of GIT_FIT_TIMINGS
+# if mode is None. Returns whether it is on.
+def enable(mode=None):
+    global _timings
+    mode = mode or environ.get('GIT_FIT_TIMINGS')
+    if not mode or mode in ('0', 'false', 'no', 'off') or _timings is not None:
+        return _timings is not None
+    _patchPopen()
+    _timings = _Timings(mode)
+    import atexit
+    atexit.register(report)
+    return True
@@ -1,19 +1,27 @@
 from os.path import exists, join as joinpath, dirname
-from shutil import copy, rmtree
+from shutil import copy, copyfileobj, rmtree
 from tempfile import mkdtemp
 from subprocess import Popen as popen
-from fitlib import fitDir, DataStore
+from fitlib import DataStore, repo
 
 class Store(DataStore):
+    resumable = True
 
     def __init__(self, *args, **kwds):
-        self.dir = joinpath(fitDir, 'store')
+        self.dir = joinpath(repo.fitDir, 'store')
 
     def get(self, key, dst, size):
         if exists(key):
             copy(key, dst)
             return True
 
+    def getStream(self, key, out, size):
+        if exists(key):
+            with open(key, 'rb') as src:
+                src.seek(out.tell())
+                copyfileobj(src, out)
+            return True
+
     def put(self, src, dst, size):
         if exists(src):
             dst = joinpath(self.dir, dst)
@@ -1,5 +1,7 @@
+import os
 import os.path# import , join as joinpath
 import posixpath
+import shutil
 import tempfile
 
 from subprocess import Popen as popen, PIPE
@@ -7,45 +9,170 @@ from fitlib import DataStore
 
 SHOW_PROGRESS_LIMIT = 1e+7 # show progress of transfer for files larger than this
 
+# Interrupted uploads are kept here (relative to the object's directory) until
+# they are continued, so that a partial object never shows up under its key
+PARTIAL_DIR = '.rsync-partial'
+
+# With a transfer statistic (%b) in it, rsync logs each file once it has been
+# transferred rather than when it starts on it
+OUT_FORMAT = '--out-format=%b %n'
+
 class Store(DataStore):
+    # --partial and --append-verify let rsync continue interrupted downloads
+    resumable = True
 
-    def __init__(self, *args, **kwds):
+    # Every rsync run sets up a connection (an SSH session for remote locations)
+    # of its own, so whole batches of objects are checked and transferred by a
+    # single run, each with a --files-from list of their keys
+    batchSize = 1000
+
+    def __init__(self, progress=None, *args, **kwds):
         self.location = popen('git config fit.datastore.location'.split(), stdout=PIPE).communicate()[0].strip()
         if not self.location :
             raise Exception("error: No datastore location given, please specify fit.datastore.location in git config.")
 
+        self.progress = progress
         self.dir = tempfile.mkdtemp()
 
     def __del__(self) :
         if popen(["rm",  "-r", self.dir]).wait() != 0 :
             print "Failed to remove temporary folder %s" % self.dir
 
+    # The location as an rsync source or destination directory
+    def _locationDir(self):
+        return self.location.rstrip('/') + '/'
+
+    # The key relative to the location, of a key returned by check()
+    def _relativeKey(self, key):
+        prefix = self._locationDir()
+        return key[len(prefix):] if key.startswith(prefix) else key
+
+    # Runs rsync with the given relative paths as its --files-from list, and calls
+    # onLine with each line it prints (given OUT_FORMAT or --list-only) as it goes.
+    # Returns whether rsync succeeded as a whole.
+    def _rsync(self, args, paths, onLine, cwd=None, quiet=False):
+        fd, filesFrom = tempfile.mkstemp(dir=self.dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write('\0'.join(paths))
+            # rsync -q isn't quiet when a file doesn't exist
+            # therefore we pipe to /dev/null
+            with file(os.devnull, 'w') as devnull :
+                p = popen(['rsync', '--from0', '--files-from=%s'%filesFrom] + args, cwd=cwd, stdout=PIPE, stderr=devnull if quiet else None)
+                for line in iter(p.stdout.readline, ''):
+                    onLine(line.rstrip('\n'))
+                return p.wait() == 0
+        finally:
+            os.remove(filesFrom)
+
     def get(self, key, dst, size):
         reporting = "--progress" if size > SHOW_PROGRESS_LIMIT else "--quiet"
 
         # the cygwin rsync requires unix filenames for dst, but we have windows
         # therefore we just work in the directory and only use the filename
         dst_dir, dst_file = os.path.split(dst)
-        return popen(['rsync', reporting, key, dst_file], cwd=dst_dir).wait() == 0
+        return popen(['rsync', reporting, '--partial', '--append-verify', key, dst_file], cwd=dst_dir).wait() == 0
+
+    def getMany(self, items):
+        if not items:
+            return []
+
+        # rsync lays the objects out under their keys in a directory next to the
+        # downloads, which are moved in and out of it, so that partial downloads
+        # are continued and kept
+        recvDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(items[0][1].name)))
+        keys = [self._relativeKey(key) for key, out, size in items]
+        try:
+            for key, (k, out, size) in zip(keys, items):
+                received = os.path.join(recvDir, key)
+                if os.path.exists(out.name) and os.path.getsize(out.name):
+                    if not os.path.exists(os.path.dirname(received)):
+                        os.makedirs(os.path.dirname(received))
+                    shutil.move(out.name, received)
+
+            sizes = dict(zip(keys, (size for key, out, size in items)))
+            transferred = set()
+            ok = self._rsync([OUT_FORMAT, '--partial', '--append-verify', self._locationDir(), '.'], keys,
+                self._transferLogger(sizes, transferred), cwd=recvDir)
+
+            results = []
+            for key, (k, out, size) in zip(keys, items):
+                received = os.path.join(recvDir, key)
+                if os.path.exists(received):
+                    shutil.move(received, out.name)
+                results.append(os.path.exists(out.name) and (ok or key in transferred))
+            return results
+        finally:
+            shutil.rmtree(recvDir, ignore_errors=True)
+
+    # Returns an onLine for _rsync that adds the keys rsync logged as transferred
+    # (those of the given {key: size} map) to the transferred set. Files that
+    # were already up to date are not logged, and only count as transferred if
+    # rsync succeeds as a whole.
+    def _transferLogger(self, sizes, transferred):
+        total = sum(sizes.itervalues())
+        def onLine(line):
+            fields = line.split(' ', 1)
+            if len(fields) == 2 and fields[0].isdigit() and fields[1] in sizes:
+                transferred.add(fields[1])
+                self.progress and self.progress(sum(sizes[k] for k in transferred), total)
+        return onLine
 
     def put(self, src, dst, size):
-        # copy the file in the temporary directory and execute rsync there
-        # this way, we can create the necessary directories using rsync -R
-        tmpfile = os.path.join(self.dir, dst)
+        return self.putMany([(src, dst, size)])[0]
 
-        reporting = "--progress" if size > SHOW_PROGRESS_LIMIT else "--quiet"
+    def putMany(self, items):
+        # rsync --relative creates the directories of the keys on the remote side,
+        # given each object under its key in a local directory: objects already laid
+        # out that way (like those of the cache) are sent from where they are, the
+        # others through links to them
+        groups = {}
+        links = []
+        for src, dst, size in items:
+            src = os.path.abspath(src)
+            suffix = os.sep + dst.replace('/', os.sep)
+            if src.endswith(suffix):
+                base = src[:-len(suffix)]
+            else:
+                base = self.dir
+                link = os.path.join(self.dir, dst)
+                if not os.path.exists(os.path.dirname(link)):
+                    os.makedirs(os.path.dirname(link))
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(src, link)
+                links.append(link)
+            groups.setdefault(base, []).append(dst)
 
-        return (
-            popen(['mkdir', '-p', os.path.dirname(tmpfile)]).wait() == 0
-        and popen(['cp', src, tmpfile]).wait() == 0
-        and popen(['rsync', reporting, '--relative', dst, self.location], cwd=self.dir).wait() == 0
-        )
+        sizes = dict((dst, size) for src, dst, size in items)
+        transferred = set()
+        onLine = self._transferLogger(sizes, transferred)
+        succeeded = set()
+        try:
+            for base, keys in groups.iteritems():
+                if self._rsync([OUT_FORMAT, '--copy-links', '--partial-dir=%s'%PARTIAL_DIR, '.', self._locationDir()], keys, onLine, cwd=base):
+                    succeeded.update(keys)
+        finally:
+            for link in links:
+                os.remove(link)
+
+        return [dst in succeeded or dst in transferred for src, dst, size in items]
 
     def check(self, key):
-        path = posixpath.join(self.location, key)
+        return self.checkMany([key]).get(key)
+
+    def checkMany(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        # one listing of all of the keys, of which the missing ones are left out
+        # (with an error that is ignored)
+        listed = set()
+        def onLine(line):
+            fields = line.split(None, 4)
+            if len(fields) == 5 and not line.startswith('d'):
+                listed.add(fields[4])
 
-        # rsync -q isn't quiet when the file doesn't exist
-        # therefore we pipe to /dev/null
-        with file(os.devnull, 'w') as devnull :
-            if popen(['rsync', '--list-only', path], stderr=devnull, stdout=devnull).wait() == 0 :
-                return path
+        self._rsync(['--list-only', self._locationDir()], keys, onLine, quiet=True)
+        return dict((k, posixpath.join(self.location, k)) for k in keys if k in listed)
@@ -1,6 +1,15 @@
 from subprocess import Popen as popen, PIPE
-from fitlib import DataStore
-from os import environ, devnull
+from fitlib import DataStore, repo, getConfig, getConfigInt
+from hashlib import md5
+from json import load, dump
+from os import environ, devnull, path, fdopen, fchmod, rename, remove, utime, open as osopen, O_WRONLY, O_CREAT, O_TRUNC
+from glob import glob
+from threading import Thread as thread, RLock, Condition
+from Queue import Queue, Empty
+from urlparse import urlparse
+from contextlib import contextmanager
+import posixpath
+import time
 
 _s3keys_from_odin_cmd='''
 python2.7 -c "
@@ -20,7 +29,54 @@ except:
 '''
 
 _TRANSFER_CHUNK_SIZE = 102400
+# Key directories with at least this many keys to check are listed instead of
+# querying each key on its own
+_LIST_MIN_KEYS = 20
+_BUCKET_NAME = 'krfdirect-git-repo'
+
+# Objects at least fit.s3.multipartThreshold bytes large are transferred in parts
+# of fit.s3.partSize bytes, fit.s3.partJobs of them at a time: uploads as multipart
+# uploads, and downloads as ranged GETs that are written out in order
+DEFAULT_MULTIPART_THRESHOLD = 64*1048576
+DEFAULT_PART_SIZE = 16*1048576
+DEFAULT_PART_JOBS = 4
+# The smallest part that S3 accepts, except for the last part of an upload
+MIN_PART_SIZE = 5*1048576
+# Multipart uploads that were not continued for this many seconds are aborted, so
+# that S3 does not keep (and bill) their parts forever
+STALE_UPLOAD_AGE = 7*86400
+
+# Seconds for which fetched credentials are kept in .git/fit/s3-credentials when
+# fit.s3.credentialsTtl is not set (0 disables that file)
+DEFAULT_CREDENTIALS_TTL = 3600
+
 S3Connection = None
+
+# Fetching credentials (through ssh) and opening connections are slow, so both
+# are shared by all the stores of a process: the credentials are fetched once,
+# and the buckets (each with its own connection, as connections are not
+# thread-safe) are taken from a pool for each transfer or check, and put back
+# once it is done, for whichever store or part transfer comes next.
+_lock = RLock()
+_credentials = None
+_idleBuckets = []
+_bucketValidated = False
+_settings = None
+_staleUploadsAborted = False
+
+def _getSettings():
+    global _settings
+    with _lock:
+        if _settings is None:
+            _settings = {
+                'bucket': getConfig('fit.s3.bucket', _BUCKET_NAME),
+                'endpoint': getConfig('fit.s3.endpoint'),
+                'threshold': getConfigInt('fit.s3.multipartThreshold', DEFAULT_MULTIPART_THRESHOLD),
+                'partSize': max(MIN_PART_SIZE, getConfigInt('fit.s3.partSize', DEFAULT_PART_SIZE)),
+                'partJobs': max(1, getConfigInt('fit.s3.partJobs', DEFAULT_PART_JOBS)),
+            }
+        return _settings
+
 def _getKeys():
     materialName = 'com.amazon.access.krf-dev-build-krf-git-1'
     userAndHost = 'krf.aka.amazon.com'
@@ -32,7 +88,55 @@ def _getKeys():
         raise Exception('Error getting AWS access credentials!')
     return creds
 
-def _getBucket():
+def _credentialsFile():
+    return path.join(repo.fitDir, 's3-credentials')
+
+def _readCachedKeys():
+    try:
+        with open(_credentialsFile()) as f:
+            cached = load(f)
+        return [str(k) for k in cached['keys']] if cached['expires'] > time.time() else None
+    except Exception:
+        # missing or unreadable, which just means fetching the credentials
+        return None
+
+def _writeCachedKeys(keys, ttl):
+    # only readable by the user, as the file holds the secret key
+    tempFile = _credentialsFile() + '.tmp'
+    try:
+        fd = osopen(tempFile, O_WRONLY | O_CREAT | O_TRUNC, 0600)
+        fchmod(fd, 0600)
+        with fdopen(fd, 'w') as f:
+            dump({'keys': keys, 'expires': time.time() + ttl}, f)
+        rename(tempFile, _credentialsFile())
+    except (IOError, OSError):
+        path.exists(tempFile) and remove(tempFile)
+
+def _getCachedKeys():
+    global _credentials
+    # only for an S3-compatible server set as fit.s3.endpoint, as the variables may
+    # well be set for some other AWS account
+    if _getSettings()['endpoint'] and environ.get('AWS_ACCESS_KEY_ID') and environ.get('AWS_SECRET_ACCESS_KEY'):
+        return [environ['AWS_ACCESS_KEY_ID'], environ['AWS_SECRET_ACCESS_KEY']]
+    with _lock:
+        if not _credentials:
+            ttl = getConfigInt('fit.s3.credentialsTtl', DEFAULT_CREDENTIALS_TTL)
+            _credentials = ttl > 0 and _readCachedKeys()
+            if not _credentials:
+                _credentials = _getKeys()
+                if ttl > 0:
+                    _writeCachedKeys(_credentials, ttl)
+        return _credentials
+
+def _forgetKeys():
+    global _credentials
+    with _lock:
+        _credentials = None
+        if path.exists(_credentialsFile()):
+            remove(_credentialsFile())
+
+# Connects to S3, or to the S3-compatible server at the URL given as fit.s3.endpoint
+def _connect():
     global S3Connection
     if not S3Connection:
         # importing boto library adds on a huge chunk of startup time for
@@ -41,27 +145,323 @@ def _getBucket():
         from boto.s3.connection import S3Connection as s3conn
         S3Connection = s3conn
 
-    return S3Connection(*_getKeys()).get_bucket('krfdirect-git-repo')
+    endpoint = _getSettings()['endpoint']
+    if not endpoint:
+        return S3Connection(*_getCachedKeys())
+
+    from boto.s3.connection import OrdinaryCallingFormat
+    url = urlparse(endpoint if '://' in endpoint else 'https://' + endpoint)
+    return S3Connection(*_getCachedKeys(), host=url.hostname, port=url.port,
+        is_secure=url.scheme == 'https', calling_format=OrdinaryCallingFormat())
+
+def _newBucket():
+    global _bucketValidated
+    bucketName = _getSettings()['bucket']
+
+    # The first bucket checks that the bucket can be accessed, which fails when
+    # cached credentials were revoked before they expired. Other buckets wait for
+    # that check, so that they get the credentials it settles on.
+    with _lock:
+        if not _bucketValidated:
+            try:
+                bucket = _connect().get_bucket(bucketName)
+            except Exception as e:
+                if getattr(e, 'status', None) not in (400, 401, 403):
+                    raise
+                _forgetKeys()
+                bucket = _connect().get_bucket(bucketName)
+            _bucketValidated = True
+            return bucket
+    return _connect().get_bucket(bucketName, validate=False)
+
+def _acquireBucket():
+    with _lock:
+        if _idleBuckets:
+            return _idleBuckets.pop()
+    return _newBucket()
+
+def _releaseBucket(bucket):
+    with _lock:
+        _idleBuckets.append(bucket)
+
+# A bucket from the pool for the duration of a with statement
+@contextmanager
+def _borrowBucket():
+    bucket = _acquireBucket()
+    try:
+        yield bucket
+    finally:
+        _releaseBucket(bucket)
+
+def _partRanges(start, end, partSize):
+    return [(o, min(o + partSize, end)) for o in xrange(start, end, partSize)]
+
+# Calls transferPart(bucket, n, (start, end), partProgress) for each of the ranges,
+# on up to jobs threads that each use a bucket (and connection) of their own, where
+# partProgress(done) reports the bytes done for the part. Then calls done(n, result)
+# with the result of each part in order, and progress(done) with the bytes done
+# for all parts, both from the calling thread (as the progress printer expects).
+# At most jobs parts are held before they are passed to done(). Raises the first
+# error of the parts.
+def _transferParts(ranges, transferPart, jobs, done, progress, acquireBucket=None, releaseBucket=None):
+    acquireBucket = acquireBucket or _acquireBucket
+    releaseBucket = releaseBucket or _releaseBucket
+    queue = Queue()
+    for n in range(len(ranges)):
+        queue.put(n)
+    condition = Condition()
+    results = {}
+    partsDone = [0]*len(ranges)
+    errors = []
+    state = {'next': 0}
+
+    def work():
+        bucket = None
+        try:
+            while not errors:
+                try:
+                    n = queue.get_nowait()
+                except Empty:
+                    return
+                with condition:
+                    while n >= state['next'] + jobs and not errors:
+                        condition.wait(1)
+                if errors:
+                    return
+                bucket = bucket or acquireBucket()
+                def partProgress(d, n=n):
+                    partsDone[n] = d
+                result = transferPart(bucket, n, ranges[n], partProgress)
+                partsDone[n] = ranges[n][1] - ranges[n][0]
+                with condition:
+                    results[n] = result
+                    condition.notify_all()
+        except Exception as e:
+            with condition:
+                errors.append(e)
+                condition.notify_all()
+        finally:
+            bucket and releaseBucket(bucket)
+
+    workers = [thread(target=work) for w in range(min(jobs, len(ranges)))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    try:
+        while state['next'] < len(ranges):
+            with condition:
+                while state['next'] not in results and not errors:
+                    condition.wait(0.5)
+                    progress(sum(partsDone))
+                if errors:
+                    break
+                result = results.pop(state['next'])
+            done(state['next'], result)
+            with condition:
+                state['next'] += 1
+                condition.notify_all()
+            progress(sum(partsDone))
+    except BaseException as e:
+        with condition:
+            errors.append(e)
+            condition.notify_all()
+        raise
+    finally:
+        for w in workers:
+            while w.is_alive():
+                w.join(1)
+    if errors:
+        raise errors[0]
+
+def _md5(filePath, start, end):
+    digest = md5()
+    with open(filePath, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(remaining, 1048576))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
 
 class Store(DataStore):
+    resumable = True
+
     def __init__(self, progress):
-        self.bucket = _getBucket()
         self.progress = progress
+        # the first store opens the first connection, which checks the credentials
+        with _borrowBucket() as bucket:
+            self._abortStaleUploads(bucket)
+
+    # Aborts the multipart uploads of this repository that were not continued for
+    # STALE_UPLOAD_AGE seconds, e.g. of objects that were never put again, once
+    # per run
+    def _abortStaleUploads(self, bucket):
+        global _staleUploadsAborted
+        with _lock:
+            if _staleUploadsAborted:
+                return
+            _staleUploadsAborted = True
+
+        from boto.s3.multipart import MultiPartUpload
+        for uploadFile in glob(path.join(repo.tempDir, '*.s3upload')):
+            try:
+                if time.time() - path.getmtime(uploadFile) < STALE_UPLOAD_AGE:
+                    continue
+                with open(uploadFile) as f:
+                    saved = load(f)
+                upload = MultiPartUpload(bucket)
+                upload.key_name, upload.id = saved['key'], saved['id']
+                upload.cancel_upload()
+            except Exception:
+                # already completed or aborted, or not readable
+                pass
+            path.exists(uploadFile) and remove(uploadFile)
+
+    # Keys returned by check() are bound to the bucket it used, which may be in use
+    # by another transfer by now
+    def _ownKey(self, key, bucket):
+        if key.bucket is bucket:
+            return key
+        ownKey = bucket.new_key(key.name)
+        ownKey.size = key.size
+        return ownKey
 
     def get(self, key, dst, size):
         if key:
-            key.get_contents_to_filename(dst, cb=self.progress, num_cb=size/_TRANSFER_CHUNK_SIZE)
+            with open(dst, 'wb') as out:
+                return self.getStream(key, out, size)
+
+    def getStream(self, key, out, size):
+        if key:
+            # continue an interrupted download with a ranged GET
+            offset = out.tell()
+            if offset and key.size is not None and offset >= key.size:
+                return True
+            settings = _getSettings()
+            if key.size is not None and key.size - offset >= settings['threshold']:
+                self._getParts(key, out, offset, settings)
+                return True
+            headers = {'Range': 'bytes=%d-'%offset} if offset else None
+            with _borrowBucket() as bucket:
+                self._ownKey(key, bucket).get_contents_to_file(out, headers=headers, cb=self.progress, num_cb=size/_TRANSFER_CHUNK_SIZE)
             return True
 
+    # Parts are written straight into the file at out.name at their offsets (rather
+    # than through out), and if the download fails, the file is cut back to the
+    # parts done without a gap, where the next download continues
+    def _getParts(self, key, out, offset, settings):
+        out.flush()
+        def getPart(bucket, n, (start, end), partProgress):
+            partKey = bucket.new_key(key.name)
+            headers = {'Range': 'bytes=%d-%d'%(start, end - 1)}
+            with open(out.name, 'r+b') as f:
+                f.seek(start)
+                partKey.get_contents_to_file(f, headers=headers, cb=lambda d, t: partProgress(d), num_cb=(end - start)/_TRANSFER_CHUNK_SIZE)
+
+        ranges = _partRanges(offset, key.size, settings['partSize'])
+        contiguous = [offset]
+        def partDone(n, result):
+            contiguous[0] = ranges[n][1]
+        try:
+            _transferParts(ranges, getPart, settings['partJobs'], partDone, lambda d: self.progress(offset + d, key.size))
+        except:
+            with open(out.name, 'r+b') as f:
+                f.truncate(contiguous[0])
+            raise
+
     def put(self, src, dst, size):
         # S3 uploads are atomic. So if a file upload is interrupted, it will be as if none of
         # it was uploaded at all. So transient temporary transfer location is not needed like
         # it is when *downloading* from S3
         try:
-            self.bucket.new_key(dst).set_contents_from_filename(src, cb=self.progress, num_cb=size/_TRANSFER_CHUNK_SIZE)
+            settings = _getSettings()
+            srcSize = path.getsize(src)
+            if srcSize >= settings['threshold']:
+                self._putParts(src, dst, srcSize, settings)
+            else:
+                with _borrowBucket() as bucket:
+                    bucket.new_key(dst).set_contents_from_filename(src, cb=self.progress, num_cb=size/_TRANSFER_CHUNK_SIZE)
             return True
         except:
             return False
 
+    # Large objects are uploaded as multipart uploads, whose id is kept in the temp
+    # directory until they are completed. An interrupted upload is continued by the
+    # next put of the object, which skips the parts that S3 already has.
+    def _putParts(self, src, dst, size, settings):
+        from boto.s3.multipart import MultiPartUpload
+
+        partSize = settings['partSize']
+        with _borrowBucket() as bucket:
+            upload = self._resumeUpload(bucket, dst, partSize, MultiPartUpload)
+            uploaded = {}
+            if upload:
+                uploaded = {p.part_number: p.etag.strip('"') for p in upload}
+                # the age of an upload counts from its last attempt
+                utime(self._uploadFile(dst), None)
+            else:
+                upload = bucket.initiate_multipart_upload(dst)
+                with open(self._uploadFile(dst), 'w') as f:
+                    dump({'key': dst, 'id': upload.id, 'partSize': partSize}, f)
+
+        def putPart(bucket, n, (start, end), partProgress):
+            if n + 1 in uploaded and uploaded[n + 1] == _md5(src, start, end):
+                return
+            part = MultiPartUpload(bucket)
+            part.key_name, part.id = dst, upload.id
+            with open(src, 'rb') as f:
+                f.seek(start)
+                part.upload_part_from_file(f, n + 1, size=end - start, cb=lambda d, t: partProgress(d), num_cb=(end - start)/_TRANSFER_CHUNK_SIZE)
+
+        _transferParts(_partRanges(0, size, partSize), putPart, settings['partJobs'],
+            lambda n, result: None, lambda d: self.progress(d, size))
+        with _borrowBucket() as bucket:
+            upload.bucket = bucket
+            upload.complete_upload()
+        remove(self._uploadFile(dst))
+
+    def _uploadFile(self, dst):
+        return path.join(repo.tempDir, dst.replace('/', '') + '.s3upload')
+
+    # Returns the unfinished upload of dst made with the same part size, if any
+    def _resumeUpload(self, bucket, dst, partSize, MultiPartUpload):
+        uploadFile = self._uploadFile(dst)
+        if not path.exists(uploadFile):
+            return None
+        try:
+            with open(uploadFile) as f:
+                saved = load(f)
+            upload = MultiPartUpload(bucket)
+            upload.key_name, upload.id = dst, saved['id']
+            if saved['partSize'] == partSize:
+                # fails if the upload was completed or aborted in the meantime
+                list(upload)
+                return upload
+            upload.cancel_upload()
+        except Exception:
+            pass
+        remove(uploadFile)
+        return None
+
     def check(self, key):
-        return self.bucket.get_key(key)
+        with _borrowBucket() as bucket:
+            return bucket.get_key(key)
+
+    def checkMany(self, keys):
+        # keys are listed by their directory (e.g. chunks/ab), so that a listing only
+        # covers the keys next to those asked for rather than a whole namespace
+        byDir = {}
+        for k in keys:
+            byDir.setdefault(posixpath.dirname(k), set()).add(k)
+
+        found = {}
+        with _borrowBucket() as bucket:
+            for d, dirKeys in byDir.iteritems():
+                if len(dirKeys) < _LIST_MIN_KEYS:
+                    found.update((k, v) for k, v in ((k, bucket.get_key(k)) for k in dirKeys) if v)
+                else:
+                    found.update((k.name, k) for k in bucket.list(prefix=d + '/' if d else '') if k.name in dirKeys)
+        return found
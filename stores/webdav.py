@@ -4,7 +4,10 @@ from subprocess import Popen as popen, PIPE
 
 import fitlib
 
+_DOWNLOAD_CHUNK_SIZE = 1048576
+
 class Store(fitlib.DataStore):
+    resumable = True
 
     def __init__(self, *args, **kwds):
         self.location = popen('git config fit.datastore.location'.split(), stdout=PIPE).communicate()[0].strip()
@@ -18,13 +21,13 @@ class Store(fitlib.DataStore):
         import easywebdav
 
         if not self._connection :
-            self.connection = easywebdav.connect(
+            self._connection = easywebdav.connect(
                 self.location,
                 port=self.port,
                 path=self.path,
             )
 
-        return self.connection
+        return self._connection
 
     def get(self, src, dst, size):
         try :
@@ -35,6 +38,25 @@ class Store(fitlib.DataStore):
 
         return True
 
+    def getStream(self, src, out, size):
+        offset = out.tell()
+        if not offset:
+            # easywebdav writes the response into file objects as it arrives
+            self.connection.download(src, out)
+            return True
+
+        # continue an interrupted download with an HTTP range request
+        response = self.connection._send('GET', src, (200, 206, 416), headers={'Range': 'bytes=%d-'%offset}, stream=True)
+        if response.status_code == 416:
+            # nothing is left to download
+            return True
+        if response.status_code == 200:
+            # the server ignored the range and sends the whole object
+            out.restart()
+        for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+            out.write(chunk)
+        return True
+
     def put(self, src, dst, size):
         dstpath = posixpath.dirname(dst)
 
@@ -49,3 +71,22 @@ class Store(fitlib.DataStore):
         if self.connection.exists(key) :
             return key
 
+    def checkMany(self, keys):
+        # one PROPFIND per key directory instead of one per key
+        byDir = {}
+        for k in keys:
+            byDir.setdefault(posixpath.dirname(k), set()).add(k)
+
+        found = {}
+        for d, dirKeys in byDir.iteritems():
+            try :
+                listing = self.connection.ls(d)
+            except Exception :
+                # the directory does not exist (yet)
+                continue
+
+            names = {posixpath.basename(f.name.rstrip('/')) for f in listing}
+            found.update((k, k) for k in dirKeys if posixpath.basename(k) in names)
+
+        return found
+
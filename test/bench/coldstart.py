@@ -0,0 +1,63 @@
+#!/usr/bin/env python2.7
+
+# Measures how long git-fit takes to start up for the commands that git runs most
+# often (hooks and the .fit textconv), in a fresh repository. Run from anywhere:
+#
+#   python2.7 test/bench/coldstart.py [--runs N] [--json]
+
+from argparse import ArgumentParser
+from json import dumps
+from os import environ, devnull
+from os.path import dirname, realpath, join as joinpath
+from shutil import rmtree
+from subprocess import call
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+import sys
+
+gitFit = joinpath(dirname(dirname(dirname(realpath(__file__)))), 'git-fit')
+
+COMMANDS = [
+    ('import fitlib', [sys.executable, '-c', 'import fitlib']),
+    ('text-output', [sys.executable, gitFit, '--git=text-output', '.fit']),
+    ('post-commit', [sys.executable, gitFit, '--git=post-commit']),
+    ('status', [sys.executable, gitFit]),
+]
+
+def _run(cmd, cwd, env):
+    with open(devnull, 'wb') as null:
+        start = timer()
+        call(cmd, cwd=cwd, env=env, stdout=null, stderr=null)
+        return timer() - start
+
+def measure(runs):
+    repoDir = mkdtemp()
+    try:
+        env = dict(environ, PYTHONPATH=dirname(gitFit))
+        with open(devnull, 'wb') as null:
+            call(['git', 'init', '-q'], cwd=repoDir)
+            call([sys.executable, gitFit], cwd=repoDir, env=env, stdout=null, stderr=null)
+        open(joinpath(repoDir, '.fit'), 'w').close()
+
+        hookEnv = dict(env, GIT_DIR=joinpath(repoDir, '.git'), GIT_WORK_TREE=repoDir)
+        results = {}
+        for name, cmd in COMMANDS:
+            for label, e in ((name, env), (name + ' (GIT_DIR set)', hookEnv)):
+                times = sorted(_run(cmd, repoDir, e) for i in range(runs))
+                results[label] = {'min': times[0], 'median': times[len(times)//2]}
+        return results
+    finally:
+        rmtree(repoDir)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure git-fit cold-start latency.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    opts = parser.parse_args()
+
+    results = measure(opts.runs)
+    if opts.json:
+        print dumps(results, indent=2, sort_keys=True)
+    else:
+        for name in sorted(results):
+            print '%-32s  median %7.1f ms   min %7.1f ms'%(name, results[name]['median']*1000, results[name]['min']*1000)
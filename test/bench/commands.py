@@ -0,0 +1,223 @@
+#!/usr/bin/env python2.7
+
+# Measures how long the git-fit commands take in a synthetic repository, against a
+# data store in the repository itself (stores/localstore.py), so no network is
+# needed. The repository is generated from a seed, so that results of different
+# revisions of git-fit can be compared. Run from anywhere:
+#
+#   python2.7 test/bench/commands.py [--items N] [--runs N] [--output FILE] [--compare FILE]
+#
+# Each run generates the repository, then goes through the steps below in order.
+# The results are the min and median time of each step across runs.
+
+from argparse import ArgumentParser
+from binascii import unhexlify
+from json import dumps, load
+from os import environ, devnull, makedirs, remove, chmod
+from os.path import dirname, exists, realpath, join as joinpath
+from random import Random
+from shutil import rmtree
+from subprocess import call, Popen as popen, PIPE
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+import sys
+
+packageDir = dirname(dirname(dirname(realpath(__file__))))
+gitFit = joinpath(packageDir, 'git-fit')
+
+STEPS = [
+    'status (new items)',
+    'save',
+    'commit',
+    'put',
+    'status (clean)',
+    'status (path)',
+    'restore',
+    'get',
+    'checkout (post-checkout)',
+    'merge (merge driver)',
+]
+
+class Scenario:
+    def __init__(self, opts, binDir):
+        self.opts = opts
+        self.rand = Random(opts.seed)
+        self.dir = mkdtemp()
+        self.env = dict(environ, PATH=binDir + ':' + environ.get('PATH', ''), PYTHONPATH=packageDir)
+        self.items = []
+        self.times = {}
+
+    def git(self, *args):
+        with open(devnull, 'wb') as null:
+            if call(('git',) + args, cwd=self.dir, env=self.env, stdout=null, stderr=null) != 0:
+                raise Exception('git %s failed'%' '.join(args))
+
+    def fit(self, *args):
+        self.git('fit', *args)
+
+    def timed(self, step, f, *args):
+        start = timer()
+        f(*args)
+        self.times[step] = timer() - start
+
+    def _size(self):
+        # log-uniform between the min and max sizes
+        o = self.opts
+        return int(o.min_size * (float(o.max_size)/o.min_size)**self.rand.random())
+
+    def _content(self, size):
+        return unhexlify('%0*x'%(2*size, self.rand.getrandbits(8*size))) if size else ''
+
+    def writeItem(self, item, size=None):
+        with open(joinpath(self.dir, item), 'wb') as f:
+            f.write(self._content(self._size() if size is None else size))
+
+    def modifyItems(self, fraction, items=None):
+        items = items or self.items
+        for item in self.rand.sample(items, max(1, int(len(items)*fraction))):
+            with open(joinpath(self.dir, item), 'ab') as f:
+                f.write(self._content(64))
+
+    def generate(self):
+        o = self.opts
+        self.git('init', '-q')
+        self.git('config', 'user.name', 'bench')
+        self.git('config', 'user.email', 'bench@localhost')
+        self.git('config', 'fit.datastore.moduleName', 'localstore')
+        self.fit()
+
+        dirs = ['/'.join('d%d'%self.rand.randrange(o.width) for i in range(self.rand.randint(0, o.depth))) for d in range(o.dirs)]
+        for n in range(o.items):
+            d = self.rand.choice(dirs)
+            self.items.append((d + '/' if d else '') + 'item%06d.bin'%n)
+        for d in set(dirs):
+            if d and not exists(joinpath(self.dir, d)):
+                makedirs(joinpath(self.dir, d))
+
+        # files tracked by git next to the items
+        for n in range(o.items // 4):
+            d = self.rand.choice(dirs)
+            with open(joinpath(self.dir, d, 'other%06d.txt'%n), 'w') as f:
+                f.write('%0100x\n'%self.rand.getrandbits(400))
+
+        if o.layout == 'root':
+            with open(joinpath(self.dir, '.gitattributes'), 'w') as f:
+                f.write('*.bin fit\n')
+        else:
+            for d in set(dirs):
+                with open(joinpath(self.dir, d, '.gitattributes'), 'w') as f:
+                    f.write('*.bin fit\n')
+        with open(joinpath(self.dir, '.gitignore'), 'w') as f:
+            f.write('*.bin\n' if o.ignored else '*.tmp\n')
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'attributes')
+
+        for item in self.items:
+            self.writeItem(item)
+
+    def run(self):
+        self.generate()
+
+        self.timed('status (new items)', self.fit)
+        self.timed('save', self.fit, 'save')
+        self.timed('commit', self.git, 'commit', '-q', '-m', 'items')
+        self.timed('put', self.fit, 'put')
+        self.timed('status (clean)', self.fit)
+        self.timed('status (path)', self.fit, dirname(self.items[0]) or self.items[0])
+
+        self.modifyItems(0.1)
+        self.timed('restore', self.fit, 'restore')
+
+        # get everything back from the store into an empty cache, in place of
+        # empty stubs
+        objectsDir = joinpath(self.dir, '.git', 'fit', 'cache', 'objects')
+        rmtree(objectsDir)
+        makedirs(objectsDir)
+        remove(joinpath(self.dir, '.git', 'fit', 'cache', 'cache.db'))
+        for item in self.items:
+            open(joinpath(self.dir, item), 'wb').close()
+        self.timed('get', self.fit, 'get')
+
+        # branches that change different items, to be switched between and merged
+        half = len(self.items)//2
+        self.git('checkout', '-q', '-b', 'other')
+        self.modifyItems(0.2, self.items[:half])
+        self.fit('save')
+        self.git('commit', '-q', '-m', 'other')
+        self.git('checkout', '-q', '-')
+        self.modifyItems(0.2, self.items[half:])
+        self.fit('save')
+        self.git('commit', '-q', '-m', 'mine')
+        self.timed('checkout (post-checkout)', self.git, 'checkout', '-q', 'other')
+        self.git('checkout', '-q', '-')
+        self.timed('merge (merge driver)', self.git, 'merge', '-q', '--no-edit', 'other')
+
+        return self.times
+
+    def close(self):
+        rmtree(self.dir)
+
+def measure(opts):
+    # hooks and the merge driver run git-fit from the PATH
+    binDir = mkdtemp()
+    try:
+        wrapper = joinpath(binDir, 'git-fit')
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'%(sys.executable, gitFit))
+        chmod(wrapper, 0755)
+
+        runs = []
+        for r in range(opts.runs):
+            scenario = Scenario(opts, binDir)
+            try:
+                runs.append(scenario.run())
+            finally:
+                scenario.close()
+    finally:
+        rmtree(binDir)
+
+    results = {}
+    for step in STEPS:
+        times = sorted(t[step] for t in runs)
+        results[step] = {'min': times[0], 'median': times[len(times)//2]}
+    return results
+
+def getRevision():
+    p = popen('git describe --always --dirty'.split(), cwd=packageDir, stdout=PIPE, stderr=open(devnull, 'wb'))
+    return p.communicate()[0].strip() or None
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure git-fit commands in a synthetic repository.')
+    parser.add_argument('--items', type=int, default=1000, help='number of fit items')
+    parser.add_argument('--min-size', type=int, default=1024, help='smallest item size in bytes')
+    parser.add_argument('--max-size', type=int, default=262144, help='largest item size in bytes')
+    parser.add_argument('--dirs', type=int, default=50, help='number of directories to spread the items over')
+    parser.add_argument('--depth', type=int, default=4, help='deepest directory level')
+    parser.add_argument('--width', type=int, default=4, help='number of directory names per level')
+    parser.add_argument('--layout', choices=('root', 'nested'), default='root', help='one .gitattributes at the root, or one per directory')
+    parser.add_argument('--ignored', action='store_true', help='gitignore the fit items')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    opts = parser.parse_args()
+
+    params = {k: v for k,v in vars(opts).iteritems() if k not in ('output', 'compare')}
+    report = {'revision': getRevision(), 'params': params, 'results': measure(opts)}
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(dumps(report, indent=2, sort_keys=True))
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = load(f)
+        if baseline['params'] != params:
+            print 'warning: The results to compare with were measured with different parameters.'
+
+    results = report['results']
+    for step in STEPS:
+        line = '%-26s  median %8.1f ms   min %8.1f ms'%(step, results[step]['median']*1000, results[step]['min']*1000)
+        if baseline and step in baseline['results']:
+            line += '   %+6.1f%%'%((results[step]['median']/baseline['results'][step]['median'] - 1)*100)
+        print line
@@ -0,0 +1,32 @@
+from os import environ
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# Helpers for the set up of tests, which undo what they did once the test is done
+# (through addCleanup, so there is no need for a tearDown)
+
+# Returns a new temp directory, which is removed again
+def tempDir(testCase):
+    dirPath = mkdtemp()
+    testCase.addCleanup(rmtree, dirPath, True)
+    return dirPath
+
+# Sets the given attributes of target (usually a module), which are set back again
+def patch(testCase, target, **attributes):
+    for name, value in attributes.iteritems():
+        testCase.addCleanup(setattr, target, name, getattr(target, name))
+        setattr(target, name, value)
+
+# Sets the given environment variables (or removes those given as None), which are
+# set back again
+def patchEnviron(testCase, **variables):
+    for name, value in variables.iteritems():
+        old = environ.get(name)
+        testCase.addCleanup(_setEnviron, name, old)
+        _setEnviron(name, value)
+
+def _setEnviron(name, value):
+    if value is None:
+        environ.pop(name, None)
+    else:
+        environ[name] = value
@@ -0,0 +1,28 @@
+import unittest
+
+from . import patch, tempDir
+from fitlib import attributes
+from os import path
+
+class TestAttributeCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.key = 'k1'
+        self.checked = []
+        patch(self, attributes, _cacheFile=lambda: path.join(self.dir, 'attributes'),
+            getAttributesKey=lambda: self.key, checkFit=self.checkFit)
+
+    def checkFit(self, paths):
+        self.checked.append(sorted(paths))
+        return {p: p.endswith('.bin') for p in paths}
+
+    def testOnlyNewPathsAreChecked(self):
+        self.assertEqual({'a.bin'}, attributes.filterFitPaths(['a.bin', 'a.txt']))
+        self.assertEqual({'a.bin', 'b.bin'}, attributes.filterFitPaths(['a.bin', 'a.txt', 'b.bin']))
+        self.assertEqual([['a.bin', 'a.txt'], ['b.bin']], self.checked)
+
+    def testChangedAttributesInvalidateCache(self):
+        attributes.filterFitPaths(['a.bin'])
+        self.key = 'k2'
+        attributes.filterFitPaths(['a.bin'])
+        self.assertEqual([['a.bin'], ['a.bin']], self.checked)
@@ -0,0 +1,127 @@
+import unittest
+
+from . import patch, tempDir
+from fitlib import cache, compression
+from fitlib.hashes import blobHeader
+from hashlib import sha1
+from json import dump
+from os import makedirs, path, stat, chmod, utime
+from StringIO import StringIO
+import sys
+
+class _Repo:
+    pass
+
+def key(n):
+    return '%040x'%n
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        repo = _Repo()
+        repo.objectsDir = path.join(self.dir, 'objects')
+        repo.lruFile = path.join(self.dir, 'lru')
+        repo.cacheDbFile = path.join(self.dir, 'cache.db')
+        patch(self, cache, repo=repo, _materializeMode=['copy'])
+        patch(self, compression, _settings={'cache': False, 'codec': ('none', 0)})
+        self.files = 0
+
+    # Returns a new file with the given contents, to be put into the cache
+    def file(self, data):
+        self.files += 1
+        filePath = path.join(self.dir, 'file%d'%self.files)
+        with open(filePath, 'wb') as f:
+            f.write(data)
+        return filePath
+
+    def insert(self, sizes, inLru=False):
+        return cache.insert({k: (s, self.file('x'*s)) for k,s in sizes.iteritems()}, inLru=inLru)
+
+    def testMigratesLruFile(self):
+        with open(cache.repo.lruFile, 'w') as f:
+            dump({
+                'lru': {'items': {key(1): [10, 2], key(2): [20, 1]}, 'size': 30, 'count': 2},
+                'map': {'items': {key(3): [5, True], key(4): [7, False]}, 'size': 12},
+            }, f)
+        makedirs(path.dirname(cache.objectPath(key(1))))
+        for k in (key(1), key(2)):
+            open(cache.objectPath(k), 'wb').close()
+
+        self.assertEqual((30, 12), cache.size())
+        self.assertFalse(path.exists(cache.repo.lruFile))
+        self.assertEqual({key(3)}, cache.getCommittedObjects())
+        self.assertEqual(10, cache.prune(20))
+        self.assertEqual({key(1)}, set(cache.find([key(1), key(2)], update=False)))
+
+    def testInsertCommitAndDeleteKeepTotals(self):
+        inserted, inOther, lruSize, mapSize = self.insert({key(1): 10, key(2): 20})
+        self.assertEqual((0, 30), (lruSize, mapSize))
+        self.assertEqual({key(1): 10}, cache.commit([key(1)]))
+        self.assertEqual({}, cache.commit([key(1)]))
+        self.assertEqual({key(1)}, cache.getCommittedObjects())
+
+        self.assertEqual(({key(2): 20}, 0, 10), cache.delete([key(1), key(2)]))
+        self.assertFalse(path.exists(cache.objectPath(key(2))))
+        self.assertEqual(({key(1): 10}, 0, 0), cache.delete([key(1)], commits=True))
+
+        self.insert({key(3): 5, key(4): 6}, inLru=True)
+        self.insert({key(3): 5})
+        self.assertEqual((11, 0), cache.size())
+        self.insert({key(5): 7})
+        cache.enque([key(5)])
+        self.assertEqual((18, 0), cache.size())
+
+    def testPruneEvictsLeastRecentlyUsedFirst(self):
+        for n in range(1, 5):
+            self.insert({key(n): 10}, inLru=True)
+        cache.find([key(1)])
+        cache.find([key(3)])
+        self.assertEqual(20, cache.prune(25))
+        self.assertEqual({key(1), key(3)}, set(cache.find([key(n) for n in range(1, 5)])))
+        self.assertFalse(path.exists(cache.objectPath(key(2))))
+        self.assertFalse(path.exists(cache.objectPath(key(4))))
+
+    # Adopts a file with the given contents into the cache (as a download would be),
+    # and materializes it at a new path in the given mode
+    def materialize(self, mode, data='contents'):
+        cache._materializeMode[0] = mode
+        k = sha1(blobHeader(len(data)) + data).hexdigest()
+        downloaded = self.file(data)
+        chmod(downloaded, 0600)
+        cache.insert({k: (len(data), downloaded)}, inLru=True, adopt=True)
+        item = path.join(self.dir, 'item')
+        cache.materialize(cache.objectPath(k), item)
+        self.assertEqual(data, open(item, 'rb').read())
+        return k, item
+
+    def testMaterializeCopies(self):
+        k, item = self.materialize('copy')
+        self.assertNotEqual(stat(item).st_ino, stat(cache.objectPath(k)).st_ino)
+        self.assertEqual(cache._FILE_MODE, stat(cache.objectPath(k)).st_mode & 0777)
+
+    def testMaterializeLinksReadOnly(self):
+        k, item = self.materialize('hardlink')
+        self.assertEqual(stat(item).st_ino, stat(cache.objectPath(k)).st_ino)
+        self.assertEqual(cache._FILE_MODE & 0444, stat(item).st_mode & 0777)
+
+    def testMaterializeCopiesWithoutReflinks(self):
+        patch(self, cache, _reflink=lambda src, dst: False)
+        k, item = self.materialize('reflink')
+        self.assertNotEqual(stat(item).st_ino, stat(cache.objectPath(k)).st_ino)
+
+    def testObjectsModifiedThroughLinksAreDropped(self):
+        patch(self, sys, stdout=StringIO())
+        k, item = self.materialize('hardlink')
+        chmod(item, 0644)
+        with open(item, 'r+b') as f:
+            f.write('C')
+        self.assertEqual({}, cache.find([k]))
+        self.assertFalse(path.exists(cache.objectPath(k)))
+        self.assertEqual((0, 0), cache.size())
+        self.assertTrue(sys.stdout.getvalue().startswith('warning:'))
+
+    def testObjectsTouchedThroughLinksAreKept(self):
+        k, item = self.materialize('hardlink')
+        utime(item, (1000, 1000))
+        self.assertEqual([k], cache.find([k]).keys())
+        self.assertEqual([k], cache.find([k]).keys())
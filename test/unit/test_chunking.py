@@ -0,0 +1,124 @@
+import unittest
+
+from . import patch, tempDir
+from fitlib import chunking, compression
+from fitlib.hashes import blobHeader
+from hashlib import sha1
+from random import Random
+import os
+
+# A store that keeps its objects in memory, and counts what is put and got
+class _Store:
+    def __init__(self):
+        self.objects = {}
+        self.puts = self.gets = 0
+
+    def checkMany(self, keys):
+        return dict((k, k) for k in keys if k in self.objects)
+
+    def putMany(self, items):
+        for src, dst, size in items:
+            self.objects[dst] = open(src, 'rb').read()
+            self.puts += 1
+        return [True]*len(items)
+
+    def getMany(self, items):
+        for key, out, size in items:
+            out.write(self.objects[key])
+            self.gets += 1
+        return [True]*len(items)
+
+# Stands in for the cache module, with no cached chunks
+class _Cache:
+    def __init__(self):
+        self.chunks = {}
+
+    def addChunks(self, key, chunks):
+        self.chunks[key] = chunks
+
+    def findChunks(self, chunkHashes):
+        return {}
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        rand = Random(42)
+        self.content = ''.join(chr(rand.randrange(256)) for i in xrange(200000))
+
+    def chunk(self, blocks):
+        return list(chunking.iterChunks(blocks, 4096))
+
+    def testAnchorRunsAreSkipped(self):
+        content = self.content[:50000] + chunking._ANCHOR*100000 + self.content[50000:]
+        chunks = self.chunk([content])
+        self.assertEqual(content, ''.join(chunks))
+        self.assertTrue(all(len(c) <= 16384 for c in chunks))
+
+    def testChunksCoverContents(self):
+        chunks = self.chunk([self.content])
+        self.assertEqual(self.content, ''.join(chunks))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(1024 <= len(c) <= 16384 for c in chunks[:-1]))
+
+    def testChunksDoNotDependOnBlocks(self):
+        blocks = [self.content[i:i+777] for i in range(0, len(self.content), 777)]
+        self.assertEqual(self.chunk([self.content]), self.chunk(blocks))
+
+    def testInsertionChangesFewChunks(self):
+        before = self.chunk([self.content])
+        after = self.chunk([self.content[:100000] + 'inserted' + self.content[100000:]])
+        self.assertTrue(len(set(after) - set(before)) <= 2)
+
+    def testManifestRoundTrip(self):
+        filePath = os.path.join(tempDir(self), 'manifest')
+        chunks = [('%040x'%(i*7919), i*100, 100) for i in range(5)]
+        chunking.writeManifest(filePath, 500, chunks)
+        decoder = compression.Decoder()
+        decoder.feed(open(filePath, 'rb').read())
+        self.assertEqual(compression.CHUNKED, decoder.codec)
+        self.assertEqual(chunks, chunking.readManifest(filePath))
+
+class TestChunkedTransfer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.tempFiles = 0
+        patch(self, chunking, cache=_Cache(), getChunkSize=lambda: 4096)
+
+        # Contents with a repeated part, so that some chunks occur twice
+        rand = Random(7)
+        part = ''.join(chr(rand.randrange(256)) for i in xrange(60000))
+        self.content = part + ''.join(chr(rand.randrange(256)) for i in xrange(30000)) + part
+        self.objPath = self.file('object', self.content)
+        self.objHash = sha1(blobHeader(len(self.content)) + self.content).hexdigest()
+
+    def file(self, name, data=''):
+        filePath = os.path.join(self.dir, name)
+        with open(filePath, 'wb') as f:
+            f.write(data)
+        return filePath
+
+    def newTempFile(self):
+        self.tempFiles += 1
+        return self.file('temp%d'%self.tempFiles)
+
+    def put(self, store):
+        return chunking.putChunked(store, self.objPath, 'obj', self.objHash, len(self.content), lambda f: f, self.newTempFile)
+
+    def testRoundTrip(self):
+        store = _Store()
+        self.assertTrue(self.put(store))
+        chunks = chunking.cache.chunks[self.objHash]
+        self.assertEqual(len(set(h for h,o,l in chunks)) + 1, store.puts)
+
+        manifest = self.file('manifest', store.objects['obj'])
+        outPath = os.path.join(self.dir, 'out')
+        self.assertTrue(chunking.getChunked(store, manifest, self.objHash, len(self.content), outPath, self.newTempFile))
+        self.assertEqual(self.content, open(outPath, 'rb').read())
+        self.assertEqual(store.puts - 1, store.gets)
+        self.assertEqual(['manifest', 'object', 'out'], sorted(f for f in os.listdir(self.dir)))
+
+    def testExistingChunksAreNotPutAgain(self):
+        store = _Store()
+        self.assertTrue(self.put(store))
+        puts = store.puts
+        self.assertTrue(self.put(store))
+        self.assertEqual(puts + 1, store.puts)
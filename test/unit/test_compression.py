@@ -0,0 +1,44 @@
+import unittest
+
+from . import tempDir
+from fitlib import compression
+import os
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.files = 0
+
+    def makeFile(self, content=''):
+        self.files += 1
+        filePath = os.path.join(self.dir, 'file%d'%self.files)
+        with open(filePath, 'wb') as f:
+            f.write(content)
+        return filePath
+
+    def roundTrip(self, content, codec):
+        raw, framed, decoded = self.makeFile(content), self.makeFile(), self.makeFile()
+        compression.compressFile(raw, framed, codec)
+        self.assertTrue(compression.isFramed(framed))
+        compression.decompressFile(framed, decoded)
+        self.assertEqual(content, open(decoded, 'rb').read())
+        return open(framed, 'rb').read()
+
+    def testCodecs(self):
+        content = 'fit object ' * 10000
+        for codec in ('none', 'zlib', 'bz2'):
+            framed = self.roundTrip(content, codec)
+            if codec != 'none':
+                self.assertTrue(len(framed) < len(content), codec)
+
+    def testRawStartingWithMagic(self):
+        content = compression.MAGIC + 'raw contents'
+        self.roundTrip(content, 'none')
+
+    def testDecoderPieces(self):
+        content = os.urandom(5000)
+        framed = self.roundTrip(content, 'zlib')
+        for data in (framed, content, content[:3]):
+            decoder = compression.Decoder()
+            decoded = ''.join(decoder.feed(data[i:i+7]) for i in range(0, len(data), 7)) + decoder.flush()
+            self.assertEqual(content if data != content[:3] else content[:3], decoded)
@@ -1,2 +1,48 @@
 import unittest
 
+import fitlib
+from . import patch, patchEnviron, tempDir
+from os import path
+from subprocess import check_call
+
+class TestRepoContext(unittest.TestCase):
+    def testResolvedLazilyFromEnvironment(self):
+        patchEnviron(self, GIT_DIR='/some/repo/.git', GIT_WORK_TREE='/some/repo')
+        repo = fitlib._RepoContext()
+        self.assertFalse('repoDir' in repo.__dict__)
+        self.assertEqual('/some/repo', repo.repoDir)
+        self.assertEqual('/some/repo/.git/fit/cache/objects', repo.objectsDir)
+        self.assertEqual('/some/repo/.fit', repo.fitFile)
+
+    def testResolvedWithGit(self):
+        patchEnviron(self, GIT_DIR=None, GIT_WORK_TREE=None)
+        repo = fitlib._RepoContext()
+        self.assertTrue(path.isdir(repo.gitDir))
+        self.assertEqual(path.join(repo.gitDir, 'fit'), repo.fitDir)
+        self.assertRaises(AttributeError, getattr, repo, 'noSuchPath')
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        check_call(['git', 'init', '-q', self.dir])
+        patchEnviron(self, GIT_DIR=path.join(self.dir, '.git'))
+        patch(self, fitlib, _config=None)
+        for key, value in (('fit.transfer.s3store.maxJobs', '3'), ('fit.scan.prune', 'off'), ('core.fsmonitor', 'hook')):
+            check_call(['git', 'config', key, value])
+        with open(path.join(self.dir, '.git', 'config'), 'a') as f:
+            f.write('[fit]\n\tflag\n\tempty =\n')
+
+    def testSettingsAreReadOnce(self):
+        self.assertEqual('3', fitlib.getConfig('fit.transfer.s3store.maxJobs'))
+        check_call(['git', 'config', 'fit.transfer.s3store.maxJobs', '5'])
+        self.assertEqual(3, fitlib.getConfigInt('FIT.transfer.s3store.MAXJOBS'))
+        self.assertEqual(None, fitlib.getConfig('fit.transfer.S3store.maxJobs'))
+        self.assertEqual('hook', fitlib.getConfig('core.fsmonitor'))
+
+    def testValues(self):
+        self.assertFalse(fitlib.getConfigBool('fit.scan.prune', True))
+        self.assertTrue(fitlib.getConfigBool('fit.flag'))
+        self.assertFalse(fitlib.getConfigBool('fit.empty', True))
+        self.assertTrue(fitlib.getConfigBool('fit.missing', True))
+        self.assertEqual('default', fitlib.getConfig('fit.empty', 'default'))
+        self.assertEqual('default', fitlib.getConfig('fit.flag', 'default'))
@@ -0,0 +1,43 @@
+import unittest
+
+from . import patch, tempDir
+from fitlib import fsmonitor
+from os import path, chmod
+
+class TestFsmonitor(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.statFile = path.join(self.dir, 'stat')
+        self.hook = path.join(self.dir, 'hook')
+        patch(self, fsmonitor, getHook=lambda: self.hook, getConfigInt=lambda key, default=0: 2)
+
+    def setHookOutput(self, output):
+        with open(self.hook, 'w') as f:
+            f.write("#!/bin/sh\nprintf '%s'\n"%output.replace('\0', '\\0'))
+        chmod(self.hook, 0755)
+
+    def testChangedPathsIncludeDirectories(self):
+        changed = fsmonitor.ChangedPaths(['a/b/', 'c/d.bin'])
+        self.assertTrue('a/b/e/f.bin' in changed)
+        self.assertTrue('c/d.bin' in changed)
+        self.assertFalse('c/e.bin' in changed)
+        self.assertFalse('a/bc.bin' in changed)
+
+    def testFirstQueryNeedsFullScan(self):
+        self.setHookOutput('t1\0/\0')
+        token, changed = fsmonitor.query(self.statFile)
+        self.assertEqual('2:t1', token)
+        self.assertEqual(None, changed)
+
+    def testQueryWithToken(self):
+        fsmonitor.saveToken(self.statFile, '2:t1')
+        self.setHookOutput('t2\0x/y.bin\0')
+        token, changed = fsmonitor.query(self.statFile)
+        self.assertEqual('2:t2', token)
+        self.assertTrue('x/y.bin' in changed)
+        self.assertEqual(1, len(changed))
+
+    def testInvalidTokenNeedsFullScan(self):
+        fsmonitor.saveToken(self.statFile, '2:t1')
+        self.setHookOutput('t2\0/\0')
+        self.assertEqual(None, fsmonitor.query(self.statFile)[1])
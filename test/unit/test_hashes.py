@@ -0,0 +1,48 @@
+import unittest
+
+from . import tempDir
+from fitlib import hashes
+from subprocess import Popen as popen, PIPE
+import os
+
+def gitHash(filePath):
+    return popen(['git', 'hash-object', '--no-filters', filePath], stdout=PIPE).communicate()[0].strip()
+
+class TestHashFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.files = 0
+
+    def makeFile(self, content):
+        self.files += 1
+        filePath = os.path.join(self.dir, 'file%d'%self.files)
+        with open(filePath, 'wb') as f:
+            f.write(content)
+        return filePath
+
+    def testEmpty(self):
+        filePath = self.makeFile('')
+        self.assertEqual(gitHash(filePath), hashes.hashFile(filePath))
+
+    def testSmall(self):
+        filePath = self.makeFile('\0binary file\n')
+        self.assertEqual(gitHash(filePath), hashes.hashFile(filePath))
+
+    def testMapped(self):
+        filePath = self.makeFile(os.urandom(hashes.MMAP_MIN_SIZE + 12345))
+        self.assertEqual(gitHash(filePath), hashes.hashFile(filePath))
+
+    def testPoolKeepsOrder(self):
+        files = [self.makeFile(os.urandom(100*i)) for i in range(20)]
+        self.assertEqual([gitHash(f) for f in files], list(hashes.iterHashes(files, 4)))
+        self.assertEqual([gitHash(f) for f in files], list(hashes.iterHashes(files, 1)))
+
+    def testBlobWriterContinuesAtOffset(self):
+        content = os.urandom(50000)
+        filePath = self.makeFile(content[:20000] + 'garbage beyond the offset')
+        writer = hashes.BlobWriter(filePath, len(content), offset=20000)
+        self.assertEqual(20000, writer.tell())
+        writer.write(content[20000:])
+        writer.close()
+        self.assertEqual(content, open(filePath, 'rb').read())
+        self.assertEqual(gitHash(filePath), writer.hexdigest())
@@ -0,0 +1,30 @@
+import unittest
+
+from fitlib import manifest
+from StringIO import StringIO
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.fitData = {'dir/file%05d.bin'%i: ['%040x'%(i*7919), i*1000] for i in range(10000)}
+        self.fitData['big.bin'] = ['f'*40, 2**40]
+
+    def encode(self, fitData):
+        f = StringIO()
+        manifest.write(fitData, f)
+        return f.getvalue()
+
+    def testRoundTrip(self):
+        data = self.encode(self.fitData)
+        self.assertTrue(manifest.isManifest(data))
+        self.assertEqual(self.fitData, manifest.read(StringIO(data)))
+
+    def testItemsAreSorted(self):
+        paths = [p for p,h,s in manifest.iterItems(StringIO(self.encode(self.fitData)))]
+        self.assertEqual(sorted(self.fitData), paths)
+
+    def testEmpty(self):
+        self.assertEqual({}, manifest.read(StringIO(self.encode({}))))
+
+    def testTruncated(self):
+        data = self.encode(self.fitData)
+        self.assertRaises(IOError, manifest.read, StringIO(data[:len(data)/2]))
@@ -0,0 +1,41 @@
+import unittest
+
+from . import patch, tempDir
+from fitlib import manifestcache
+from os import path, utime
+
+class _Repo:
+    pass
+
+class TestManifestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        patch(self, manifestcache, repo=_Repo(), _cacheSize=2)
+        manifestcache.repo.manifestsDir = path.join(self.dir, 'manifests')
+
+    def setTime(self, blobId, t):
+        utime(manifestcache._cacheFile(blobId), (t, t))
+
+    def testRoundTrip(self):
+        fitData = {'a.bin': ['1'*40, 10], u'b\xe9.bin': ['2'*40, 2**40]}
+        self.assertEqual(None, manifestcache.get('a'*40))
+        manifestcache.put('a'*40, fitData)
+        self.assertEqual(fitData, manifestcache.get('a'*40))
+        self.assertEqual(sorted(fitData), manifestcache.get('a'*40).pathIndex().paths)
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        manifestcache.put('a'*40, {})
+        manifestcache.put('b'*40, {})
+        self.setTime('a'*40, 1000)
+        self.setTime('b'*40, 2000)
+        manifestcache.get('a'*40)
+        manifestcache.put('c'*40, {})
+        self.assertEqual({}, manifestcache.get('a'*40))
+        self.assertEqual(None, manifestcache.get('b'*40))
+        self.assertEqual({}, manifestcache.get('c'*40))
+
+    def testDisabled(self):
+        manifestcache._cacheSize = 0
+        manifestcache.put('a'*40, {})
+        self.assertEqual(None, manifestcache.get('a'*40))
+        self.assertFalse(path.exists(manifestcache.repo.manifestsDir))
@@ -1,2 +1,142 @@
 import unittest
 
+from . import patch
+from fitlib import objects
+from threading import current_thread
+import time
+
+class _Store:
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class TestTransferPool(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+
+    def runPool(self, jobs, items, transferItem):
+        created = []
+        def storeFactory():
+            created.append(_Store())
+            return created[-1]
+        pool = objects._TransferPool(storeFactory(), storeFactory, jobs)
+        results = pool.map(lambda store, batch: [transferItem(store, i) for i in batch], items)
+        pool.close()
+        self.assertTrue(all(s.closed for s in created), '\n\nerror: not all stores were closed')
+        return results, created
+
+    def testSerialRunsInCallingThread(self):
+        threads = set()
+        def transferItem(store, item):
+            threads.add(current_thread())
+            return True
+        results, stores = self.runPool(1, range(10), transferItem)
+        self.assertEqual([True]*10, results)
+        self.assertEqual({current_thread()}, threads)
+        self.assertEqual(1, len(stores))
+
+    def testResultsKeepItemOrder(self):
+        results, stores = self.runPool(4, range(50), lambda store, i: i % 3 == 0)
+        self.assertEqual([i % 3 == 0 for i in range(50)], results)
+        self.assertTrue(1 <= len(stores) <= 4)
+
+    def testStoreThatCannotBeOpenedLeavesBatchesToOthers(self):
+        calls = []
+        def storeFactory():
+            calls.append(None)
+            if len(calls) == 2:
+                # the other workers finish meanwhile
+                time.sleep(0.2)
+                raise Exception('cannot connect')
+            return _Store()
+        def transferBatch(store, batch):
+            time.sleep(0.01)
+            return [True for i in batch]
+        pool = objects._TransferPool(storeFactory(), storeFactory, 2)
+        self.assertEqual([True]*10, pool.map(transferBatch, range(10)))
+        self.assertEqual(2, len(calls))
+
+    def testExceptionsAreFailures(self):
+        def transferItem(store, item):
+            if item == 2:
+                raise Exception('transfer failed')
+            return True
+        results, stores = self.runPool(3, range(5), transferItem)
+        self.assertEqual([True, True, False, True, True], results)
+
+    def testBatches(self):
+        batches = []
+        class BatchStore(_Store):
+            batchSize = 4
+        def transferBatch(store, batch):
+            batches.append(list(batch))
+            return [i != 5 for i in batch]
+        pool = objects._TransferPool(BatchStore(), BatchStore, 1)
+        results = pool.map(transferBatch, range(10))
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]], batches)
+        self.assertEqual([i != 5 for i in range(10)], results)
+
+    def testEmpty(self):
+        results, stores = self.runPool(4, [], lambda store, i: True)
+        self.assertEqual([], results)
+
+    def testRetries(self):
+        attempts = {}
+        def transferBatch(store, batch):
+            for i in batch:
+                attempts[i] = attempts.get(i, 0) + 1
+            return [i != 3 or attempts[i] > 2 for i in batch]
+        pool = objects._TransferPool(_Store(), _Store, 2, retries=2)
+        self.assertEqual([True]*6, pool.map(transferBatch, range(6)))
+        self.assertEqual(3, attempts[3])
+
+class TestWindow(unittest.TestCase):
+    # throughput is not steady enough in here to be compared
+    def setUp(self):
+        patch(self, objects, THROUGHPUT_TOLERANCE=0)
+
+    def complete(self, window, n, ok=True):
+        for i in range(n):
+            window.acquire()
+            window.release(ok, 1000)
+
+    def testLimits(self):
+        window = objects._Window(4, 2, 6)
+        self.complete(window, 100)
+        self.assertEqual(6, window.size)
+        self.complete(window, 10, ok=False)
+        self.assertEqual(2, window.size)
+
+    def testSlowBatchHalvesWindow(self):
+        window = objects._Window(4, 1, 16)
+        window.lastRate = 4000.
+        window.acquire()
+        window.release(True, 1000, 1.5)
+        self.assertEqual(4, window.size)
+        window.acquire()
+        window.release(True, 1000, 10)
+        self.assertEqual(2, window.size)
+
+    def testFailureHalvesWindow(self):
+        window = objects._Window(8, 1, 16)
+        self.complete(window, 1, ok=False)
+        self.assertEqual(4, window.size)
+        self.complete(window, 4)
+        self.assertEqual(5, window.size)
+
+class TestTransferLimits(unittest.TestCase):
+    def setUp(self):
+        self.config = {}
+        patch(self, objects, getConfig=lambda key, default=None: self.config.get(key, default),
+            getConfigInt=lambda key, default=0: int(self.config.get(key, default)))
+
+    def testDefaultsAdapt(self):
+        self.assertEqual((4, 1, 16), objects.getTransferLimits('rsync'))
+
+    def testJobsStayFixed(self):
+        self.config['fit.transfer.jobs'] = '1'
+        self.assertEqual((1, 1, 1), objects.getTransferLimits('rsync'))
+        self.config['fit.transfer.rsync.maxJobs'] = '8'
+        self.assertEqual((1, 1, 8), objects.getTransferLimits('rsync'))
+        self.assertEqual((1, 1, 1), objects.getTransferLimits('s3store'))
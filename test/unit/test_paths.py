@@ -1,2 +1,37 @@
 import unittest
 
+from fitlib.paths import PathIndex, FitData, getPathIndex, getValidFitPaths
+
+class TestPaths(unittest.TestCase):
+    def setUp(self):
+        self.available = ['a/b/c.bin', 'a/b/d.bin', 'a/b-c.bin', 'a/b0.bin', 'a/bc/e.bin', 'f.bin']
+
+    def testFind(self):
+        index = PathIndex(self.available)
+        self.assertEqual(['a/b/c.bin', 'a/b/d.bin'], index.find('a/b'))
+        self.assertEqual(['a/b-c.bin'], index.find('a/b-c.bin'))
+        self.assertEqual(sorted(self.available[:5]), index.find('a'))
+        self.assertEqual([], index.find('a/x'))
+        self.assertTrue('f.bin' in index)
+        self.assertFalse('a' in index)
+
+    def testValidFitPaths(self):
+        self.assertEqual({'a/b/c.bin', 'a/b/d.bin', 'f.bin'}, getValidFitPaths(['a/b', 'f.bin', 'x'], self.available, '/r', '/r'))
+        self.assertEqual({'a/bc/e.bin'}, getValidFitPaths(['bc'], self.available, '/r', '/r/a'))
+        self.assertEqual(set(self.available), getValidFitPaths(['.'], self.available, '/r', '/r'))
+        self.assertEqual(None, getValidFitPaths([], self.available))
+
+    def testValidFitPathsWithExtraPaths(self):
+        index = PathIndex(self.available)
+        extra = ['a/b/new.bin', 'a/bnew.bin', 'g.bin']
+        self.assertEqual({'a/b/c.bin', 'a/b/d.bin', 'a/b/new.bin', 'g.bin'}, getValidFitPaths(['a/b', 'g.bin'], index, '/r', '/r', extra))
+        self.assertEqual(set(self.available + extra), getValidFitPaths(['.'], index, '/r', '/r', extra))
+
+    def testFitDataIndexIsBuiltOnce(self):
+        fitData = FitData((p, ['0'*40, 1]) for p in self.available)
+        index = getPathIndex(fitData)
+        self.assertTrue(index is getPathIndex(fitData))
+        fitData['a/b/x.bin'] = ['1'*40, 2]
+        self.assertEqual(['a/b/c.bin', 'a/b/d.bin', 'a/b/x.bin'], getPathIndex(fitData).find('a/b'))
+        del fitData['a/b/c.bin']
+        self.assertEqual(['a/b/d.bin', 'a/b/x.bin'], getPathIndex(fitData).find('a/b'))
@@ -0,0 +1,73 @@
+import unittest
+import sys
+
+from . import tempDir
+from os import path, makedirs
+from tempfile import mkdtemp
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), 'stores'))
+import rsync
+
+class _Out:
+    def __init__(self, name):
+        self.name = name
+
+class _Store(rsync.Store):
+    # without reading the location from git config
+    def __init__(self, location, storeDir):
+        self.location = location
+        self.progress = None
+        self.dir = storeDir
+
+class TestRsyncStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        # the store removes its own directory
+        self.store = _Store('host:/store', mkdtemp())
+
+    # Has _rsync print the given lines, after calling received(cwd), and exit
+    # with the given status
+    def fakeRsync(self, lines, ok, received=None):
+        calls = []
+        def run(args, paths, onLine, cwd=None, quiet=False):
+            calls.append(list(paths))
+            received and received(cwd)
+            for l in lines:
+                onLine(l)
+            return ok
+        self.store._rsync = run
+        return calls
+
+    def writeFile(self, filePath, data):
+        if not path.exists(path.dirname(filePath)):
+            makedirs(path.dirname(filePath))
+        with open(filePath, 'wb') as f:
+            f.write(data)
+
+    def testPutOnlyCountsLoggedFilesAfterFailure(self):
+        objects = path.join(self.dir, 'objects')
+        items = [(path.join(objects, k), k, 3) for k in ('ab/c1', 'ab/c2', 'cd/e3')]
+        for src, dst, size in items:
+            self.writeFile(src, 'abc')
+
+        calls = self.fakeRsync(['0 ab/', '3 ab/c1', '0 cd/'], False)
+        self.assertEqual([True, False, False], self.store.putMany(items))
+        self.assertEqual([['ab/c1', 'ab/c2', 'cd/e3']], calls)
+
+        self.fakeRsync([], True)
+        self.assertEqual([True, True, True], self.store.putMany(items))
+
+    def testInterruptedDownloadsAreKept(self):
+        outs = [_Out(path.join(self.dir, n)) for n in ('1.part', '2.part')]
+        self.writeFile(outs[0].name, '')
+        self.writeFile(outs[1].name, 'ab')
+
+        def received(cwd):
+            self.assertEqual('ab', open(path.join(cwd, 'cd/e2')).read())
+            self.writeFile(path.join(cwd, 'ab/c1'), 'abc')
+            self.writeFile(path.join(cwd, 'cd/e2'), 'abcd')
+
+        self.fakeRsync(['3 ab/c1'], False, received)
+        items = [('host:/store/ab/c1', outs[0], 3), ('host:/store/cd/e2', outs[1], 6)]
+        self.assertEqual([True, False], self.store.getMany(items))
+        self.assertEqual('abc', open(outs[0].name).read())
+        self.assertEqual('abcd', open(outs[1].name).read())
@@ -0,0 +1,121 @@
+import unittest
+import sys
+
+from . import patch, tempDir
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.dirname(path.abspath(__file__)))), 'stores'))
+import s3store
+
+class TestParts(unittest.TestCase):
+    def transfer(self, ranges, transferPart, jobs=3):
+        buckets = []
+        done = []
+        progress = []
+        def acquireBucket():
+            buckets.append(object())
+            return buckets[-1]
+        s3store._transferParts(ranges, transferPart, jobs, lambda n, r: done.append((n, r)), progress.append,
+            acquireBucket, lambda b: buckets.remove(b))
+        self.assertEqual([], buckets, '\n\nerror: not all buckets were released')
+        return done, progress
+
+    def testPartRanges(self):
+        self.assertEqual([(0, 4), (4, 8), (8, 10)], s3store._partRanges(0, 10, 4))
+        self.assertEqual([(3, 7), (7, 8)], s3store._partRanges(3, 8, 4))
+        self.assertEqual([], s3store._partRanges(8, 8, 4))
+
+    def testPartsAreDoneInOrder(self):
+        def transferPart(bucket, n, (start, end), partProgress):
+            partProgress(1)
+            return n*10
+        ranges = s3store._partRanges(0, 100, 7)
+        done, progress = self.transfer(ranges, transferPart)
+        self.assertEqual([(n, n*10) for n in range(len(ranges))], done)
+        self.assertEqual(100, progress[-1])
+
+    def testFirstErrorIsRaised(self):
+        def transferPart(bucket, n, r, partProgress):
+            if n == 2:
+                raise IOError('part %d'%n)
+        with self.assertRaises(IOError):
+            self.transfer(s3store._partRanges(0, 100, 10), transferPart)
+
+class _Key:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def get_contents_to_file(self, f, headers, cb, num_cb):
+        start, end = (int(o) for o in headers['Range'][len('bytes='):].split('-'))
+        if start in self.bucket.failAt:
+            raise IOError('part at %d'%start)
+        f.write(self.bucket.data[start:end + 1])
+
+class _Bucket:
+    def __init__(self, data, failAt=()):
+        self.data = data
+        self.failAt = failAt
+        self.listed = []
+
+    def new_key(self, name):
+        return _Key(self, name)
+
+    def get_key(self, name):
+        return name in self.data and _Key(self, name)
+
+    def list(self, prefix):
+        self.listed.append(prefix)
+        return [_Key(self, k) for k in sorted(self.data) if k.startswith(prefix)]
+
+class _Store(s3store.Store):
+    # without a connection
+    def __init__(self):
+        self.progress = lambda done, size: None
+
+class TestGetParts(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        self.data = ''.join(chr(i % 256) for i in range(1000))
+        self.settings = {'partSize': 64, 'partJobs': 3}
+        patch(self, s3store, _idleBuckets=[])
+
+    def getParts(self, bucket, offset):
+        s3store._idleBuckets.extend(bucket for i in range(3))
+        out = open(path.join(self.dir, 'object'), 'wb')
+        out.write(self.data[:offset])
+        store = _Store()
+        key = bucket.new_key('ab/cdef')
+        key.size = len(self.data)
+        try:
+            store._getParts(key, out, offset, self.settings)
+        finally:
+            out.close()
+        return open(out.name, 'rb').read()
+
+    def testPartsAreWrittenAtTheirOffsets(self):
+        self.assertEqual(self.data, self.getParts(_Bucket(self.data), 100))
+
+    def testFailedDownloadKeepsPartsWithoutGap(self):
+        with self.assertRaises(IOError):
+            self.getParts(_Bucket(self.data, failAt=(100 + 3*64,)), 100)
+        self.assertEqual(self.data[:100 + 3*64], open(path.join(self.dir, 'object'), 'rb').read())
+
+class TestBucketPool(unittest.TestCase):
+    def setUp(self):
+        patch(self, s3store, _idleBuckets=[])
+
+    def testBucketsAreReturnedAfterEachCheck(self):
+        bucket = _Bucket({'ab/cdef': ''})
+        s3store._idleBuckets.append(bucket)
+        store = _Store()
+        self.assertEqual(['ab/cdef'], store.checkMany(['ab/cdef', 'ab/0123']).keys())
+        self.assertEqual([bucket], s3store._idleBuckets)
+        self.assertFalse(store.check('ab/0123'))
+        self.assertEqual([bucket], s3store._idleBuckets)
+
+    def testChunksAreListedByDirectory(self):
+        keys = ['chunks/ab/%038x'%i for i in range(30)]
+        bucket = _Bucket(dict((k, '') for k in keys[:25] + ['chunks/cd/' + '0'*38]))
+        s3store._idleBuckets.append(bucket)
+        self.assertEqual(set(keys[:25]), set(_Store().checkMany(keys)))
+        self.assertEqual(['chunks/ab/'], bucket.listed)
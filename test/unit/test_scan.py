@@ -0,0 +1,63 @@
+import unittest
+
+import fitlib
+from . import patch, tempDir
+from fitlib import attributes, scan
+from fitlib.scan import _FitPattern
+from os import chdir, getcwd, makedirs, path
+from subprocess import check_call
+
+class _Repo:
+    pass
+
+class TestFitPattern(unittest.TestCase):
+    def covers(self, base, pattern, d):
+        return _FitPattern(base, pattern).coversDir(d.split('/'))
+
+    def testUnanchoredPatternCoversEverythingBelowItsBase(self):
+        self.assertTrue(self.covers('', '*.bin', 'build/x/y'))
+        self.assertTrue(self.covers('assets', '*.bin', 'assets/x'))
+        self.assertTrue(self.covers('assets/art', '*.bin', 'assets'))
+        self.assertFalse(self.covers('assets', '*.bin', 'build'))
+
+    def testAnchoredPatternPrunesOtherDirectories(self):
+        self.assertTrue(self.covers('', 'data/*/*.dat', 'data'))
+        self.assertTrue(self.covers('', 'data/*/*.dat', 'data/x'))
+        self.assertFalse(self.covers('', 'data/*/*.dat', 'data/x/y'))
+        self.assertFalse(self.covers('', 'data/*/*.dat', 'build'))
+        self.assertFalse(self.covers('', '/top.bin', 'build'))
+        self.assertTrue(self.covers('', 'data/**', 'data/x/y/z'))
+        self.assertTrue(self.covers('', 'data/**/*.dat', 'data/x/y/z'))
+
+    def testNamePrefilter(self):
+        self.assertTrue(_FitPattern('', 'data/*.dat').matchesName('a.dat'))
+        self.assertFalse(_FitPattern('', 'data/*.dat').matchesName('a.txt'))
+        self.assertTrue(_FitPattern('', 'data/**').matchesName('a.txt'))
+
+class TestListCandidates(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempDir(self)
+        check_call(['git', 'init', '-q', self.dir])
+        repo = _Repo()
+        repo.gitDir = path.join(self.dir, '.git')
+        patch(self, attributes, repo=repo)
+        patch(self, fitlib, _config=None)
+        self.addCleanup(chdir, getcwd())
+        chdir(self.dir)
+
+    def write(self, filePath, data=''):
+        dirPath = path.dirname(filePath)
+        if dirPath and not path.exists(dirPath):
+            makedirs(dirPath)
+        with open(filePath, 'w') as f:
+            f.write(data)
+
+    def testAttributesInIgnoredDirectories(self):
+        self.write('.gitignore', 'nested/\nbuild/\n')
+        self.write('.gitattributes', '*.bin fit\n')
+        self.write('nested/deep/.gitattributes', 'foo.psd fit\n')
+        for f in ('nested/deep/foo.psd', 'nested/deep/er/foo.psd', 'nested/other/foo.psd', 'build/x/a.bin', 'build/x/a.o'):
+            self.write(f)
+        candidates = set(scan.listCandidates())
+        self.assertTrue({'nested/deep/foo.psd', 'nested/deep/er/foo.psd', 'build/x/a.bin'} <= candidates)
+        self.assertFalse('build/x/a.o' in candidates)
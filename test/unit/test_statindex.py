@@ -0,0 +1,54 @@
+import unittest
+
+from . import tempDir
+from fitlib import statindex
+from json import dump
+from os import path
+
+def getStats(numItems):
+    return {'dir%d/item%d'%(i%3, i): ('%040x'%((i+1)*7919), (i*100, 1400000000.25+i, 1400000001.5+i, 1000+i)) for i in range(numItems)}
+
+class TestStatIndex(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        self.index = path.join(tempDir(self), 'stat')
+
+    def testMissing(self):
+        self.assertEqual({}, statindex.read(self.index))
+        self.assertFalse(statindex.update(getStats(1), self.index))
+
+    def testRoundTrip(self):
+        stats = getStats(50)
+        stats['empty'] = (0, (0, 1.0, 2.0, 3))
+        statindex.write(stats, self.index)
+        self.assertTrue(statindex.isIndex(self.index))
+        self.assertEqual(stats, statindex.read(self.index))
+
+    def testUpdateInPlace(self):
+        stats = getStats(20)
+        statindex.write(stats, self.index)
+        changed = {'dir1/item7': ('f'*40, (1, 2.5, 3.5, 4))}
+        self.assertTrue(statindex.update(changed, self.index))
+        stats.update(changed)
+        self.assertEqual(stats, statindex.read(self.index))
+
+    def testUpdateUnknownItem(self):
+        stats = getStats(5)
+        statindex.write(stats, self.index)
+        self.assertFalse(statindex.update({'new': ('f'*40, (1, 2.0, 3.0, 4))}, self.index))
+        self.assertEqual(stats, statindex.read(self.index))
+
+    def testCorruptIndexIsEmpty(self):
+        statindex.write(getStats(5), self.index)
+        with open(self.index, 'r+b') as f:
+            f.seek(-1, 2)
+            f.write('#')
+        self.assertEqual({}, statindex.read(self.index))
+
+    def testMigrateFromJson(self):
+        stats = getStats(10)
+        with open(self.index, 'w') as f:
+            dump(stats, f)
+        self.assertEqual(stats, statindex.read(self.index))
+        self.assertTrue(statindex.isIndex(self.index))
+        self.assertEqual(stats, statindex.read(self.index))
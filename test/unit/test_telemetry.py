@@ -0,0 +1,36 @@
+import unittest
+
+from . import patch
+from fitlib import telemetry
+
+class _Store:
+    pass
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        patch(self, telemetry, writeRecords=self.written.extend, getConfigBool=lambda key, default: default)
+
+    def testRecords(self):
+        log = telemetry.TransferLog('get', _Store(), 4)
+        log.check(3, 0.5)
+        log.batch([('a', 'h1', 100), ('b', 'h2', 200)], [True, False], 2.0)
+        log.close([('a', 'h1', 100)], ['b'])
+
+        self.assertEqual(['check', 'batch', 'object', 'object', 'run'], [r['type'] for r in self.written])
+        self.assertTrue(all(r['op'] == 'get' and r['store'] == __name__ for r in self.written))
+        run = self.written[-1]
+        self.assertEqual((2, 100, 1, 1), (run['objects'], run['bytes'], run['successes'], run['failures']))
+
+    def testBatchTimeIsSharedBySize(self):
+        log = telemetry.TransferLog('put', _Store(), 4)
+        log.batch([('a', 'h1', 1048576), ('b', 'h2', 3*1048576)], [True, True], 2.0, 2)
+        batch, a, b = log.records
+        self.assertEqual((2, 4*1048576, 2.0, 2), (batch['count'], batch['bytes'], batch['seconds'], batch['attempts']))
+        self.assertEqual((0.5, 1.5), (a['seconds'], b['seconds']))
+
+    def testPercentile(self):
+        values = range(100, 0, -1)
+        self.assertEqual(51, telemetry._percentile(values, .5))
+        self.assertEqual(96, telemetry._percentile(values, .95))
+        self.assertEqual(0, telemetry._percentile([], .5))
@@ -0,0 +1,32 @@
+import unittest
+
+from . import patch
+from fitlib import timings
+
+@timings.phase('double')
+def double(x):
+    return 2*x
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        patch(self, timings, _timings=None)
+
+    def testDisabled(self):
+        self.assertEqual(4, double(2))
+        timings.count('things', 3)
+        self.assertFalse(timings.isEnabled())
+
+    def testPhasesAndCounts(self):
+        timings._timings = timings._Timings('log')
+        double(1)
+        double(2)
+        timings.count('things', 3)
+        timings.count('things')
+        record = timings._timings.record()
+        self.assertEqual(2, record['phases']['double']['calls'])
+        self.assertEqual({'things': 4}, record['counts'])
+
+    def testCommandNames(self):
+        self.assertEqual('git ls-files', timings._commandName(['/usr/bin/git', 'ls-files', '-o']))
+        self.assertEqual('git check-attr', timings._commandName('git check-attr --stdin'))
+        self.assertEqual('rsync', timings._commandName(['rsync']))